@@ -1,18 +1,30 @@
 from flask import Flask, redirect, url_for, escape, request, jsonify, abort, send_file, Response
 from werkzeug.utils import secure_filename
 import os
+import json
 import shutil
+import threading
 from io import BytesIO
+from collections import OrderedDict
+from tempfile import TemporaryDirectory
 
 import networkx as nx
 import numpy as np
 
 from src.py.bbbike_fixer import bbbike_fixer
 from src.py.osm_reader import read_osm_and_make_graph
+from src.py.network_cache import NetworkCache, file_key
+from src.py.network_store import NetworkStore, apply_edits, network_delta
 from src.py.nx_geojson import nx_to_geojson, geojson_to_nx
-from src.py.api_requester import make_requests
+from src.py import nx_columnar
+from src.py.api_requester import make_requests, print_progress
+from src.py.travel_time_cache import TravelTimeCache
+from src.py.traffic_sampling import sample_edges, interpolate_ratios
 from src.py.taz_creator import add_TAZs_to_network
-from src.py.trip_assigner import run_trip_assignment
+from src.py.trip_tables import TripTableStore, read_trip_table, trip_table_summary
+from src.py.trip_assigner import run_trip_assignment, run_scenarios, network_key, solver_settings
+from src.py.julia_worker import JuliaWorkerPool
+from src.py.jobs import JobQueue
 
 app = Flask(__name__, static_url_path='')
 app.config['MAX_CONTENT_LENGTH'] = 1024 * 1024 * 1024 # limit upload sizes to 1gb
@@ -24,11 +36,112 @@ app.secret_key = binascii.hexlify(os.urandom(24))
 UPLOAD_FOLDER = 'tmp'
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 
+# processed networks by upload contents, so repeated uploads of the same extract skip the osm pipeline
+network_cache = NetworkCache(os.path.join(UPLOAD_FOLDER, 'network_cache'), max_bytes=2 * 1024 * 1024 * 1024)
+
+# networks being worked on in the frontend, by id, so requests send edits rather than the whole network
+network_store = NetworkStore(max_bytes=1024 * 1024 * 1024,
+    spill_directory=os.path.join(UPLOAD_FOLDER, 'network_store'), max_spill_bytes=4 * 1024 * 1024 * 1024)
+
+# uploaded trip tables, by id, so assignment requests name one rather than sending the whole matrix
+trip_table_store = TripTableStore(max_bytes=1024 * 1024 * 1024)
+
+# directions travel times from earlier traffic requests, so re-fetching only pays for new edges/departure slots
+travel_time_cache = TravelTimeCache(os.path.join(UPLOAD_FOLDER, 'travel_times.sqlite'))
+
+# last equilibrium link flows per network/scenario, used to warm start re-assignments. runs work on a copy of
+# their entry and put it back when done, so concurrent runs of one scenario don't write to the same dict
+warm_starts = OrderedDict()
+warm_starts_lock = threading.Lock()
+WARM_START_LIMIT = 32
+
+# julia processes for the julia assignment engine, started with the server and kept running so runs don't each pay
+# julia's startup
+julia_workers = JuliaWorkerPool(workers=2)
+julia_workers.start()
+
+# long-running traffic fetches and assignments, run in the background; each job gets a directory under tmp/jobs
+job_queue = JobQueue(os.path.join(UPLOAD_FOLDER, 'jobs'), workers=4)
+
 # serve static site
 @app.route('/')
 def index():
     return app.send_static_file("index.html")
 
+# request payload, from json or the binary network format (see src/py/nx_columnar.py)
+def read_payload():
+    if request.mimetype == nx_columnar.MIME:
+        payload, _ = nx_columnar.decode(request.get_data())
+        return payload
+    return request.get_json()
+
+# the network in a payload as a graph; the binary format already arrives as one
+def payload_network(payload, key='nw'):
+    nw = payload[key]
+    return nw if isinstance(nw, nx.DiGraph) else geojson_to_nx(nw)
+
+# respond with the network in whichever format the client prefers, json by default. extra goes alongside the
+# network: merged into it, or next to it when key is given
+def network_response(g, extra, key=None):
+    if request.accept_mimetypes.best_match(['application/json', nx_columnar.MIME]) == nx_columnar.MIME:
+        return Response(nx_columnar.encode(g, extra, [key] if key else []), mimetype=nx_columnar.MIME)
+    if key:
+        return jsonify(dict(extra, **{key: nx_to_geojson(g)}))
+    gj = nx_to_geojson(g)
+    gj.update(extra)
+    return jsonify(gj)
+
+# answer 410, naming what the request referred to by id that the server no longer has: 'network' or 'trip_table'
+def abort_expired(what):
+    response = jsonify(expired=what)
+    response.status_code = 410
+    abort(response)
+
+# the network a request works on, as (stored network or None, working copy). requests either name a stored
+# network by 'nw_id', with the user's edits since then in 'edits', or send the whole network in 'nw'
+def checkout_network(payload):
+    if not payload.get('nw_id'):
+        return None, payload_network(payload)
+    base = network_store.get(payload['nw_id'])
+    if base is None:
+        # evicted, or from before a restart: the client sends the full network instead
+        abort_expired('network')
+    try:
+        return base, apply_edits(base.copy(), payload.get('edits'))
+    except (KeyError, ValueError) as e:
+        print(e)
+        abort(400)
+
+# store the resulting network and respond with its id, plus only what changed from the stored network the
+# request named, or the full network if it sent one
+def session_response(base, g, extra, nw_id=None):
+    extra = dict(extra, nw_id=nw_id or network_store.put(g))
+    if base is None:
+        return network_response(g, extra)
+    return jsonify(dict(extra, delta=network_delta(base, g)))
+
+# the trip table a request works on goes in 'tt' (and its total in 'tot'), whether the request sent it or named an
+# uploaded one by 'tt_id'
+def checkout_trip_table(payload):
+    if not payload.get('tt_id'):
+        return
+    tt = trip_table_store.get(payload['tt_id'])
+    if tt is None:
+        # evicted, or from before a restart: the client uploads it again
+        abort_expired('trip_table')
+    payload['tt'] = tt
+    payload.setdefault('ntazs', tt.shape[0])
+    payload.setdefault('tot', tt.sum())
+
+# the solver settings for an assignment go in 'settings', from the optional convergence controls the request sent:
+# target relative 'gap', 'max_iterations' and 'time_budget' in seconds (whichever is reached first stops it)
+def checkout_solver_settings(payload):
+    try:
+        payload['settings'] = solver_settings(payload.get('gap'), payload.get('max_iterations'), payload.get('time_budget'))
+    except ValueError as e:
+        print(e)
+        abort(400)
+
 # convenience function to verify approved file type extensions
 def allowed_file(filename, allowed_extensions):
     return '.' in filename and \
@@ -41,91 +154,282 @@ def upload_osm():
         print('empty osm upload')
         abort(400)
     file = request.files['file']
-    if (not file) or file.filename == '' or (not allowed_file(file.filename, set(['osm']))):
+    if (not file) or file.filename == '' or (not allowed_file(file.filename, set(['osm', 'pbf']))):
         print('osm extension is bad')
         abort(400)
     else:
         filename = os.path.join(app.config['UPLOAD_FOLDER'], secure_filename(file.filename))
         file.save(filename)
         
-        try:
-            g, eo, no, es, ns, mlon, mlat = read_osm_and_make_graph(filename)
-        except KeyError as e:
-            if str(e) != '\'changeset\'':
-                raise
-            else:
-                bbbike_fixer(filename, filename)
-                g, eo, no, es, ns, mlon, mlat = read_osm_and_make_graph(filename)
+        # key on the bytes as uploaded, before any bbbike fix rewrites the file
+        key = file_key(filename, streaming=True, lengths='geodesic')
+        cached = network_cache.get(key)
+        timings = {}
+        if cached is not None:
+            g, counts = cached
+            eo, no, es, ns, mlon, mlat = (counts[k] for k in ('eo', 'no', 'es', 'ns', 'mlon', 'mlat'))
+        else:
+            try:
+                g, eo, no, es, ns, mlon, mlat = read_osm_and_make_graph(filename, timings=timings)
+            except KeyError as e:
+                if str(e) != '\'changeset\'':
+                    raise
+                else:
+                    bbbike_fixer(filename, filename)
+                    g, eo, no, es, ns, mlon, mlat = read_osm_and_make_graph(filename, timings=timings)
+            network_cache.put(key, g, eo=eo, no=no, es=es, ns=ns, mlon=mlon, mlat=mlat)
+            print('osm processing times (s): ' + ', '.join('{} {:.2f}'.format(k, v) for k, v in timings.items()))
         os.remove(filename)
+        print('network cache {}: {}'.format('hit' if cached is not None else 'miss', network_cache.stats()))
 
-        return jsonify({
-            'edges_original': eo,
-            'nodes_original': no,
-            'edges_simplified': es,
-            'nodes_simplified': ns,
-            'mean_longitude': mlon,
-            'mean_latitude': mlat,
-            'network': nx_to_geojson(g)
-        })
+        g = g.to_networkx()
+        return network_response(g, {
+            'edges_original': int(eo),
+            'nodes_original': int(no),
+            'edges_simplified': int(es),
+            'nodes_simplified': int(ns),
+            'mean_longitude': float(mlon),
+            'mean_latitude': float(mlat),
+            'cached': cached is not None,
+            'timings': timings,
+            'nw_id': network_store.put(g)
+        }, key='network')
 
     abort(400)
 
+# hit/miss counts and size of the processed network cache
+@app.route('/_network_cache', methods=['GET'])
+def network_cache_stats():
+    return jsonify(network_cache.stats())
+
+# size and hit counts of the network session store
+@app.route('/_network_store', methods=['GET'])
+def network_store_stats():
+    return jsonify(network_store.stats())
+
+# count and size of the stored trip tables
+@app.route('/_trip_tables', methods=['GET'])
+def trip_table_stats():
+    return jsonify(trip_table_store.stats())
+
+# get free flow 2am and congested 8am travel times for a network. payload: api_key, ff and am departure times,
+# optionally sample (a fraction or number of edges to query, estimating the rest) and batch
+def fetch_traffic(g, payload, progress=print_progress, log_label=None):
+    sample = payload.get('sample')
+
+    # optionally query only a sample of edges: a fraction of them, or a number of edges
+    if sample:
+        queried = sample_edges(g, int(sample * g.number_of_edges()) if sample < 1 else int(sample))
+    else:
+        queried = list(g.edges())
+
+    g = make_requests(payload['api_key'], payload['ff'], payload['am'], g,
+        cache=travel_time_cache, batch=payload.get('batch', False), edges=queried,
+        progress=progress, log_label=log_label)
+
+    # calculate api ratio
+    for n1,n2 in queried:
+        dat = g[n1][n2]
+        g[n1][n2]['api_ratio'] = (dat['am_best_guess']/dat['ff_best_guess']) if ((dat['am_best_guess'] > 0) and (dat['ff_best_guess'] > 0)) else 1
+
+    # and estimate it everywhere else
+    if sample:
+        measured, interpolated = interpolate_ratios(g, queried)
+        g.graph['traffic'].update(measured=measured, interpolated=interpolated)
+
+    return g, {'traffic': dict(g.graph.get('traffic', {}), cache=travel_time_cache.stats())}
+
 # given api key and date, get and return network with free flow 2am traffic times and 8am congested times.
 @app.route('/_get_traffic', methods=['POST'])
 def get_traffic():
-    payload = request.get_json()
+    payload = read_payload()
+    base, g = checkout_network(payload)
 
     try:
-        g = make_requests(payload['api_key'], payload['ff'], payload['am'], geojson_to_nx(payload['nw']))
+        g, extra = fetch_traffic(g, payload)
     except Exception as e:
         print(e)
         abort(400)
 
-    # calculate api ratio
-    for n1,n2,dat in g.edges(data=True):
-        g[n1][n2]['api_ratio'] = (dat['am_best_guess']/dat['ff_best_guess']) if ((dat['am_best_guess'] > 0) and (dat['ff_best_guess'] > 0)) else 1
-    
-    return jsonify(nx_to_geojson(g))
+    return session_response(base, g, extra)
 
 # add TAZs to network by attaching to nodes specified and return result.
 @app.route('/_create_tazs', methods=['POST'])
 def create_tazs():
-    payload = request.get_json()
+    payload = read_payload()
+    base, g = checkout_network(payload)
 
-    return jsonify(nx_to_geojson(add_TAZs_to_network(geojson_to_nx(payload['nw']), payload['tazList'])))
+    return session_response(base, add_TAZs_to_network(g, payload['tazList']), {})
 
-# upload trip table, check that it's square, and return as JSON.
+# upload trip table (dense or long form csv, npy or npz, see src/py/trip_tables.py), check that it's square, store
+# it and return its id with a summary. a long form table's zone count can be given as ntazs, for when its last
+# zones have no trips
 @app.route('/_upload_trip_table', methods=['POST'])
 def upload_trips():
     # check if the post request has the file part
     if 'file' not in request.files:
         abort(400)
     file = request.files['file']
-    if (not file) or file.filename == '' or (not allowed_file(file.filename, set(['csv']))):
+    if (not file) or file.filename == '' or (not allowed_file(file.filename, set(['csv', 'npy', 'npz']))):
         abort(400)
     else:
         filename = os.path.join(app.config['UPLOAD_FOLDER'], secure_filename(file.filename))
         file.save(filename)
         
         try:
-            tt = np.genfromtxt(filename, delimiter=',')
-            assert tt.shape[0] == tt.shape[1]
-            assert tt.shape[0] > 1
-        except AssertionError:
+            tt = read_trip_table(filename, ntazs=request.form.get('ntazs', type=int))
+        except ValueError as e:
+            print(e)
             abort(400)
-        os.remove(filename)
+        finally:
+            os.remove(filename)
 
-        return jsonify({
-            'trip_table': tt.tolist(),
-            'total_trips': tt.sum().sum(),
-            'ntazs': tt.shape[0]
-        })
+        return jsonify(dict(trip_table_summary(tt), table_id=trip_table_store.put(tt)))
 
     abort(400)
 
-# take in network and trip table as JSONs, run traffic assignment, and return resulting network.
+# run traffic assignment for payload's trip table (tt, ntazs, tot), warm starting from the last run of the same
+# network and scenario, with its engine: python by default, since only the in-process engines warm start; julia, or
+# paths for tight gaps (see run_trip_assignment). workdir: for the engine's files. with table set in the payload,
+# returns the link results as columns (see link_results in src/py/trip_assigner.py) and leaves g as it is
+def assign_traffic(g, payload, workdir, progress=None):
+    key = (network_key(g, payload['ntazs']), payload.get('scenario'))
+    with warm_starts_lock:
+        warm_start = dict(warm_starts.get(key, {}))
+
+    result = run_trip_assignment(g, payload['ntazs'], payload['tt'], payload['tot'],
+        engine=payload.get('engine', 'python'), warm_start=warm_start, workdir=workdir, progress=progress,
+        julia_workers=julia_workers, table=payload.get('table', False), settings=payload['settings'])
+
+    # keep the most recently used scenarios only
+    with warm_starts_lock:
+        warm_starts.pop(key, None)
+        warm_starts[key] = warm_start
+        while len(warm_starts) > WARM_START_LIMIT:
+            warm_starts.popitem(last=False)
+    if payload.get('table'):
+        return result, {}
+
+    return result, {'assignment': result.graph.get('assignment', {})}
+
+# take in network and trip table as JSONs, run traffic assignment, and return resulting network (or with table set in
+# the payload, just the link results).
 @app.route('/_do_assignment', methods=['POST'])
 def do_assignment():
-    payload = request.get_json()
+    payload = read_payload()
+    base, g = checkout_network(payload)
+    checkout_trip_table(payload)
+    checkout_solver_settings(payload)
+
+    with TemporaryDirectory(dir=app.config['UPLOAD_FOLDER']) as workdir:
+        result, extra = assign_traffic(g, payload, workdir)
+
+    if payload.get('table'):
+        return table_response(result)
+    return session_response(base, result, extra)
+
+# solve several scenarios (trip tables, or scalings of one) on one network: payload has the network, ntazs and
+# scenarios ([{name, tt} or {name, scale}]), optionally a base tt to scale, the engine (python by default: its
+# scenarios share one prepared network across a process pool) and the number of workers
+def assign_scenarios(g, payload, workdir, progress=None):
+    return run_scenarios(g, payload['ntazs'], payload['scenarios'], base_trip_table=payload.get('tt'),
+        engine=payload.get('engine', 'python'), workers=payload.get('workers'), workdir=workdir, progress=progress,
+        julia_workers=julia_workers, settings=payload['settings'])
+
+TABLE_MIME = 'application/x-npz'
+
+# a link table (from run_scenarios, or run_trip_assignment's table option): json by default, or for clients that
+# accept it an .npz of the arrays, with the rest (scenario details, stats) as json strings
+def table_response(table):
+    if request.accept_mimetypes.best_match(['application/json', TABLE_MIME]) == TABLE_MIME:
+        f = BytesIO()
+        np.savez_compressed(f, **{k: (v if isinstance(v, np.ndarray) else np.array(json.dumps(v)))
+                                  for k, v in table.items()})
+        return Response(f.getvalue(), mimetype=TABLE_MIME)
+    return jsonify({k: (v.tolist() if isinstance(v, np.ndarray) else v) for k, v in table.items()})
+
+@app.route('/_do_scenario_assignment', methods=['POST'])
+def do_scenario_assignment():
+    payload = read_payload()
+    base, g = checkout_network(payload)
+    checkout_trip_table(payload)
+    checkout_solver_settings(payload)
+
+    try:
+        with TemporaryDirectory(dir=app.config['UPLOAD_FOLDER']) as workdir:
+            table = assign_scenarios(g, payload, workdir)
+    except ValueError as e:
+        print(e)
+        abort(400)
+
+    return table_response(table)
+
+# the same steps as background jobs. a job's result is a function making the response, fetched from
+# /_jobs/<id>/result in the same form as the synchronous endpoint's; networks are stored when the job finishes
+def traffic_job(job, base, g, payload):
+    g, extra = fetch_traffic(g, payload, progress=lambda done, total: job.report(done=done, total=total),
+        log_label=job.id[:8])
+    nw_id = network_store.put(g)
+    return lambda: session_response(base, g, extra, nw_id=nw_id)
+
+def assignment_job(job, base, g, payload):
+    result, extra = assign_traffic(g, payload, job.workdir,
+        progress=lambda k, gap, obj: job.report(iteration=k, gap=gap, objective=obj))
+    if payload.get('table'):
+        return lambda: table_response(result)
+    nw_id = network_store.put(result)
+    return lambda: session_response(base, result, extra, nw_id=nw_id)
+
+def scenarios_job(job, base, g, payload):
+    table = assign_scenarios(g, payload, job.workdir,
+        progress=lambda done, total: job.report(done=done, total=total))
+    return lambda: table_response(table)
+
+JOB_TASKS = {
+    'traffic': traffic_job,
+    'assignment': assignment_job,
+    'scenarios': scenarios_job
+}
+
+# submit a job: same payload as /_get_traffic, /_do_assignment or /_do_scenario_assignment. responds with the job's status, including its id
+@app.route('/_jobs/<kind>', methods=['POST'])
+def submit_job(kind):
+    if kind not in JOB_TASKS:
+        abort(404)
+    payload = read_payload()
+    base, g = checkout_network(payload)
+    checkout_trip_table(payload)
+    checkout_solver_settings(payload)
+
+    job = job_queue.submit(kind, JOB_TASKS[kind], base, g, payload)
+    return jsonify(job.info()), 202
+
+# counts of jobs by status
+@app.route('/_jobs', methods=['GET'])
+def job_stats():
+    return jsonify(job_queue.stats())
+
+# status and progress: requests done and total for traffic, iteration, gap and objective for assignments, and
+# scenarios done and total for scenario batches
+@app.route('/_jobs/<job_id>', methods=['GET'])
+def job_status(job_id):
+    job = job_queue.get(job_id)
+    if job is None:
+        abort(404)
+    return jsonify(job.info())
+
+@app.route('/_jobs/<job_id>/result', methods=['GET'])
+def job_result(job_id):
+    job = job_queue.get(job_id)
+    if job is None:
+        abort(404)
+    if job.status != 'done':
+        return jsonify(job.info()), 409
+    return job.result()
 
-    return jsonify(nx_to_geojson(run_trip_assignment(geojson_to_nx(payload['nw']), payload['ntazs'], payload['tt'], payload['tot'])))
+@app.route('/_jobs/<job_id>/cancel', methods=['POST'])
+def cancel_job(job_id):
+    job = job_queue.cancel(job_id)
+    if job is None:
+        abort(404)
+    return jsonify(job.info())
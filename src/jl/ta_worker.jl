@@ -0,0 +1,72 @@
+# long-lived traffic assignment worker, started by src/py/julia_worker.py, so the packages are loaded and
+# ta_frank_wolfe is compiled once rather than for every assignment. it takes jobs on stdin, one at a time, and
+# answers on the file descriptor given as ARGS[1], leaving stdout and stderr for logs. all little-endian:
+#   job: Int64 zones, nodes, links | Float64 total od flow | Float64 tol | Int64 max iterations |
+#        Float64 time budget in seconds (Inf for none) | Int64 tail, head [links] |
+#        Float64 capacity, length, free flow time, b, power, speed limit, toll [links] | Int64 type [links] |
+#        Float64 initial travel time [links] | Int64 od pairs with trips |
+#        Int64 origins [pairs] | Int64 destinations [pairs] | Float64 trips [pairs]
+#   answers: 'R' once ready | 'I' Int64 iteration, Float64 relative gap, objective, after each iteration |
+#            then 'D' Float64 objective, xk [links], travel time [links], fixed flow [links] |
+#            or 'E' Int64 length, utf-8 error message
+# the worker exits when stdin closes.
+
+const TA_WORKER = true
+include("traffic_assignment.jl")
+
+const out = fdio(parse(Int, ARGS[1]))
+
+function send(tag, values...)
+    write(out, UInt8(tag))
+    for v in values
+        write(out, isa(v, Array) ? htol.(v) : htol(v))
+    end
+    flush(out)
+end
+
+readvec(T, n) = map(ltoh, read(STDIN, T, n))
+
+function read_job()
+    zones, nodes, links = readvec(Int64, 3)
+    total_od_flow = readvec(Float64, 1)[1]
+    tol = readvec(Float64, 1)[1]
+    max_iter_no = readvec(Int64, 1)[1]
+    time_budget = readvec(Float64, 1)[1]
+    start_node = readvec(Int64, links)
+    end_node = readvec(Int64, links)
+    capacity, link_length, free_flow_time, B, power, speed_limit, toll = [readvec(Float64, links) for i=1:7]
+    link_type = readvec(Int64, links)
+    travel_time = readvec(Float64, links)
+    pairs = readvec(Int64, 1)[1]
+    origins = readvec(Int64, pairs)
+    destinations = readvec(Int64, pairs)
+    travel_demand = sparse(origins, destinations, readvec(Float64, pairs), zones, zones)
+
+    ta_data = TA_Data("worker", zones, nodes, links, start_node, end_node, capacity, link_length, free_flow_time, B,
+        power, speed_limit, toll, link_type, total_od_flow, travel_demand, Array{Tuple{Int64, Int64}}(0),
+        0.0, 0.0, -1.0, travel_time)
+    return ta_data, tol, max_iter_no, time_budget
+end
+
+# same settings as the script
+function solve_job(ta_data, send; tol=1e-4, max_iter_no=2000, time_budget=Inf)
+    xk, travel_time, obj, fixed_flow = ta_frank_wolfe(ta_data; log=:off, method=:cfw, tol=tol, max_iter_no=max_iter_no,
+        min_iter_no=5, time_budget=time_budget, progress=(k, rel_gap, obj) -> send('I', k, rel_gap, obj))
+    send('D', obj, xk, travel_time, fixed_flow)
+end
+
+# compile everything on a two-zone network before taking jobs
+solve_job(TA_Data("warmup", 2, 2, 2, [1, 2], [2, 1], [1000.0, 1000.0], [1.0, 1.0], [60.0, 60.0], [0.15, 0.15],
+    [4.0, 4.0], [30.0, 30.0], [0.0, 0.0], [1, 1], 20.0, sparse([1, 2], [2, 1], [10.0, 10.0], 2, 2),
+    Array{Tuple{Int64, Int64}}(0), 0.0, 0.0, -1.0, [66.0, 66.0]), (tag, values...) -> nothing)
+
+send('R')
+while !eof(STDIN)
+    ta_data, tol, max_iter_no, time_budget = read_job()
+    try
+        solve_job(ta_data, send; tol=tol, max_iter_no=max_iter_no, time_budget=time_budget)
+    catch e
+        message = convert(Vector{UInt8}, sprint(showerror, e))
+        send('E', length(message), message)
+    end
+end
@@ -23,7 +23,7 @@ type TA_Data
 
     total_od_flow::Float64
 
-    travel_demand::Array{Float64,2}
+    travel_demand::SparseMatrixCSC{Float64,Int64}
     od_pairs::Array{Tuple{Int64,Int64},1}
 
     toll_factor::Float64
@@ -34,14 +34,6 @@ type TA_Data
     travel_time::Array{Float64,1}
 end
 
-net_filename = ARGS[1]
-net_metadata_filename = ARGS[2]
-
-trip_metadata_filename = ARGS[3]
-trip_filename = ARGS[4]
-
-output_filename = ARGS[5]
-
 function load_ta_network(net_name, net_metadata_filename, net_filename, trip_metadata_filename, trip_filename; 
     best_objective=-1.0, toll_factor=0.0, distance_factor=0.0, travel_time_initialization=nothing, fftime=:fftime)
 
@@ -94,24 +86,23 @@ function load_ta_network(net_name, net_metadata_filename, net_filename, trip_met
     @assert number_of_zones_trip == number_of_zones # Check if number_of_zone is same in both txt files
     @assert total_od_flow > 0
 
-    travel_demand = zeros(number_of_zones, number_of_zones)
     od_pairs = Array{Tuple{Int64, Int64}}(0)
 
-    dft = CSV.read(trip_filename; allowmissing=:none)
-
     ## old: columnar format
     # for row in eachrow(dft)
     #     push!(od_pairs, (row[1], row[2]))
     #     travel_demand[row[1], row[2]] = row[3]
     # end
 
-    # new: od table format
-    sort!(dft,1)
-    delete!(dft,1)
-    for i = 1:size(dft,2)
-        for j = 1:size(dft,1)
-            travel_demand[i,j] = dft[i,j]
-        end
+    # new: the od pairs with trips as raw little-endian arrays (Int64 origins, Int64 destinations, Float64 trips),
+    # as dump_trips_binary writes them to trips.bin (the metadata is still csv)
+    number_of_pairs = Int(dftm[3,2])
+    @assert filesize(trip_filename) == 24 * number_of_pairs
+    travel_demand = open(trip_filename) do io
+        origins = map(ltoh, read(io, Int64, number_of_pairs))
+        destinations = map(ltoh, read(io, Int64, number_of_pairs))
+        trips = map(ltoh, read(io, Float64, number_of_pairs))
+        sparse(origins, destinations, trips, number_of_zones, number_of_zones)
     end
 
     # Preparing data to return
@@ -144,9 +135,6 @@ function load_ta_network(net_name, net_metadata_filename, net_filename, trip_met
 
 end # end of load_network function
 
-dat = load_ta_network("moffet", net_metadata_filename, net_filename, trip_metadata_filename, trip_filename; 
-    travel_time_initialization=:am, fftime=:base)
-
 function TA_dijkstra_shortest_paths(graph, travel_time, origin, start_node, end_node)
     no_node = nv(graph)
     no_arc = ne(graph)
@@ -230,11 +218,15 @@ end
 # include("misc.jl")
 
 
-function ta_frank_wolfe(ta_data; method=:bfw, min_iter_no=5, max_iter_no=2000, step=:exact, log=:off, tol=1e-3)
+function ta_frank_wolfe(ta_data; method=:bfw, min_iter_no=5, max_iter_no=2000, step=:exact, log=:off, tol=1e-3, progress=nothing,
+    time_budget=Inf)
     # in the original algorithm, x/xk represented distribution of flow
     # in this edited version, it represents the distribution of additional flow from our OD trips on top of inferred existing flows
+    # progress(k, rel_gap, obj) is called after each iteration; without it the script prints them for the python side
+    # time_budget: seconds after which to stop with the flows so far, if tol or max_iter_no aren't reached first
     
-    setup_time = time()
+    start_time = time()
+    setup_time = start_time
 
     if log==:on
         println("-------------------------------------")
@@ -271,6 +263,11 @@ function ta_frank_wolfe(ta_data; method=:bfw, min_iter_no=5, max_iter_no=2000, s
     travel_demand = ta_data.travel_demand
     od_pairs = ta_data.od_pairs
 
+    # each origin's trips as a column, so all-or-nothing only visits origins and od pairs with trips
+    demand_by_origin = transpose(travel_demand)
+    destinations = rowvals(demand_by_origin)
+    trips = nonzeros(demand_by_origin)
+
     toll_factor = ta_data.toll_factor
     distance_factor = ta_data.distance_factor
 
@@ -370,15 +367,17 @@ function ta_frank_wolfe(ta_data; method=:bfw, min_iter_no=5, max_iter_no=2000, s
         state = LightGraphs.DijkstraState{Float64}
         x = zeros(size(start_node))
 
-        for r=1:size(travel_demand)[1]
+        for r=1:number_of_zones
+            if isempty(nzrange(demand_by_origin, r))
+                continue
+            end
             # for each origin node r, find shortest paths to all destination nodes
             state = TA_dijkstra_shortest_paths(graph, travel_time, r, start_node, end_node)
 
-            for s=1:size(travel_demand)[2]
-                # for each destination node s, find the shortest-path vector
-                # load travel demand
+            for i in nzrange(demand_by_origin, r)
+                # for each destination node s with trips from r, load them on the shortest path
                 # x = x + travel_demand[r,s] * get_vector(state, r, s, link_dic)
-                add_demand_vector!(x, travel_demand[r,s], state, r, s, link_dic)
+                add_demand_vector!(x, trips[i], state, r, destinations[i], link_dic)
             end
         end
         return x
@@ -391,23 +390,18 @@ function ta_frank_wolfe(ta_data; method=:bfw, min_iter_no=5, max_iter_no=2000, s
         vv = zeros(size(start_node))
         x = zeros(size(start_node))
 
-        x = x + @parallel (+) for r=1:size(travel_demand)[1]
+        x = x + @parallel (+) for r=1:number_of_zones
             # for each origin node r, find shortest paths to all destination nodes
             # if there is any travel demand starting from node r.
             vv = zeros(size(start_node))
 
-            if sum(travel_demand, 2)[r] > 0.0
+            if !isempty(nzrange(demand_by_origin, r))
                 state = TA_dijkstra_shortest_paths(graph, travel_time, r, start_node, end_node)
 
-                for s=1:size(travel_demand)[2]
-                    # for each destination node s, find the shortest-path vector
-                    # v = get_vector(state, r, s, start_node, end_node)
-
-                    if travel_demand[r,s] > 0.0
-                        # load travel demand
-                        # vv = vv + travel_demand[r,s] * get_vector(state, r, s, link_dic)
-                        add_demand_vector!(vv, travel_demand[r,s], state, r, s, link_dic)
-                    end
+                for i in nzrange(demand_by_origin, r)
+                    # for each destination node s with trips from r, load them on the shortest path
+                    # vv = vv + travel_demand[r,s] * get_vector(state, r, s, link_dic)
+                    add_demand_vector!(vv, trips[i], state, r, destinations[i], link_dic)
                 end
 
             end
@@ -623,7 +617,17 @@ function ta_frank_wolfe(ta_data; method=:bfw, min_iter_no=5, max_iter_no=2000, s
 
 #         rel_gap = ( objective(xk) - best_objective ) / best_objective
 #         rel_gap = ( best_objective - obj )
-        rel_gap = abs( objective(xk) - best_objective ) / best_objective
+        # relative gap: how much the total travel time is over that of the all-or-nothing flows at the same times
+        total_time = dot(xk, travel_time)
+        rel_gap = total_time > 0 ? max(0.0, ( total_time - dot(yk_FW, travel_time) ) / total_time) : 0.0
+
+        if progress === nothing
+            # progress for the python side, which reads it line by line
+            @printf("iteration %d %.10e %.10e\n", k, rel_gap, obj)
+            flush(STDOUT)
+        else
+            progress(k, rel_gap, obj)
+        end
 
         # Convergence Test
 #         if average_excess_cost < tol
@@ -642,6 +646,13 @@ function ta_frank_wolfe(ta_data; method=:bfw, min_iter_no=5, max_iter_no=2000, s
         xk = new_x
 
         @assert minimum(xk) >= 0
+
+        if time() - start_time > time_budget
+            if log==:on
+                println("Exited on reaching time_budget")
+            end
+            break
+        end
     end
 
     if log==:on
@@ -658,7 +669,28 @@ function ta_frank_wolfe(ta_data; method=:bfw, min_iter_no=5, max_iter_no=2000, s
 
 end
 
-xk, travel_time, obj, fixed_flow = ta_frank_wolfe(dat; log=:off, method=:cfw, tol=1e-9, max_iter_no=2000, min_iter_no=5) # :bfw results in xk<0 error
+# run as a script on the files dump_network_as_csvs/dump_trips_binary write. src/jl/ta_worker.jl includes this
+# file for the definitions only
+if !isdefined(:TA_WORKER)
+    net_filename = ARGS[1]
+    net_metadata_filename = ARGS[2]
+
+    trip_metadata_filename = ARGS[3]
+    trip_filename = ARGS[4]
 
-df = DataFrame(tail=dat.start_node, head=dat.end_node, travel_time=travel_time, xk=xk, fixed_flow=fixed_flow)
-CSV.write(output_filename, df)
+    output_filename = ARGS[5]
+
+    # optional convergence controls: tol, max_iter_no and time budget in seconds
+    tol = length(ARGS) >= 6 ? parse(Float64, ARGS[6]) : 1e-4
+    max_iter_no = length(ARGS) >= 7 ? parse(Int, ARGS[7]) : 2000
+    time_budget = length(ARGS) >= 8 ? parse(Float64, ARGS[8]) : Inf
+
+    dat = load_ta_network("moffet", net_metadata_filename, net_filename, trip_metadata_filename, trip_filename; 
+        travel_time_initialization=:am, fftime=:base)
+
+    xk, travel_time, obj, fixed_flow = ta_frank_wolfe(dat; log=:off, method=:cfw, tol=tol, max_iter_no=max_iter_no, min_iter_no=5,
+        time_budget=time_budget) # :bfw results in xk<0 error
+
+    df = DataFrame(tail=dat.start_node, head=dat.end_node, travel_time=travel_time, xk=xk, fixed_flow=fixed_flow)
+    CSV.write(output_filename, df)
+end
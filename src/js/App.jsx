@@ -32,6 +32,11 @@ export default class App extends React.Component {
             network: null,
             network_api_only: null,
 
+            // id of the network in the server's network store, and edits to edges made since it was stored
+            nw_id: null,
+            nw_id_api_only: null,
+            edits: {},
+
             // used for trip assignment
             ntazs: 0,
             tazList: null,
@@ -63,7 +68,9 @@ export default class App extends React.Component {
             ns: rs.nodes_simplified,
             mlon: rs.mean_longitude,
             mlat: rs.mean_latitude,
-            network: rs.network
+            network: rs.network,
+            nw_id: rs.nw_id,
+            edits: {}
         });
     }
 
@@ -75,14 +82,21 @@ export default class App extends React.Component {
         this.setState({
             state: 2,
             network: nw,
-            network_api_only: JSON.parse(JSON.stringify(nw))
+            network_api_only: JSON.parse(JSON.stringify(nw)),
             // deep copy network (which was provided as text by the server API to begin with) to allow for state reset
+            nw_id: nw.nw_id,
+            nw_id_api_only: nw.nw_id,
+            edits: {}
         });
     }
 
-    updateNetwork(newNet) {
+    updateNetwork(newNet, edited) {
         this.setState({
-            network: newNet
+            network: newNet,
+            // only edge properties can be edited
+            edits: (edited && (edited.geometry.type === 'LineString')) ? update(this.state.edits, {
+                [edited.id]: {$set: edited.properties}
+            }) : this.state.edits
         });
     }
 
@@ -118,14 +132,16 @@ export default class App extends React.Component {
         this.setState({
             state: 4,
             tazList: null,
-            network: nw
+            network: nw,
+            nw_id: nw.nw_id,
+            edits: {}
         });
     }
 
     handleTripTable(rs) {
         this.setState({
             state: ((this.state.state === 4) ? 5 : 7), // first time trip table or not
-            incomingTripTable: rs.trip_table,
+            incomingTripTable: rs, // summary and id of the table stored server-side
             totalTrips: rs.total_trips
         });
     }
@@ -142,6 +158,8 @@ export default class App extends React.Component {
         this.setState({
             state: 6,
             network: rs,
+            nw_id: rs.nw_id,
+            edits: {},
             tripTable: this.state.incomingTripTable,
             incomingTripTable: null
         })
@@ -151,6 +169,8 @@ export default class App extends React.Component {
         this.setState({
             state: 2,
             network: this.state.network_api_only,
+            nw_id: this.state.nw_id_api_only,
+            edits: {},
             tripTable: null,
             incomingTripTable: null,
             totalTrips: 0,
@@ -208,6 +228,7 @@ export default class App extends React.Component {
                                 es = {this.state.es}
                                 ns = {this.state.ns}
                                 network = {this.state.network}
+                                session = {{nw_id: this.state.nw_id, edits: this.state.edits}}
                                 handleAPIrequests = {this.handleAPIrequests}
                             />
                         ) : (null)}
@@ -220,6 +241,7 @@ export default class App extends React.Component {
                             <TAZcreator
                                 ntazs={this.state.ntazs}
                                 network={this.state.network}
+                                session={{nw_id: this.state.nw_id, edits: this.state.edits}}
                                 tazList={this.state.tazList}
                                 setTAZs={this.setTAZs}
                             />
@@ -236,6 +258,7 @@ export default class App extends React.Component {
                         {((this.state.state === 5) || (this.state.state === 7)) ? (
                             <TripAssigner
                                 network={this.state.network}
+                                session={{nw_id: this.state.nw_id, edits: this.state.edits}}
                                 ntazs={this.state.ntazs}
                                 tripTable={this.state.incomingTripTable}
                                 totalTrips={this.state.totalTrips}
@@ -158,7 +158,7 @@ export default class NetVisualizer extends React.Component {
     editFeature(editedFeature) {
         this.state.gjlayer.removeLayer(this.state.layerBeingEdited);
         this.state.gjlayer.addData(editedFeature);
-        this.props.updateNetwork(this.state.gjlayer.toGeoJSON());
+        this.props.updateNetwork(this.state.gjlayer.toGeoJSON(), editedFeature);
         // edge recolor lags unless wrapped in a setState for some reason
         // recolor edges after editing in case the edit changes the min or max and therefore the colorscale for the current edge coloring
         // set layerBeingEdited to null because during editing the feature is effectively deleted and recreated, so the old pointer is broken
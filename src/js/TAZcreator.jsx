@@ -2,6 +2,8 @@ import React from 'react';
 import { scaleSequential } from 'd3-scale';
 import { interpolateRainbow } from 'd3-scale-chromatic';
 
+import { postNetworkSession } from './networkCodec';
+
 export default class TAZcreator extends React.Component {
     constructor(props) {
         super(props);
@@ -12,34 +14,16 @@ export default class TAZcreator extends React.Component {
     uploadTAZs(e) {
         e.preventDefault();
 
-        fetch('/_create_tazs', {
-            method: "POST", // *GET, POST, PUT, DELETE, etc.
-            // mode: "cors", // no-cors, cors, *same-origin
-            // cache: "no-cache", // *default, no-cache, reload, force-cache, only-if-cached
-            credentials: "same-origin", // include, same-origin, *omit
-            headers: {
-                "Accept": "application/json; charset=utf-8",
-                "Content-Type": "application/json; charset=utf-8",
-            },
-            // redirect: "follow", // manual, *follow, error
-            // referrer: "no-referrer", // no-referrer, *client
-            body: JSON.stringify({
-                nw: this.props.network,
-                tazList: this.props.tazList
-            }), // body data type must match "Content-Type" header
-        }).then((response) => {
-                if (!response.ok) {
-                    throw Error(response.statusText);
-                }
-                return response.json();
-            }).then((rjson) => {
-                this.props.setTAZs(rjson);
-            }).catch((error) => {
-                console.log(error);
-                this.setState({
-                    failed: true
-                })
-            });
+        postNetworkSession('/_create_tazs', {
+            tazList: this.props.tazList
+        }, this.props.network, this.props.session).then((rjson) => {
+            this.props.setTAZs(rjson);
+        }).catch((error) => {
+            console.log(error);
+            this.setState({
+                failed: true
+            })
+        });
     }
     
     render() {
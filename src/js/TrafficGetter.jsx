@@ -1,6 +1,8 @@
 import React from "react";
 import moment from "moment-timezone";
 
+import { runJob, cancelJob } from './jobs';
+
 export default class TrafficGetter extends React.Component {
     constructor(props) {
         super(props);
@@ -11,12 +13,14 @@ export default class TrafficGetter extends React.Component {
             est_time: Math.round(2 * 0.4 * this.props.es / 60),
             est_cost: 2 * 0.01 * this.props.es,
             api_key: "",
-            timezone: "America/Los_Angeles"
+            timezone: "America/Los_Angeles",
+            job: null
         };
 
         this.onKeyChange = this.onKeyChange.bind(this);
         this.onTimezoneChange = this.onTimezoneChange.bind(this);
         this.sendAPIrequests = this.sendAPIrequests.bind(this);
+        this.cancelRequests = this.cancelRequests.bind(this);
     }
 
     onKeyChange(e) {
@@ -35,7 +39,8 @@ export default class TrafficGetter extends React.Component {
         e.preventDefault();
 
         this.setState({
-            retrieving: true
+            retrieving: true,
+            requests_failed: false
         })
 
         const request_day = moment.tz(moment(), this.state.timezone).startOf('day');
@@ -47,39 +52,32 @@ export default class TrafficGetter extends React.Component {
             request_day.add(1, 'weeks').isoWeekday(wed);
         }
 
-        const rsp = fetch('/_get_traffic', {
-            method: "POST", // *GET, POST, PUT, DELETE, etc.
-            // mode: "cors", // no-cors, cors, *same-origin
-            // cache: "no-cache", // *default, no-cache, reload, force-cache, only-if-cached
-            credentials: "same-origin", // include, same-origin, *omit
-            headers: {
-                "Accept": "application/json; charset=utf-8",
-                "Content-Type": "application/json; charset=utf-8",
-            },
-            // redirect: "follow", // manual, *follow, error
-            // referrer: "no-referrer", // no-referrer, *client
-            body: JSON.stringify({
-                api_key: this.state.api_key,
-                ff: request_day.clone().add(2, 'hours').unix(),
-                am: request_day.clone().add(8, 'hours').unix(),
-                nw: this.props.network
-            }), // body data type must match "Content-Type" header
-        }).then((response) => {
-            if (!response.ok) {
-                throw Error(response.statusText);
-            }
-            return response.json();
+        const rsp = runJob('traffic', {
+            api_key: this.state.api_key,
+            ff: request_day.clone().add(2, 'hours').unix(),
+            am: request_day.clone().add(8, 'hours').unix()
+        }, this.props.network, this.props.session, (job) => {
+            this.setState({job: job});
         }).then((nw) => {
             this.props.handleAPIrequests(nw);
         }).catch((error) => {
             console.log(error);
             this.setState({
                 retrieving: false,
-                requests_failed: true
+                requests_failed: (error.message !== 'cancelled'),
+                job: null
             })
         });
     }
 
+    cancelRequests(e) {
+        e.preventDefault();
+
+        if (this.state.job) {
+            cancelJob(this.state.job.job_id).catch((error) => console.log(error));
+        }
+    }
+
     render() {
 
         return (
@@ -128,6 +126,10 @@ export default class TrafficGetter extends React.Component {
                             <div class="ui success message">
                                 <i class="thumbs up icon"></i>
                                 Retrieving traffic information. This will take approximately <code>{Math.round(this.state.est_time)}</code> minutes. Do not navigate away from this page.
+                                {(this.state.job && this.state.job.progress.total) ? (
+                                    <p><code>{this.state.job.progress.done}</code> of <code>{this.state.job.progress.total}</code> requests done.</p>
+                                ) : (null)}
+                                <button class="ui button" onClick={this.cancelRequests} disabled={!this.state.job}>Cancel</button>
                             </div>
                         ) : (
                             <form onSubmit={this.sendAPIrequests} class="ui form">
@@ -1,58 +1,73 @@
 import React from "react";
 
 import TripTableDisplay from './TripTableDisplay';
+import { runJob, cancelJob } from './jobs';
 
 export default class TripAssigner extends React.Component {
     constructor(props) {
         super(props);
         this.state = {
             failed: false,
+            tripTableExpired: false,
             ready: false,
             assigning: false,
-            tripTable: null
+            tripTable: null,
+            job: null,
+            gap: "",
+            timeBudget: ""
         };
         
         this.doTripAssignment = this.doTripAssignment.bind(this);
+        this.cancelTripAssignment = this.cancelTripAssignment.bind(this);
+        this.changeGap = this.changeGap.bind(this);
+        this.changeTimeBudget = this.changeTimeBudget.bind(this);
+    }
+
+    // optional convergence controls, left blank for the server's defaults
+    changeGap(e) {
+        this.setState({gap: e.target.value});
+    }
+
+    changeTimeBudget(e) {
+        this.setState({timeBudget: e.target.value});
     }
 
     doTripAssignment(e) {
         e.preventDefault();         
         
         this.setState({
-            assigning: true
+            assigning: true,
+            failed: false,
+            tripTableExpired: false
         });
 
-        fetch('/_do_assignment', {
-            method: "POST", // *GET, POST, PUT, DELETE, etc.
-            // mode: "cors", // no-cors, cors, *same-origin
-            // cache: "no-cache", // *default, no-cache, reload, force-cache, only-if-cached
-            credentials: "same-origin", // include, same-origin, *omit
-            headers: {
-                "Accept": "application/json; charset=utf-8",
-                "Content-Type": "application/json; charset=utf-8",
-            },
-            // redirect: "follow", // manual, *follow, error
-            // referrer: "no-referrer", // no-referrer, *client
-            body: JSON.stringify({
-                nw: this.props.network,
-                ntazs: this.props.ntazs,
-                tt: this.props.tripTable,
-                tot: this.props.totalTrips
-            }), // body data type must match "Content-Type" header
-        }).then((response) => {
-                if (!response.ok) {
-                    throw Error(response.statusText);
-                }
-                return response.json();
-            }).then((rjson) => {
-                this.props.handleTripAssignment(rjson);
-            }).catch((error) => {
-                console.log(error);
-                this.setState({
-                    assigning: false,
-                    failed: true
-                })
-            });
+        runJob('assignment', {
+            ntazs: this.props.ntazs,
+            tt_id: this.props.tripTable.table_id,
+            tot: this.props.totalTrips,
+            gap: (this.state.gap !== "") ? (Number(this.state.gap)) : (null),
+            time_budget: (this.state.timeBudget !== "") ? (Number(this.state.timeBudget)) : (null)
+        }, this.props.network, this.props.session, (job) => {
+            this.setState({job: job});
+        }).then((rjson) => {
+            this.props.handleTripAssignment(rjson);
+        }).catch((error) => {
+            console.log(error);
+            this.setState({
+                assigning: false,
+                failed: (error.message !== 'cancelled'),
+                tripTableExpired: (error.expired === 'trip_table'),
+                job: null
+            })
+        });
+    }
+
+    cancelTripAssignment(e) {
+        e.preventDefault();
+
+        if (this.state.job) {
+            cancelJob(this.state.job.job_id).catch((error) => console.log(error));
+        }
     }
 
     render() {
@@ -94,16 +109,47 @@ export default class TripAssigner extends React.Component {
                     {(this.state.assigning) ? (
                         <div class="ui warning message">
                             Please wait, traffic assignment is running, this may take several minutes. Do not navigate away from this page.
+                            {(this.state.job && this.state.job.progress.iteration) ? (
+                                <p>Iteration <code>{this.state.job.progress.iteration}</code>, relative gap <code>{this.state.job.progress.gap.toExponential(2)}</code>.</p>
+                            ) : (null)}
+                            <button class="ui button" onClick={this.cancelTripAssignment} disabled={!this.state.job}>Cancel</button>
                         </div>
                     ) : (
                         <div>
+                            <div class="ui form">
+                                <div class="two fields">
+                                    <div class="field">
+                                        <label>Target relative gap (optional)</label>
+                                        <input onChange={this.changeGap}
+                                            type="number"
+                                            min="0"
+                                            step="any"
+                                            placeholder="1e-4"
+                                            value={this.state.gap}
+                                        />
+                                    </div>
+                                    <div class="field">
+                                        <label>Time limit in seconds (optional)</label>
+                                        <input onChange={this.changeTimeBudget}
+                                            type="number"
+                                            min="0"
+                                            step="any"
+                                            value={this.state.timeBudget}
+                                        />
+                                    </div>
+                                </div>
+                            </div>
                             <p>Is this trip table correct?</p>
                             <button class="ui primary button" onClick={this.doTripAssignment}>Yes, run trip assignment</button>
                             <button class="ui button" onClick={this.props.scrapTripTable}>No, let me upload a new trip table</button>
                             {(this.state.failed) ? (
                                 <div className="ui red message">
                                     <i className="warning icon"></i>
-                                    Trip assignment failed. Try again or consider uploading a new trip table.
+                                    {(this.state.tripTableExpired) ? (
+                                        "The server no longer has this trip table. Please upload it again."
+                                    ) : (
+                                        "Trip assignment failed. Try again or consider uploading a new trip table."
+                                    )}
                                 </div>
                             ) : (null)}
                         </div>
@@ -5,26 +5,35 @@ export default class TripTableReader extends React.Component {
         super(props);
     }
 
+    // tripTable: the summary /_upload_trip_table returns, with the top left corner of the table as preview
     render() {
+        const preview = this.props.tripTable.preview;
         return (
-            <table class="ui very basic collapsing celled table">
-                <thead>
-                    <tr>
-                        <th />
-                        {this.props.tripTable.map((e, i) => {return <th key={i}>{i+1}</th>})}
-                    </tr>
-                </thead>
-                <tbody>
-                    {this.props.tripTable.map((row, i) => {
-                        return (
-                            <tr key={i}>
-                                <td><b>{i+1}</b></td>
-                                {row.map((e, j) => {return <td key={String(i)+","+String(j)+":"+String(e)}>{e}</td>})}
-                            </tr>
-                        )
-                    })}
-                </tbody>
-            </table>
+            <div>
+                <p>
+                    <code>{this.props.tripTable.ntazs}</code> zones, <code>{this.props.tripTable.total_trips}</code> trips
+                    between <code>{this.props.tripTable.nonzero}</code> origin-destination pairs
+                    {(preview.length < this.props.tripTable.ntazs) ? (", first " + preview.length + " zones shown") : ""}.
+                </p>
+                <table class="ui very basic collapsing celled table">
+                    <thead>
+                        <tr>
+                            <th />
+                            {preview.map((e, i) => {return <th key={i}>{i+1}</th>})}
+                        </tr>
+                    </thead>
+                    <tbody>
+                        {preview.map((row, i) => {
+                            return (
+                                <tr key={i}>
+                                    <td><b>{i+1}</b></td>
+                                    {row.map((e, j) => {return <td key={String(i)+","+String(j)+":"+String(e)}>{e}</td>})}
+                                </tr>
+                            )
+                        })}
+                    </tbody>
+                </table>
+            </div>
         )
     }
 }
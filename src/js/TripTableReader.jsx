@@ -18,6 +18,7 @@ export default class TripTableReader extends React.Component {
         
         const fl = new FormData();
         fl.append('file', this.file.files[0]);
+        fl.append('ntazs', this.props.ntazs); // for long form tables whose last zones have no trips
         
         const rsp = fetch('/_upload_trip_table', {
             method: "POST", // *GET, POST, PUT, DELETE, etc.
@@ -92,6 +93,8 @@ export default class TripTableReader extends React.Component {
                         <li>Trip table must be square (same number of rows and columns).</li>
                         <li>Row numbers represent origin zone, column numbers represent destination zone.</li>
                         <li>Do not include any row or column numbers. The table should only contain volumes.</li>
+                        <li>Or list trips in long form, with a header row: <code>origin,destination,trips</code>, zones numbered from 1.</li>
+                        <li>NumPy <code>.npy</code> / <code>.npz</code> files of the square table are accepted too.</li>
                     </ul>
                     <form class="ui form">
                         {(this.props.state === 6) ? (
@@ -111,7 +114,7 @@ export default class TripTableReader extends React.Component {
                          ) : null}
                         <label htmlFor="browseTripsTable" class="ui left labeled button">
                             <a class="ui basic right pointing label">
-                                .csv file
+                                .csv, .npy or .npz file
                             </a>
                             <div class="ui button">
                                 <i class="upload icon"></i>
@@ -123,7 +126,7 @@ export default class TripTableReader extends React.Component {
                             id="browseTripsTable"
                             name="file" 
                             style={{display: "none"}} 
-                            accept=".csv" 
+                            accept=".csv,.npy,.npz" 
                             ref={(ref)=>{ this.file=ref; }} 
                             onChange={this.uploadTripTable}
                         />
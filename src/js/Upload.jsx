@@ -1,5 +1,7 @@
 import React from "react";
 
+import { NETWORK_MIME, readNetworkResponse } from './networkCodec';
+
 export default class Upload extends React.Component {
     constructor(props) {
         super(props);
@@ -30,28 +32,23 @@ export default class Upload extends React.Component {
             // mode: "cors", // no-cors, cors, *same-origin
             // cache: "no-cache", // *default, no-cache, reload, force-cache, only-if-cached
             credentials: "same-origin", // include, same-origin, *omit
-            // headers: {
-            //     "Content-Type": "application/json; charset=utf-8",
-            //     // "Content-Type": "application/x-www-form-urlencoded",
-            // },
+            headers: {
+                // the network comes back in the compact binary format if the server has it, else as geojson
+                "Accept": NETWORK_MIME + ", application/json; q=0.5",
+            },
             // redirect: "follow", // manual, *follow, error
             // referrer: "no-referrer", // no-referrer, *client
             body: fl, // body data type must match "Content-Type" header
             // body: this.osmFile
-        }).then((response) => {
-                if (!response.ok) {
-                    throw Error(response.statusText);
-                }
-                return response.json();
-            }).then((rjson) => {
-                this.props.handleOSMupload(rjson);
-            }).catch((error) => {
-                console.log(error);
-                this.setState({
-                    osm_uploading: false,
-                    osm_upload_failed: true
-                })
-            });
+        }).then(readNetworkResponse).then((rjson) => {
+            this.props.handleOSMupload(rjson);
+        }).catch((error) => {
+            console.log(error);
+            this.setState({
+                osm_uploading: false,
+                osm_upload_failed: true
+            })
+        });
     }
 
     handleJSONupclick(e){
@@ -126,7 +123,7 @@ export default class Upload extends React.Component {
                                     <form>
                                         <label htmlFor="browseOSMFile" class="ui left labeled button">
                                             <a class="ui basic right pointing label">
-                                                .osm file
+                                                .osm or .osm.pbf file
                                             </a>
                                             <div class="ui button">
                                                 <i class="upload icon"></i>
@@ -0,0 +1,44 @@
+// long-running steps run as server-side jobs (see src/py/jobs.py): submit, poll the status for progress, then
+// fetch the result like the synchronous endpoints would have returned it.
+
+import { NETWORK_MIME, sendNetwork, networkResult, readNetworkResponse } from './networkCodec';
+
+function getJSON(url, options) {
+    return fetch(url, Object.assign({credentials: "same-origin"}, options)).then((response) => {
+        if (!response.ok) {
+            throw Error(response.statusText);
+        }
+        return response.json();
+    });
+}
+
+// kind: 'traffic' or 'assignment'. onProgress(status) is called with each status polled, which has the job_id
+// (for cancelJob) and progress: {done, total} requests for traffic, {iteration, gap, objective} for assignments
+export function runJob(kind, payload, network, session, onProgress, interval = 1000) {
+    return sendNetwork('/_jobs/' + kind, payload, network, session).then((submitted) => new Promise((resolve, reject) => {
+        const poll = () => {
+            getJSON('/_jobs/' + submitted.job_id).then((status) => {
+                if (onProgress) {
+                    onProgress(status);
+                }
+                if (status.status === 'done') {
+                    resolve(status.job_id);
+                } else if ((status.status === 'failed') || (status.status === 'cancelled')) {
+                    reject(Error(status.error || status.status));
+                } else {
+                    setTimeout(poll, interval);
+                }
+            }).catch(reject);
+        };
+        poll();
+    })).then((job_id) => fetch('/_jobs/' + job_id + '/result', {
+        credentials: "same-origin",
+        headers: {
+            "Accept": NETWORK_MIME + ", application/json; q=0.5",
+        },
+    })).then(readNetworkResponse).then((rjson) => networkResult(network, rjson));
+}
+
+export function cancelJob(job_id) {
+    return getJSON('/_jobs/' + job_id + '/cancel', {method: "POST"});
+}
@@ -0,0 +1,346 @@
+// compact binary network messages, the javascript end of src/py/nx_columnar.py (see there for the layout).
+// networks stay GeoJSON FeatureCollections inside the app; this only changes what goes over the wire.
+
+export const NETWORK_MIME = 'application/vnd.trayson.network';
+const MAGIC = 'TRNW';
+const VERSION = 1;
+
+const ARRAYS = {f8: Float64Array, u4: Uint32Array, u1: Uint8Array, i4: Int32Array};
+
+function decodeColumns(section, buffers, count) {
+    const records = [];
+    for (let i = 0; i < count; i++) {
+        records.push({});
+    }
+    for (const column of section.columns) {
+        const data = buffers[column.data];
+        const mask = column.mask === null ? null : buffers[column.mask];
+        for (let i = 0; i < count; i++) {
+            if (mask !== null && !mask[i]) {
+                continue;
+            }
+            if (column.kind === 'bool') {
+                records[i][column.name] = data[i] !== 0;
+            } else if (column.kind === 'f8') {
+                records[i][column.name] = data[i];
+            } else {
+                records[i][column.name] = column.table[data[i]];
+            }
+        }
+    }
+    return records;
+}
+
+// ArrayBuffer -> the payload object, with the network rebuilt as GeoJSON where it was sent from
+export function decodeNetwork(buffer) {
+    const view = new DataView(buffer);
+    const magic = String.fromCharCode(...new Uint8Array(buffer, 0, 4));
+    if (magic !== MAGIC) {
+        throw Error('not a columnar network message');
+    }
+    if (view.getUint32(4, true) !== VERSION) {
+        throw Error('unsupported columnar network version');
+    }
+    const headSize = view.getUint32(8, true);
+    const header = JSON.parse(new TextDecoder('utf-8').decode(new Uint8Array(buffer, 12, headSize)));
+    const body = 12 + headSize;
+    const buffers = header.buffers.map(b => new ARRAYS[b.dtype](buffer, body + b.offset, b.length));
+
+    // same layout as nx_to_geojson: edges first, then nodes
+    const ids = buffers[header.nodes.ids];
+    const nodes = decodeColumns(header.nodes, buffers, header.nodes.count);
+    const tail = buffers[header.edges.tail];
+    const head = buffers[header.edges.head];
+    const edges = decodeColumns(header.edges, buffers, header.edges.count);
+    const features = [];
+    for (let i = 0; i < edges.length; i++) {
+        const n1 = nodes[tail[i]];
+        const n2 = nodes[head[i]];
+        features.push({
+            type: "Feature",
+            geometry: {
+                type: "LineString",
+                coordinates: [[n1.lon, n1.lat], [n2.lon, n2.lat]]
+            },
+            properties: edges[i],
+            id: ids[tail[i]] + "," + ids[head[i]]
+        });
+    }
+    for (let i = 0; i < nodes.length; i++) {
+        features.push({
+            type: "Feature",
+            geometry: {
+                type: "Point",
+                coordinates: [nodes[i].lon, nodes[i].lat]
+            },
+            properties: {taz: nodes[i].taz},
+            id: ids[i]
+        });
+    }
+    const network = {type: "FeatureCollection", features: features};
+
+    const payload = header.payload;
+    if (header.path.length === 0) {
+        return Object.assign(network, payload);
+    }
+    let parent = payload;
+    for (const key of header.path.slice(0, -1)) {
+        parent = parent[key] = parent[key] || {};
+    }
+    parent[header.path[header.path.length - 1]] = network;
+    return payload;
+}
+
+function encodeColumns(records, buffers) {
+    const keys = [];
+    const seen = new Set();
+    for (const r of records) {
+        for (const k of Object.keys(r)) {
+            if (!seen.has(k)) {
+                seen.add(k);
+                keys.push(k);
+            }
+        }
+    }
+
+    const columns = [];
+    for (const k of keys) {
+        const present = records.map(r => r[k] !== undefined);
+        const values = records.filter(r => r[k] !== undefined).map(r => r[k]);
+        const column = {name: k};
+        let data;
+        if (values.every(v => typeof v === 'boolean')) {
+            column.kind = 'bool';
+            data = new Uint8Array(records.length);
+            records.forEach((r, i) => { data[i] = r[k] ? 1 : 0; });
+            column.data = addBuffer(buffers, 'u1', data);
+        } else if (values.every(v => typeof v === 'number')) {
+            column.kind = 'f8';
+            column.int = values.every(v => Number.isInteger(v));
+            data = new Float64Array(records.length).fill(NaN);
+            records.forEach((r, i) => { if (present[i]) data[i] = r[k]; });
+            column.data = addBuffer(buffers, 'f8', data);
+        } else {
+            column.kind = 'cat';
+            const table = new Map();
+            data = new Int32Array(records.length).fill(-1);
+            records.forEach((r, i) => {
+                if (present[i]) {
+                    const key = JSON.stringify(r[k]);
+                    if (!table.has(key)) {
+                        table.set(key, table.size);
+                    }
+                    data[i] = table.get(key);
+                }
+            });
+            column.table = Array.from(table.keys()).map(key => JSON.parse(key));
+            column.data = addBuffer(buffers, 'i4', data);
+        }
+        column.mask = present.every(p => p) ? null : addBuffer(buffers, 'u1', Uint8Array.from(present, p => p ? 1 : 0));
+        columns.push(column);
+    }
+    return columns;
+}
+
+function addBuffer(buffers, dtype, array) {
+    buffers.push({dtype: dtype, array: array});
+    return buffers.length - 1;
+}
+
+// GeoJSON network plus the rest of the payload -> ArrayBuffer. path: keys to where the network sits in the payload
+export function encodeNetwork(network, payload, path) {
+    const buffers = [];
+    const features = network.features || network;
+    const index = new Map();
+    const nodeIds = [];
+    const nodes = [];
+    for (const ft of features) {
+        if (ft.geometry.type === 'Point') {
+            index.set(Number(ft.id), nodeIds.length);
+            nodeIds.push(Number(ft.id));
+            nodes.push({lon: ft.geometry.coordinates[0], lat: ft.geometry.coordinates[1], taz: ft.properties.taz});
+        }
+    }
+    const tail = [];
+    const head = [];
+    const edges = [];
+    for (const ft of features) {
+        if (ft.geometry.type === 'LineString') {
+            const [n1, n2] = ft.id.split(',').map(Number);
+            tail.push(index.get(n1));
+            head.push(index.get(n2));
+            edges.push(ft.properties);
+        }
+    }
+
+    const header = {
+        version: VERSION,
+        payload: payload || {},
+        path: path || [],
+        nodes: {
+            count: nodes.length,
+            ids: addBuffer(buffers, 'f8', Float64Array.from(nodeIds)),
+            columns: encodeColumns(nodes, buffers)
+        },
+        edges: {
+            count: edges.length,
+            tail: addBuffer(buffers, 'u4', Uint32Array.from(tail)),
+            head: addBuffer(buffers, 'u4', Uint32Array.from(head)),
+            columns: encodeColumns(edges, buffers)
+        },
+        buffers: []
+    };
+
+    // 8-byte aligned buffers after the header
+    let offset = 0;
+    for (const b of buffers) {
+        header.buffers.push({dtype: b.dtype, offset: offset, length: b.array.length});
+        offset += Math.ceil(b.array.byteLength / 8) * 8;
+    }
+    let head_bytes = new TextEncoder().encode(JSON.stringify(header));
+    const padded = new Uint8Array(Math.ceil((12 + head_bytes.length) / 8) * 8 - 12).fill(32); // spaces
+    padded.set(head_bytes);
+
+    const out = new ArrayBuffer(12 + padded.length + offset);
+    const bytes = new Uint8Array(out);
+    bytes.set(Array.from(MAGIC, c => c.charCodeAt(0)), 0);
+    const view = new DataView(out);
+    view.setUint32(4, VERSION, true);
+    view.setUint32(8, padded.length, true);
+    bytes.set(padded, 12);
+    for (let i = 0; i < buffers.length; i++) {
+        bytes.set(new Uint8Array(buffers[i].array.buffer, buffers[i].array.byteOffset, buffers[i].array.byteLength),
+                  12 + padded.length + header.buffers[i].offset);
+    }
+    return out;
+}
+
+// parse a response in whichever format the server chose. a 410 means something the request named by id is gone
+// from the server: the error thrown has what in `expired`, 'network' or 'trip_table'
+export function readNetworkResponse(response) {
+    if (response.status === 410) {
+        return response.json().then((rjson) => {
+            const error = Error(rjson.expired + ' expired');
+            error.expired = rjson.expired;
+            throw error;
+        });
+    }
+    if (!response.ok) {
+        throw Error(response.statusText);
+    }
+    if ((response.headers.get('Content-Type') || '').startsWith(NETWORK_MIME)) {
+        return response.arrayBuffer().then(decodeNetwork);
+    }
+    return response.json();
+}
+
+// POST a payload whose `key` member is a GeoJSON network, sending and asking for the binary format
+export function postNetwork(url, payload, key = 'nw') {
+    const rest = Object.assign({}, payload);
+    delete rest[key];
+    return fetch(url, {
+        method: "POST",
+        credentials: "same-origin",
+        headers: {
+            "Accept": NETWORK_MIME + ", application/json; q=0.5",
+            "Content-Type": NETWORK_MIME,
+        },
+        body: encodeNetwork(payload[key], rest, [key]),
+    }).then(readNetworkResponse);
+}
+
+// apply the changes a server-side network store sends back (see network_delta in src/py/network_store.py)
+// to a GeoJSON network, returning a new one. unchanged features are reused as they are
+export function applyNetworkDelta(network, delta) {
+    const removed = new Set(delta.removed_edges.concat(delta.removed_nodes.map(String)));
+    const edges = [];
+    const nodes = [];
+    const positions = {};
+    const seen = new Set();
+    for (const ft of network.features) {
+        const id = String(ft.id);
+        if (removed.has(id)) {
+            continue;
+        }
+        seen.add(id);
+        if (ft.geometry.type === 'LineString') {
+            const changed = delta.edges[id];
+            edges.push(changed ? Object.assign({}, ft, {properties: Object.assign({}, ft.properties, changed)}) : ft);
+        } else {
+            const changed = delta.nodes[id];
+            const node = changed ? Object.assign({}, ft, {
+                geometry: {
+                    type: "Point",
+                    coordinates: [
+                        (changed.lon !== undefined) ? changed.lon : ft.geometry.coordinates[0],
+                        (changed.lat !== undefined) ? changed.lat : ft.geometry.coordinates[1]
+                    ]
+                },
+                properties: {taz: (changed.taz !== undefined) ? changed.taz : ft.properties.taz}
+            }) : ft;
+            positions[id] = node.geometry.coordinates;
+            nodes.push(node);
+        }
+    }
+    for (const id of Object.keys(delta.nodes)) {
+        if (!seen.has(id)) {
+            const n = delta.nodes[id];
+            positions[id] = [n.lon, n.lat];
+            nodes.push({
+                type: "Feature",
+                geometry: {type: "Point", coordinates: positions[id]},
+                properties: {taz: n.taz},
+                id: Number(id)
+            });
+        }
+    }
+    for (const id of Object.keys(delta.edges)) {
+        if (!seen.has(id)) {
+            const [n1, n2] = id.split(',');
+            edges.push({
+                type: "Feature",
+                geometry: {type: "LineString", coordinates: [positions[n1], positions[n2]]},
+                properties: delta.edges[id],
+                id: id
+            });
+        }
+    }
+    return {type: "FeatureCollection", features: edges.concat(nodes)};
+}
+
+// POST to an endpoint that works on a network kept server-side (see src/py/network_store.py): name it by id with
+// the edits made since. sends the whole network instead when there's no id (e.g. after loading an export) or the
+// server no longer has it. resolves to the response as it is; an expired trip table rejects (see readNetworkResponse)
+export function sendNetwork(url, payload, network, session) {
+    const request = session.nw_id ? fetch(url, {
+        method: "POST",
+        credentials: "same-origin",
+        headers: {
+            "Accept": "application/json; charset=utf-8",
+            "Content-Type": "application/json; charset=utf-8",
+        },
+        body: JSON.stringify(Object.assign({nw_id: session.nw_id, edits: session.edits}, payload)),
+    }).then(readNetworkResponse).catch((error) => {
+        if (error.expired === 'network') {
+            return null;
+        }
+        throw error;
+    }) : Promise.resolve(null);
+
+    return request.then((rjson) => (rjson === null) ? postNetwork(url, Object.assign({nw: network}, payload)) : rjson);
+}
+
+// the new network from a response: the changes applied to the network sent, or the full network that came back.
+// the rest of the response (nw_id, stats) is merged in, like the full responses have it
+export function networkResult(network, rjson) {
+    if (rjson.delta === undefined) {
+        return rjson;
+    }
+    const delta = rjson.delta;
+    delete rjson.delta;
+    return Object.assign(applyNetworkDelta(network, delta), rjson);
+}
+
+export function postNetworkSession(url, payload, network, session) {
+    return sendNetwork(url, payload, network, session).then((rjson) => networkResult(network, rjson));
+}
@@ -1,33 +1,231 @@
 import gzip
 import json
+import os
+import random
 import requests
+import threading
 import urllib.parse as urlparse
 import networkx as nx
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
 from datetime import datetime
-from time import time
+from itertools import islice
+from requests.adapters import HTTPAdapter
+from time import time, sleep
 
-def make_requests(api_key, ff_time, am_time, g):
+from src.py.travel_time_cache import departure_slot, point_key
 
-    # test api key
-    test = requests.get(
-        'https://maps.googleapis.com/maps/api/directions/json?origin=arup+oakland&destination=arup+sf&departure_time=now&key={}'.format(api_key)
-    ).json()
-    if test['status'] != 'OK':
-        raise Exception(test['error_message'])
-    elif 'duration_in_traffic' not in test['routes'][0]['legs'][0]:
+# override to point at local stub servers when benchmarking
+DIRECTIONS_URL = os.environ.get('DIRECTIONS_URL', 'https://maps.googleapis.com/maps/api/directions/json')
+DISTANCE_MATRIX_URL = os.environ.get('DISTANCE_MATRIX_URL', 'https://maps.googleapis.com/maps/api/distancematrix/json')
+
+# statuses and http codes worth retrying; anything else is a permanent error for that request
+RETRY_STATUSES = {'OVER_QUERY_LIMIT', 'UNKNOWN_ERROR'}
+RETRY_HTTP_CODES = {429, 500, 502, 503, 504}
+
+class TokenBucket(object):
+    # shared between the worker threads: allows `rate` requests per second on average, in bursts of up to `burst`
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst if burst is not None else max(1, rate)
+        self.tokens = self.burst
+        self.last = time()
+        self.lock = threading.Lock()
+
+    def take(self):
+        while True:
+            with self.lock:
+                now = time()
+                self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+                self.last = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            sleep(wait)
+
+def make_session(pool_size):
+    # one keep-alive connection per worker thread
+    session = requests.session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+def unknown_error(e):
+    # the error logged for an exception while fetching or reading a response
+    return {"type" : "unknown", "code" : str(type(e)) + ': ' + str(e)}
+
+def fetch_directions(session, bucket, url, params, max_retries=5, backoff=1.0, timeout=30):
+    # returns (response, None) or (None, error) for a directions or distance matrix request. retries rate limiting and transient failures with
+    # exponential backoff (jittered so the workers don't retry in lockstep).
+    for attempt in range(max_retries + 1):
+        bucket.take()
+        try:
+            response = session.get(url, params=params, timeout=timeout)
+            if response.status_code in RETRY_HTTP_CODES:
+                error = {"type" : "HTTP", "code" : response.status_code}
+            else:
+                directions = response.json()
+                status = directions["status"]
+                if status == "OK":
+                    return directions, None
+                error = {"type" : "API", "code" : status}
+                if 'error_message' in directions:
+                    error['message'] = directions['error_message']
+                if status not in RETRY_STATUSES:
+                    return None, error
+        except (requests.ConnectionError, requests.Timeout) as e:
+            error = unknown_error(e)
+        except Exception as e:
+            return None, unknown_error(e)
+        if attempt < max_retries:
+            sleep(backoff * 2**attempt * (0.5 + random.random()))
+    return None, error
+
+def print_progress(done, total):
+    if (done == total) or (done % max(1, total // 20) == 0):
+        print('directions requests: {}/{} ({:.0%})'.format(done, total, done / total))
+
+def check_api_key(session, bucket, url, api_key, batch, max_retries):
+    if batch:
+        params = {'origins': 'arup oakland', 'destinations': 'arup sf', 'departure_time': 'now', 'key': api_key}
+    else:
+        params = {'origin': 'arup oakland', 'destination': 'arup sf', 'departure_time': 'now', 'key': api_key}
+    test, error = fetch_directions(session, bucket, url, params, max_retries)
+    if error is not None:
+        raise Exception(error.get('message', error['code']))
+    found = test['rows'][0]['elements'][0] if batch else test['routes'][0]['legs'][0]
+    if 'duration_in_traffic' not in found:
         raise Exception('Duration in traffic not returned. Suspect bad API key.')
 
+def matrix_calls(g, jobs, api_key, mode, model, max_side=25, max_elements=100):
+    # pack (edge, time) jobs into distance matrix requests. origins are added with all their out-edges while the
+    # origins, the union of destinations, and origins x destinations stay within the api's per-request limits.
+    # returns (params, [(job index, row, column)]) per request.
+    by_time = {}
+    for k, (n1, n2, ampmstr, params) in enumerate(jobs):
+        by_time.setdefault(params['departure_time'], {}).setdefault(n1, []).append(k)
+
+    calls = []
+    for departure_time, by_origin in by_time.items():
+        origins, destinations, members = [], {}, []
+
+        def flush():
+            if members:
+                params = {
+                    'origins': '|'.join(str(g.nodes[n]['lat']) + "," + str(g.nodes[n]['lon']) for n in origins),
+                    'destinations': '|'.join(str(g.nodes[n]['lat']) + "," + str(g.nodes[n]['lon']) for n in destinations),
+                    'key': api_key,
+                    'departure_time': departure_time,
+                    'mode': mode,
+                    'traffic_model': model
+                }
+                calls.append((params, [(k, origins.index(jobs[k][0]), destinations[jobs[k][1]]) for k in members]))
+            origins.clear()
+            destinations.clear()
+            members.clear()
+
+        for n1, ks in by_origin.items():
+            # an origin with more edges than fit in one request is split over several
+            for start in range(0, len(ks), min(max_side, max_elements)):
+                part = ks[start:start + min(max_side, max_elements)]
+                new = {jobs[k][1] for k in part if jobs[k][1] not in destinations}
+                side = max(len(origins) + 1, len(destinations) + len(new))
+                if side > max_side or (len(origins) + 1) * (len(destinations) + len(new)) > max_elements:
+                    flush()
+                    new = {jobs[k][1] for k in part}
+                origins.append(n1)
+                for n2 in sorted(new):
+                    destinations[n2] = len(destinations)
+                members.extend(part)
+                if start + min(max_side, max_elements) < len(ks):
+                    flush()
+        flush()
+    return calls
+
+def directions_duration(directions):
+    duration = 0
+    for leg in directions['routes'][0]['legs']:
+        duration += leg['duration_in_traffic']['value']
+    return duration/60**2, None # convert to hours
+
+def matrix_duration(matrix, row, column):
+    element = matrix['rows'][row]['elements'][column]
+    if element['status'] != 'OK':
+        return None, {"type" : "API", "code" : element['status']}
+    if 'duration_in_traffic' not in element:
+        # not the free flow duration instead: that would pass for a traffic time
+        return None, {"type" : "API", "code" : "NO_DURATION_IN_TRAFFIC"}
+    return element['duration_in_traffic']['value']/60**2, None
+
+class JsonlLog(object):
+    # appends json records, one per line, to gzip files of at most per_file records each: <prefix>_1.jsonl.gz,
+    # <prefix>_2.jsonl.gz, ... files are flushed every flush_every records, so a run that dies still leaves
+    # readable logs of what it fetched.
+
+    def __init__(self, prefix, per_file=10000, flush_every=100):
+        self.prefix = prefix
+        self.per_file = per_file
+        self.flush_every = flush_every
+        self.file = None
+        self.files = 0
+        self.count = 0
+
+    def write(self, record):
+        if self.count % self.per_file == 0:
+            self.close()
+            self.files += 1
+            self.file = gzip.open('{}_{}.jsonl.gz'.format(self.prefix, self.files), 'wt', encoding="utf8")
+        self.file.write(json.dumps(record) + '\n')
+        self.count += 1
+        if self.count % self.flush_every == 0:
+            self.file.flush()
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+def used_fields(response):
+    # just the parts of a response the travel times come from, for much smaller logs
+    if 'rows' in response:
+        rows = [
+            {'elements': [{k: e[k] for k in ('status', 'duration', 'duration_in_traffic') if k in e} for e in row['elements']]}
+            for row in response['rows']
+        ]
+        return {'status': response['status'], 'rows': rows, 'request_data': response['request_data']}
+    legs = [{k: leg[k] for k in ('duration', 'duration_in_traffic') if k in leg} for leg in response['routes'][0]['legs']]
+    return {'status': response['status'], 'legs': legs, 'request_data': response['request_data']}
+
+def make_requests(api_key, ff_time, am_time, g, base_url=None, workers=16, qps=40, max_retries=5, progress=print_progress,
+                  cache=None, batch=False, log_full=True, edges=None, log_label=None):
+    # workers: concurrent requests in flight; qps: limit on requests per second across all of them
+    # progress(done, total) is called from this thread as requests complete. if it raises (e.g. a cancelled job),
+    # the requests in flight are finished and what was fetched so far is still logged and cached
+    # cache: optional TravelTimeCache. only edges/times it doesn't have are requested, and new results are added
+    # batch: query the distance matrix api, covering many edges that share origins/destinations per request,
+    # instead of one directions request per edge and time
+    # log_full: log whole responses (including route geometry), or only the fields the travel times are read from
+    # edges: only query these edges (see traffic_sampling), instead of all of them
+    # log_label: added to the log file names, to tell apart runs started in the same second
+    url_raw = base_url or (DISTANCE_MATRIX_URL if batch else DIRECTIONS_URL)
+    session = make_session(workers)
+    bucket = TokenBucket(qps)
+
     # start running the requests
-    results = []
-    error_log = []
+    time_label = (datetime.fromtimestamp(int(time())).strftime('%Y-%m-%d_%H-%M-%S'))
+    if log_label:
+        time_label += '_' + log_label
+    results = JsonlLog('logs/gmaps_results/api_responses_' + time_label)
+    error_log = JsonlLog('logs/gmaps_errors/error_log_' + time_label)
 
-    session = requests.session()
-    url_raw = 'https://maps.googleapis.com/maps/api/directions/json'
     mode = 'driving'
     model = 'best_guess'
 
-    # make requests
-    for i,(n1,n2) in enumerate(g.edges()):
+    # prepare all requests: two per edge, one per time of day
+    jobs = []
+    for n1,n2 in (g.edges() if edges is None else edges):
 
         origin = str(g.nodes[n1]['lat']) + "," + str(g.nodes[n1]['lon'])
         destination = str(g.nodes[n2]['lat']) + "," + str(g.nodes[n2]['lon'])
@@ -37,8 +235,7 @@ def make_requests(api_key, ff_time, am_time, g):
 
             # track time of day
             ampmstr = 'ff_' if j==0 else 'am_'
-            
-            # prepare request but don't send it
+
             params={
                 'origin': origin,
                 'destination': destination,
@@ -47,72 +244,112 @@ def make_requests(api_key, ff_time, am_time, g):
                 'mode': mode,
                 'model': model
             }
-            request = requests.Request('GET', url_raw, params=params).prepare()
+            jobs.append((n1, n2, ampmstr, params))
 
-            try:
-                # actually send request
-                response = session.send(request)
+    # answer what we can from the cache
+    requested = len(jobs)
+    if cache is not None:
+        keys = [
+            (point_key(g.nodes[n1]['lat'], g.nodes[n1]['lon']), point_key(g.nodes[n2]['lat'], g.nodes[n2]['lon']),
+                departure_slot(params['departure_time']), model)
+            for n1, n2, ampmstr, params in jobs
+        ]
+        cached = cache.get_many(keys)
+        for (n1, n2, ampmstr, params), key in zip(jobs, keys):
+            if key in cached:
+                g[n1][n2][ampmstr+model] = cached[key]
+        misses = [k for k, key in enumerate(keys) if key not in cached]
+        jobs = [jobs[k] for k in misses]
+        keys = [keys[k] for k in misses]
+        print('travel time cache: {} of {} requests cached ({:.0%})'.format(
+            len(cached), requested, len(cached) / max(1, requested)))
 
-                # Get the response
-                directions = response.json()
+    # group jobs into calls: (params, [(job index, row, column)])
+    if batch:
+        calls = matrix_calls(g, jobs, api_key, mode, model)
+    else:
+        calls = [(params, [(k, None, None)]) for k, (n1, n2, ampmstr, params) in enumerate(jobs)]
+    g.graph['traffic'] = {'requests': requested, 'cached': requested - len(jobs), 'calls': len(calls)}
+    if batch:
+        # distance matrix requests are billed per origin x destination element, which can be more than one per edge
+        g.graph['traffic']['elements'] = sum(
+            len(params['origins'].split('|')) * len(params['destinations'].split('|')) for params, _ in calls)
 
-                status = directions["status"]
-                if status != "OK":
-                    data = {
-                        "error" : {
-                            "type" : "API",
-                            "code" : status
-                            },
-                        "request" : params
-                    }
-                    print("API response error: ", status)
-                    error_log.append(data)
-                    continue
-
-                # log request
-                directions['request_data'] = params
-
-                # save results
-                results.append(directions)
-
-                # collect travel time
-                duration = 0
-                for leg in directions['routes'][0]['legs']:
-                    duration += leg['duration_in_traffic']['value']
-                duration = duration/60**2 # convert to hours
-                g[n1][n2][ampmstr+model] = duration
-
-            except Exception as e:
-                error_code = str(type(e)) + ': ' + str(e)
-                data = {
-                    "error" : {
-                        "type" : "unknown",
-                        "code" : error_code
-                    },
-                    "request" : request
-                }
-                error_log.append(data)
-                g[n1][n2][ampmstr+model] = 0
-
-    # # calculate timing
-    # end = time.time()
-    # elapsed_time = end - start
-    # time_per_request = elapsed_time / len(api_schedules)
-    # print(time_per_request, " time per request")
-
-    # determine filesize
-    chunkSize = 500
-    # print("Dumping requests locally")
-    time_label = (datetime.fromtimestamp(int(time())).strftime('%Y-%m-%d_%H-%M'))
-    for i in range(0, len(results), chunkSize):
-        with gzip.open('logs/gmaps_results/api_responses_' + time_label + "_" + str((i//chunkSize)+1) + '.json.gz', 'wt', encoding="utf8") as outfile:
-            json.dump(results[i:i+chunkSize], outfile, indent =2)
-
-    with gzip.open("logs/gmaps_errors/error_log_" + time_label + ".json.gz", 'wt', encoding="utf8") as outfile:
-        json.dump(error_log,outfile,indent=2)
-
-    # value = datetime.fromtimestamp(int(time.time()))
-    # time_label = (value.strftime('%Y-%m-%d_%H-%M'))
-    # print("API call completed: ", time_label)
+    if calls:
+        check_api_key(session, bucket, url_raw, api_key, batch, max_retries)
+
+    # make requests, handling each response as it arrives: graph updates stay on this thread, and responses are
+    # logged and cached straight away rather than held until the end. only a window of calls is in flight at once.
+    succeeded = 0
+    fresh = []
+    try:
+        with ThreadPoolExecutor(workers) as pool:
+            pending = iter(enumerate(calls))
+            in_flight = {}
+            def submit(n):
+                for c, (params, targets) in islice(pending, n):
+                    in_flight[pool.submit(fetch_directions, session, bucket, url_raw, params, max_retries)] = c
+
+            submit(4 * workers)
+            done = 0
+            # what progress raised: no more calls are started, and the ones in flight are handled before it's raised
+            stopped = None
+            while in_flight:
+                finished, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    params, targets = calls[in_flight.pop(future)]
+                    response, error = future.result()
+                    if response is not None:
+                        # log request, in full if the fields can't be picked out of it
+                        response['request_data'] = params
+                        logged = response
+                        if not log_full:
+                            try:
+                                logged = used_fields(response)
+                            except Exception as e:
+                                error = unknown_error(e)
+                        results.write(logged)
+
+                    for k, row, column in targets:
+                        n1, n2, ampmstr, job_params = jobs[k]
+                        if error is None:
+                            # collect travel time; a response missing what it should have fails just this edge
+                            try:
+                                duration, job_error = matrix_duration(response, row, column) if batch else directions_duration(response)
+                            except Exception as e:
+                                job_error = unknown_error(e)
+                        else:
+                            job_error = error
+                        if job_error is not None:
+                            if job_error['type'] == 'API':
+                                print("API response error: ", job_error['code'])
+                            error_log.write({"error" : job_error, "request" : job_params})
+                            g[n1][n2][ampmstr+model] = 0
+                            continue
+                        g[n1][n2][ampmstr+model] = duration
+                        succeeded += 1
+                        if cache is not None:
+                            fresh.append((keys[k], duration))
+
+                    done += 1
+                    if (progress is not None) and (stopped is None):
+                        try:
+                            progress(done, len(calls))
+                        except BaseException as e:
+                            stopped = e
+                if len(fresh) >= 1000:
+                    cache.put_many(fresh)
+                    fresh = []
+                if stopped is None:
+                    submit(len(finished))
+            if stopped is not None:
+                raise stopped
+    finally:
+        if fresh:
+            cache.put_many(fresh)
+        results.close()
+        error_log.close()
+
+    g.graph['traffic']['failed'] = len(jobs) - succeeded
 
     return g
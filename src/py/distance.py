@@ -0,0 +1,70 @@
+# edge lengths over whole coordinate arrays at once instead of one geopy call per edge.
+# geodesic_miles is Vincenty's inverse formula on the WGS-84 ellipsoid, checked against geopy's geodesic (Karney's
+# algorithm), which it agrees with to well under a millimetre; the few nearly antipodal pairs it can't converge on
+# fall back to geopy.
+# haversine_miles is the spherical approximation, about 0.5% off but several times cheaper.
+
+import numpy as np
+from geopy.distance import geodesic
+
+# WGS-84
+A = 6378137.0
+F = 1 / 298.257223563
+B = A * (1 - F)
+METRES_PER_MILE = 1609.344
+EARTH_RADIUS = 6371008.8 # mean radius, metres
+
+def haversine_miles(lat1, lon1, lat2, lon2):
+    lat1, lon1, lat2, lon2 = (np.radians(np.asarray(x, dtype=float)) for x in (lat1, lon1, lat2, lon2))
+    h = np.sin((lat2 - lat1) / 2)**2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2)**2
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(np.minimum(h, 1))) / METRES_PER_MILE
+
+def geodesic_miles(lat1, lon1, lat2, lon2, tol=1e-12, max_iter=200):
+    lat1, lon1, lat2, lon2 = (np.asarray(x, dtype=float) for x in (lat1, lon1, lat2, lon2))
+    U1 = np.arctan((1 - F) * np.tan(np.radians(lat1)))
+    U2 = np.arctan((1 - F) * np.tan(np.radians(lat2)))
+    L = np.radians(lon2 - lon1)
+    sinU1, cosU1 = np.sin(U1), np.cos(U1)
+    sinU2, cosU2 = np.sin(U2), np.cos(U2)
+
+    # iterate lambda until every pair has converged (or give up on the ones that don't)
+    lam = L.copy()
+    active = np.ones(L.shape, dtype=bool)
+    sin_sigma = np.zeros(L.shape)
+    cos_sigma = np.ones(L.shape)
+    sigma = np.zeros(L.shape)
+    cos2_alpha = np.ones(L.shape)
+    cos_2sigma_m = np.zeros(L.shape)
+    for _ in range(max_iter):
+        i = np.flatnonzero(active)
+        if len(i) == 0:
+            break
+        sin_lam, cos_lam = np.sin(lam[i]), np.cos(lam[i])
+        ss = np.hypot(cosU2[i] * sin_lam, cosU1[i] * sinU2[i] - sinU1[i] * cosU2[i] * cos_lam)
+        cs = sinU1[i] * sinU2[i] + cosU1[i] * cosU2[i] * cos_lam
+        s = np.arctan2(ss, cs)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            sin_alpha = np.where(ss == 0, 0, cosU1[i] * cosU2[i] * sin_lam / ss)
+            c2a = 1 - sin_alpha**2
+            # equatorial lines have cos^2(alpha) = 0
+            c2sm = np.where(c2a == 0, 0, cs - 2 * sinU1[i] * sinU2[i] / c2a)
+        C = F / 16 * c2a * (4 + F * (4 - 3 * c2a))
+        lam_new = L[i] + (1 - C) * F * sin_alpha * (s + C * ss * (c2sm + C * cs * (-1 + 2 * c2sm**2)))
+
+        sin_sigma[i], cos_sigma[i], sigma[i], cos2_alpha[i], cos_2sigma_m[i] = ss, cs, s, c2a, c2sm
+        done = np.abs(lam_new - lam[i]) <= tol
+        lam[i] = lam_new
+        active[i[done]] = False
+
+    u2 = cos2_alpha * (A**2 - B**2) / B**2
+    A_ = 1 + u2 / 16384 * (4096 + u2 * (-768 + u2 * (320 - 175 * u2)))
+    B_ = u2 / 1024 * (256 + u2 * (-128 + u2 * (74 - 47 * u2)))
+    delta_sigma = B_ * sin_sigma * (cos_2sigma_m + B_ / 4 * (
+        cos_sigma * (-1 + 2 * cos_2sigma_m**2) -
+        B_ / 6 * cos_2sigma_m * (-3 + 4 * sin_sigma**2) * (-3 + 4 * cos_2sigma_m**2)
+    ))
+    miles = B * A_ * (sigma - delta_sigma) / METRES_PER_MILE
+
+    for j in np.flatnonzero(active):
+        miles.flat[j] = geodesic((lat1.flat[j], lon1.flat[j]), (lat2.flat[j], lon2.flat[j])).miles
+    return miles
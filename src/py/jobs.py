@@ -0,0 +1,117 @@
+# background jobs for the long-running steps (traffic fetches, assignments), so they don't run inside a request
+# and several can run at once. jobs run on a pool of worker threads, each in its own working directory that's
+# removed when it finishes. a job reports progress through job.report(), which is also where cancellation takes
+# effect: once cancel() is called, the job's next report raises JobCancelled. finished jobs are kept for their
+# results until max_finished newer ones have finished.
+
+import os
+import shutil
+import threading
+import traceback
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from time import time
+
+class JobCancelled(Exception):
+    pass
+
+class Job(object):
+
+    def __init__(self, kind, workdir):
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.workdir = os.path.join(workdir, self.id)
+        self.status = 'queued'
+        self.progress = {}
+        self.result = None
+        self.error = None
+        self.submitted = time()
+        self.started = None
+        self.finished = None
+        self.cancelled = threading.Event()
+        self.future = None
+
+    def report(self, **progress):
+        # called by the running job, from its own thread
+        if self.cancelled.is_set():
+            raise JobCancelled()
+        self.progress = dict(self.progress, **progress)
+
+    def info(self):
+        now = time()
+        return {
+            'job_id': self.id,
+            'kind': self.kind,
+            'status': self.status,
+            'progress': self.progress,
+            'error': self.error,
+            'queued_for': (self.started or now) - self.submitted,
+            'running_for': ((self.finished or now) - self.started) if self.started else 0
+        }
+
+class JobQueue(object):
+
+    def __init__(self, directory, workers=4, max_finished=100):
+        self.directory = directory
+        self.max_finished = max_finished
+        self.pool = ThreadPoolExecutor(workers)
+        self.jobs = OrderedDict()
+        self.finished = OrderedDict() # ids of finished jobs, oldest first
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def submit(self, kind, fn, *args):
+        # runs fn(job, *args) on a worker; whatever it returns is the job's result
+        job = Job(kind, self.directory)
+        with self.lock:
+            self.jobs[job.id] = job
+        job.future = self.pool.submit(self.run, job, fn, args)
+        return job
+
+    def run(self, job, fn, args):
+        if job.cancelled.is_set():
+            self.finish(job, 'cancelled')
+            return
+        job.status = 'running'
+        job.started = time()
+        os.makedirs(job.workdir)
+        try:
+            job.result = fn(job, *args)
+            self.finish(job, 'done')
+        except JobCancelled:
+            self.finish(job, 'cancelled')
+        except Exception as e:
+            traceback.print_exc()
+            job.error = str(e) or type(e).__name__
+            self.finish(job, 'failed')
+        finally:
+            shutil.rmtree(job.workdir, ignore_errors=True)
+
+    def finish(self, job, status):
+        job.status = status
+        job.finished = time()
+        with self.lock:
+            self.finished[job.id] = True
+            while len(self.finished) > self.max_finished:
+                old, _ = self.finished.popitem(last=False)
+                del self.jobs[old]
+
+    def get(self, job_id):
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def cancel(self, job_id):
+        # queued jobs are dropped straight away, running ones stop at their next progress report
+        job = self.get(job_id)
+        if job is None:
+            return None
+        job.cancelled.set()
+        if job.future.cancel():
+            self.finish(job, 'cancelled')
+        return job
+
+    def stats(self):
+        with self.lock:
+            statuses = [job.status for job in self.jobs.values()]
+        return {s: statuses.count(s) for s in ('queued', 'running', 'done', 'failed', 'cancelled')}
@@ -0,0 +1,157 @@
+# long-lived julia traffic assignment workers (src/jl/ta_worker.jl, which has the message layout), so an
+# assignment costs its solve time only, not starting julia, loading its packages and compiling the solver. a
+# worker takes one job at a time, sent over its stdin in binary rather than as csv files, and answers on a pipe of
+# its own. one that dies, or is stopped mid-job (e.g. a cancelled assignment), is replaced by a fresh one.
+
+import os
+import queue
+import subprocess
+import numpy as np
+import pandas as pd
+
+from src.py.trip_tables import sparse_trip_table
+
+JULIA = './julia-0.6/bin/julia'
+WORKER_SCRIPT = 'src/jl/ta_worker.jl'
+
+# network columns in the order the worker reads them (free flow time is the 'base' column, as in the script)
+FLOAT_COLUMNS = ['capacity', 'length', 'base', 'b', 'power', 'speedlimit', 'toll']
+
+def job_bytes(df, ntazs, node_counter, trip_table, total_trips, settings):
+    # df as network_to_dataframe makes it, settings as solver_settings makes them
+    budget = settings['time_budget']
+    parts = [
+        np.array([ntazs, node_counter, len(df)], dtype='<i8'),
+        np.array([total_trips, settings['tol']], dtype='<f8'),
+        np.array([settings['max_iter_no']], dtype='<i8'),
+        np.array([np.inf if budget is None else budget], dtype='<f8'),
+        df['tail'].to_numpy(dtype='<i8'),
+        df['head'].to_numpy(dtype='<i8')
+    ]
+    parts += [df[c].to_numpy(dtype='<f8') for c in FLOAT_COLUMNS]
+    parts += [df['type'].to_numpy(dtype='<i8'), df['am'].to_numpy(dtype='<f8')]
+    # the od pairs with trips
+    od = sparse_trip_table(trip_table).tocoo()
+    parts += [np.array([od.nnz], dtype='<i8'), (od.row + 1).astype('<i8'), (od.col + 1).astype('<i8'), od.data.astype('<f8')]
+    return b''.join(p.tobytes() for p in parts)
+
+class JuliaWorker(object):
+
+    def __init__(self):
+        self.proc = None
+        self.answers = None
+        self.ready = False
+
+    def start(self):
+        # returns straight away; the worker loads and compiles in the background until its first job
+        r, w = os.pipe()
+        try:
+            self.proc = subprocess.Popen([JULIA, WORKER_SCRIPT, str(w)], stdin=subprocess.PIPE, pass_fds=(w,))
+        except BaseException:
+            os.close(r)
+            raise
+        finally:
+            os.close(w)
+        self.answers = os.fdopen(r, 'rb')
+        self.ready = False
+
+    def stop(self):
+        if self.proc is not None:
+            self.proc.kill()
+            self.proc.wait()
+            try:
+                self.proc.stdin.close()
+            except OSError:
+                # flushing a part-written job to the dead worker
+                pass
+            self.answers.close()
+            self.proc = None
+
+    def restart(self):
+        self.stop()
+        try:
+            self.start()
+        except OSError as e:
+            # e.g. no julia install: jobs will fail with this when they try to start it again
+            print('could not start julia worker: {}'.format(e))
+
+    def read(self, size):
+        data = self.answers.read(size)
+        if len(data) < size:
+            raise RuntimeError('julia worker exited with code {}'.format(self.proc.wait()))
+        return data
+
+    def read_array(self, dtype, count):
+        return np.frombuffer(self.read(8 * count), dtype=dtype)
+
+    def solve(self, df, ntazs, node_counter, trip_table, total_trips, settings, progress=None):
+        # returns the same dataframe the script writes: tail, head, travel_time, xk, fixed_flow
+        if (self.proc is None) or (self.proc.poll() is not None):
+            self.stop()
+            self.start()
+        try:
+            if not self.ready:
+                if self.read(1) != b'R':
+                    raise RuntimeError('julia worker did not start properly')
+                self.ready = True
+            self.proc.stdin.write(job_bytes(df, ntazs, node_counter, trip_table, total_trips, settings))
+            self.proc.stdin.flush()
+
+            while True:
+                tag = self.read(1)
+                if tag == b'I':
+                    k = int(self.read_array('<i8', 1)[0])
+                    gap, obj = self.read_array('<f8', 2).tolist()
+                    if progress is not None:
+                        progress(k, gap, obj)
+                elif tag == b'D':
+                    self.read_array('<f8', 1) # objective
+                    xk, travel_time, fixed_flow = self.read_array('<f8', 3 * len(df)).reshape(3, len(df))
+                    return pd.DataFrame({
+                        'tail': df['tail'],
+                        'head': df['head'],
+                        'travel_time': travel_time,
+                        'xk': xk,
+                        'fixed_flow': fixed_flow
+                    })
+                elif tag == b'E':
+                    size = int(self.read_array('<i8', 1)[0])
+                    error = self.read(size).decode('utf-8', 'replace')
+                    break
+                else:
+                    raise RuntimeError('unexpected answer from julia worker: {!r}'.format(tag))
+        except BaseException:
+            # mid-job (or gone), the worker can't take another one: replace it
+            self.restart()
+            raise
+        # the job failed but the worker is fine
+        raise RuntimeError('julia traffic assignment failed: {}'.format(error))
+
+class JuliaWorkerPool(object):
+
+    def __init__(self, workers=1):
+        # the workers aren't started until start(); one that isn't running when it gets a job (not started, or
+        # crashed) starts then
+        self.workers = [JuliaWorker() for _ in range(workers)]
+        self.idle = queue.Queue()
+        for worker in self.workers:
+            self.idle.put(worker)
+
+    def start(self):
+        # returns straight away: the workers load and compile in the background, so they're warm by the first
+        # assignment
+        for worker in self.workers:
+            if worker.proc is None:
+                worker.restart()
+
+    def solve(self, *args, **kwargs):
+        # see JuliaWorker.solve. waits for a free worker
+        worker = self.idle.get()
+        try:
+            return worker.solve(*args, **kwargs)
+        finally:
+            self.idle.put(worker)
+
+    def close(self):
+        while not self.idle.empty():
+            self.idle.get().stop()
@@ -0,0 +1,104 @@
+# on-disk cache of processed networks, so uploading the same extract again skips parsing and simplification.
+# entries are keyed by a sha256 of the uploaded bytes plus the pipeline parameters, and stored as .npz files
+# (see save_road_graph). file modification times double as the LRU order: a hit touches its entry, and the
+# oldest entries are deleted once the directory grows past max_bytes.
+
+import hashlib
+import json
+import os
+import uuid
+from zipfile import BadZipFile
+
+from src.py.road_graph import save_road_graph, load_road_graph
+
+# bump when the processing pipeline changes, so stale entries stop matching
+PIPELINE_VERSION = 1
+
+def file_key(filename, **params):
+    h = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    h.update(json.dumps(dict(params, version=PIPELINE_VERSION), sort_keys=True).encode('utf-8'))
+    return h.hexdigest()
+
+class NetworkCache(object):
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, key):
+        return os.path.join(self.directory, key + '.npz')
+
+    def get(self, key):
+        # returns (RoadGraph, extras dict) or None
+        path = self.path(key)
+        try:
+            result = load_road_graph(path)
+        except (OSError, ValueError, KeyError, BadZipFile) as e:
+            # missing, or a partial/corrupt file: treat as a miss and let put() replace it
+            if os.path.exists(path):
+                print('dropping unreadable network cache entry {}: {}'.format(key, e))
+                os.remove(path)
+            self.misses += 1
+            return None
+        try:
+            os.utime(path)
+        except OSError: # evicted meanwhile by another request; the loaded copy is still good
+            pass
+        self.hits += 1
+        return result
+
+    def put(self, key, g, **extra):
+        # write to a temporary name first so a crash never leaves a half-written entry under the real key. the name
+        # is unique so concurrent puts of one key (two uploads of the same extract) don't write the same file
+        path = self.path(key)
+        partial = '{}.{}.partial'.format(path, uuid.uuid4().hex)
+        try:
+            with open(partial, 'wb') as f:
+                save_road_graph(g, f, **extra)
+            os.replace(partial, path)
+        except BaseException:
+            if os.path.exists(partial):
+                os.remove(partial)
+            raise
+        self.evict()
+
+    def entries(self):
+        # (mtime, size, path) of every entry, oldest first
+        found = []
+        for name in os.listdir(self.directory):
+            if name.endswith('.npz'):
+                path = os.path.join(self.directory, name)
+                st = os.stat(path)
+                found.append((st.st_mtime, st.st_size, path))
+        return sorted(found)
+
+    def evict(self):
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        # always keep the newest entry, even if it alone is over the limit
+        for _, size, path in entries[:-1]:
+            if total <= self.max_bytes:
+                break
+            os.remove(path)
+            total -= size
+            self.evictions += 1
+
+    def stats(self):
+        entries = self.entries()
+        lookups = self.hits + self.misses
+        return {
+            'entries': len(entries),
+            'bytes': sum(size for _, size, _ in entries),
+            'max_bytes': self.max_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': self.hits / lookups if lookups else 0.0
+        }
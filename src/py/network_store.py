@@ -0,0 +1,215 @@
+# server-side store of the networks the frontend is working on, so requests can name a network by id (plus the
+# user's edits since) instead of sending the whole graph, and responses can return just what changed. networks
+# are kept in memory up to max_bytes, least recently used first out; with a spill directory, evicted networks are
+# written there in the columnar format (see nx_columnar) and loaded back on their next use, up to max_spill_bytes.
+# stored graphs are never modified: endpoints work on a copy and store the result under a new id.
+
+import os
+import threading
+import uuid
+from collections import OrderedDict
+from sys import getsizeof
+
+from src.py import nx_columnar
+
+def graph_bytes(g):
+    # rough in-memory size, from the attribute dicts and their values, which dominate
+    def attr_bytes(d):
+        return getsizeof(d) + sum(getsizeof(v) for v in d.values())
+    return sum(attr_bytes(d) for _, d in g.nodes(data=True)) + sum(attr_bytes(d) for _, _, d in g.edges(data=True))
+
+def edge_key(edge_id):
+    n1, n2 = edge_id.split(',')
+    return int(n1), int(n2)
+
+def apply_edits(g, edits):
+    # edits: {"n1,n2": {attribute: value}} as made to edge features in the frontend
+    for edge_id, attrs in (edits or {}).items():
+        n1, n2 = edge_key(edge_id)
+        if not g.has_edge(n1, n2):
+            raise KeyError('edit to unknown edge {}'.format(edge_id))
+        g[n1][n2].update(attrs)
+    return g
+
+def changed_attributes(before, after):
+    return {k: v for k, v in after.items() if (k not in before) or (before[k] != v)}
+
+def network_delta(before, after):
+    # what turns network before into after, keyed like the geojson features: changed (or all, for new ones)
+    # attributes of nodes and edges, and the ids of removed ones. new nodes come with lat/lon so they can be drawn.
+    edges = {}
+    for n1, n2, d in after.edges(data=True):
+        changed = changed_attributes(before[n1][n2], d) if before.has_edge(n1, n2) else d
+        if changed:
+            edges['{},{}'.format(n1, n2)] = changed
+    nodes = {}
+    for n, d in after.nodes(data=True):
+        changed = changed_attributes(before.nodes[n], d) if before.has_node(n) else d
+        if changed:
+            nodes[n] = changed
+    return {
+        'edges': edges,
+        'nodes': nodes,
+        'removed_edges': ['{},{}'.format(n1, n2) for n1, n2 in before.edges() if not after.has_edge(n1, n2)],
+        'removed_nodes': [n for n in before.nodes() if not after.has_node(n)]
+    }
+
+class NetworkStore(object):
+
+    def __init__(self, max_bytes, spill_directory=None, max_spill_bytes=0):
+        self.max_bytes = max_bytes
+        self.spill_directory = spill_directory
+        self.max_spill_bytes = max_spill_bytes
+        self.networks = OrderedDict() # id -> (graph, size), least recently used first
+        self.spilling = {} # id -> (graph, size) of evicted networks still being written to the spill directory
+        self.loading = {} # id -> event set once the spilled network is read back
+        self.bytes = 0
+        self.hits = 0
+        self.spill_hits = 0
+        self.misses = 0
+        self.spills = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+        if spill_directory:
+            os.makedirs(spill_directory, exist_ok=True)
+            # spilled networks don't outlive the process that knows their ids
+            for name in os.listdir(spill_directory):
+                if name.endswith('.trnw'):
+                    os.remove(os.path.join(spill_directory, name))
+
+    def spill_path(self, nw_id):
+        return os.path.join(self.spill_directory, nw_id + '.trnw')
+
+    def put(self, g):
+        nw_id = uuid.uuid4().hex
+        size = graph_bytes(g)
+        with self.lock:
+            evicted = self.admit(nw_id, g, size)
+        self.spill(evicted)
+        return nw_id
+
+    def get(self, nw_id):
+        # the stored graph (don't modify it) or None if it's unknown or was evicted. spilled networks are read back
+        # outside the lock; requests for one that's being read back wait for it
+        while True:
+            g = None
+            with self.lock:
+                if nw_id in self.networks:
+                    self.networks.move_to_end(nw_id)
+                    self.hits += 1
+                    return self.networks[nw_id][0]
+                if nw_id in self.spilling:
+                    # evicted but not written out yet: take it back
+                    g, size = self.spilling.pop(nw_id)
+                    self.hits += 1
+                    evicted = self.admit(nw_id, g, size)
+                else:
+                    loading = self.loading.get(nw_id)
+                    if loading is None:
+                        if not (self.spill_directory and os.path.exists(self.spill_path(nw_id))):
+                            self.misses += 1
+                            return None
+                        loading = self.loading[nw_id] = threading.Event()
+                        break
+            if g is not None:
+                self.spill(evicted)
+                return g
+            loading.wait()
+
+        try:
+            with open(self.spill_path(nw_id), 'rb') as f:
+                _, g = nx_columnar.decode(f.read())
+            size = graph_bytes(g)
+            with self.lock:
+                os.remove(self.spill_path(nw_id))
+                self.spill_hits += 1
+                evicted = self.admit(nw_id, g, size)
+        finally:
+            with self.lock:
+                del self.loading[nw_id]
+            loading.set()
+        self.spill(evicted)
+        return g
+
+    def admit(self, nw_id, g, size):
+        # called under the lock. returns the ids shrink evicted to be spilled
+        self.networks[nw_id] = (g, size)
+        self.bytes += size
+        return self.shrink()
+
+    def shrink(self):
+        # called under the lock. always keeps the most recent network, even if it alone is over the limit. returns
+        # the ids of the networks to write to the spill directory, which spill does outside the lock
+        evicted = []
+        while (self.bytes > self.max_bytes) and (len(self.networks) > 1):
+            nw_id, (g, size) = self.networks.popitem(last=False)
+            self.bytes -= size
+            if self.spill_directory and self.max_spill_bytes > 0:
+                self.spilling[nw_id] = (g, size)
+                evicted.append(nw_id)
+            else:
+                self.evictions += 1
+        return evicted
+
+    def spill(self, evicted):
+        # writes the networks shrink evicted to the spill directory, without holding the lock
+        for nw_id in evicted:
+            with self.lock:
+                spilling = self.spilling.get(nw_id)
+            if spilling is None:
+                # taken back already
+                continue
+            partial = '{}.{}.partial'.format(self.spill_path(nw_id), uuid.uuid4().hex)
+            with open(partial, 'wb') as f:
+                f.write(nx_columnar.encode(spilling[0]))
+            os.replace(partial, self.spill_path(nw_id))
+            with self.lock:
+                if self.spilling.get(nw_id) is spilling:
+                    del self.spilling[nw_id]
+                    self.spills += 1
+                elif nw_id in self.networks:
+                    # taken back while it was being written
+                    os.remove(self.spill_path(nw_id))
+        if evicted:
+            with self.lock:
+                self.shrink_spill()
+
+    def spilled(self):
+        # (mtime, size, path) of spilled networks, oldest first
+        found = []
+        for name in os.listdir(self.spill_directory):
+            if name.endswith('.trnw'):
+                path = os.path.join(self.spill_directory, name)
+                st = os.stat(path)
+                found.append((st.st_mtime, st.st_size, path))
+        return sorted(found)
+
+    def shrink_spill(self):
+        # called under the lock. networks being read back are left alone
+        spilled = self.spilled()
+        total = sum(size for _, size, _ in spilled)
+        loading = set(self.spill_path(nw_id) for nw_id in self.loading)
+        for _, size, path in spilled:
+            if total <= self.max_spill_bytes:
+                break
+            if path in loading:
+                continue
+            os.remove(path)
+            total -= size
+            self.evictions += 1
+
+    def stats(self):
+        with self.lock:
+            spilled = self.spilled() if self.spill_directory else []
+            return {
+                'networks': len(self.networks),
+                'bytes': self.bytes,
+                'max_bytes': self.max_bytes,
+                'spilled': len(spilled),
+                'spilled_bytes': sum(size for _, size, _ in spilled),
+                'hits': self.hits,
+                'spill_hits': self.spill_hits,
+                'misses': self.misses,
+                'spills': self.spills,
+                'evictions': self.evictions
+            }
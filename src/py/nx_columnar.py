@@ -0,0 +1,171 @@
+# compact binary alternative to nx_geojson for sending networks between the server and the frontend
+# (src/js/networkCodec.js is the other end). a message is
+#   'TRNW' | u32 version | u32 header length | header json | padding to 8 bytes | buffers
+# the header holds the rest of the request/response payload, where in it the network goes, and a description of
+# the node and edge columns; the buffers are little-endian typed arrays at 8-byte aligned offsets:
+#   nodes: ids (f8), then one array per attribute (lat, lon, taz, ...)
+#   edges: tail and head as node indices (u4), then one array per attribute
+# attribute kinds are 'f8' (numbers, 'int' set if they were all ints), 'bool' (u1) and 'cat' (i4 codes into a
+# table of json values held in the header, for strings and mixed columns). an attribute missing on some
+# nodes/edges also gets a u1 mask of where it's present, so the graph round-trips exactly.
+# GeoJSON stays the format for export and for clients that don't ask for this one.
+
+import json
+import numbers
+import numpy as np
+import networkx as nx
+from struct import pack, unpack_from
+
+MIME = 'application/vnd.trayson.network'
+MAGIC = b'TRNW'
+VERSION = 1
+
+DTYPES = {'f8': '<f8', 'u4': '<u4', 'u1': 'u1', 'i4': '<i4'}
+
+def is_number(v):
+    return isinstance(v, numbers.Number) and not isinstance(v, (bool, np.bool_))
+
+def json_value(v):
+    # numpy scalars to plain python for the header
+    return v.item() if isinstance(v, np.generic) else v
+
+def json_default(v):
+    # numpy values left in the payload (stats and the like)
+    if isinstance(v, np.ndarray):
+        return v.tolist()
+    if isinstance(v, np.generic):
+        return v.item()
+    raise TypeError('{!r} is not JSON serializable'.format(v))
+
+def encode_columns(records, buffers):
+    # one column per attribute key, in first-seen order
+    keys = []
+    seen = set()
+    for r in records:
+        for k in r:
+            if k not in seen:
+                seen.add(k)
+                keys.append(k)
+
+    columns = []
+    for k in keys:
+        present = np.array([k in r for r in records], dtype=bool)
+        values = [json_value(r[k]) for r in records if k in r]
+        column = {'name': k}
+        if all(isinstance(v, bool) for v in values):
+            column['kind'] = 'bool'
+            data = np.zeros(len(records), dtype=np.uint8)
+            data[present] = values
+            column['data'] = add_buffer(buffers, 'u1', data)
+        elif all(is_number(v) for v in values):
+            column['kind'] = 'f8'
+            column['int'] = all(isinstance(v, numbers.Integral) for v in values)
+            data = np.full(len(records), np.nan)
+            data[present] = values
+            column['data'] = add_buffer(buffers, 'f8', data)
+        else:
+            column['kind'] = 'cat'
+            table = {}
+            codes = np.full(len(records), -1, dtype=np.int32)
+            codes[present] = [table.setdefault(json.dumps(v), len(table)) for v in values]
+            column['table'] = [json.loads(v) for v in table]
+            column['data'] = add_buffer(buffers, 'i4', codes)
+        column['mask'] = None if present.all() else add_buffer(buffers, 'u1', present.astype(np.uint8))
+        columns.append(column)
+    return columns
+
+def add_buffer(buffers, dtype, array):
+    buffers.append((dtype, np.ascontiguousarray(array, dtype=DTYPES[dtype])))
+    return len(buffers) - 1
+
+def encode(g, payload=None, path=()):
+    # payload: the rest of the message (json-able dict); path: keys leading to where the network sits in it,
+    # empty to merge the payload into the network object itself (like the geojson responses do)
+    buffers = []
+    nodes = list(g.nodes())
+    index = {n: i for i, n in enumerate(nodes)}
+    edges = list(g.edges(data=True))
+
+    header = {
+        'version': VERSION,
+        'payload': payload or {},
+        'path': list(path),
+        'nodes': {
+            'count': len(nodes),
+            'ids': add_buffer(buffers, 'f8', np.array(nodes, dtype=float)),
+            'columns': encode_columns([g.nodes[n] for n in nodes], buffers)
+        },
+        'edges': {
+            'count': len(edges),
+            'tail': add_buffer(buffers, 'u4', np.array([index[n1] for n1, _, _ in edges], dtype=np.uint32)),
+            'head': add_buffer(buffers, 'u4', np.array([index[n2] for _, n2, _ in edges], dtype=np.uint32)),
+            'columns': encode_columns([d for _, _, d in edges], buffers)
+        }
+    }
+
+    # lay the buffers out at 8-byte aligned offsets after the header
+    offset = 0
+    header['buffers'] = []
+    for dtype, array in buffers:
+        header['buffers'].append({'dtype': dtype, 'offset': offset, 'length': len(array)})
+        offset += -(-array.nbytes // 8) * 8
+    head = json.dumps(header, default=json_default).encode('utf-8')
+    head += b' ' * (-(len(MAGIC) + 8 + len(head)) % 8)
+
+    out = bytearray(MAGIC + pack('<II', VERSION, len(head)) + head)
+    for dtype, array in buffers:
+        out += array.tobytes()
+        out += b'\0' * (-array.nbytes % 8)
+    return bytes(out)
+
+def decode_columns(section, buffers, count):
+    columns = []
+    for column in section['columns']:
+        present = np.ones(count, dtype=bool) if column['mask'] is None else buffers[column['mask']].astype(bool)
+        data = buffers[column['data']][present]
+        if column['kind'] == 'bool':
+            values = [bool(v) for v in data.tolist()]
+        elif column['kind'] == 'f8':
+            values = [int(v) for v in data.tolist()] if column.get('int') else data.tolist()
+        else:
+            table = column['table']
+            values = [table[c] for c in data.tolist()]
+        columns.append((column['name'], iter(values), present.tolist()))
+    records = [{} for _ in range(count)]
+    for name, values, present in columns:
+        for r, p in zip(records, present):
+            if p:
+                r[name] = next(values)
+    return records
+
+def decode(data):
+    # returns (payload, g). the graph is also put back in the payload at its path, unless that's the top level
+    if data[:len(MAGIC)] != MAGIC:
+        raise ValueError('not a columnar network message')
+    version, head_size = unpack_from('<II', data, len(MAGIC))
+    if version != VERSION:
+        raise ValueError('unsupported columnar network version {}'.format(version))
+    start = len(MAGIC) + 8
+    header = json.loads(bytes(data[start:start+head_size]).decode('utf-8'))
+    body = start + head_size
+    buffers = [
+        np.frombuffer(data, dtype=DTYPES[b['dtype']], count=b['length'], offset=body + b['offset'])
+        for b in header['buffers']
+    ]
+
+    g = nx.DiGraph()
+    node_ids = [int(n) for n in buffers[header['nodes']['ids']].tolist()]
+    g.add_nodes_from(zip(node_ids, decode_columns(header['nodes'], buffers, header['nodes']['count'])))
+    tails = buffers[header['edges']['tail']].tolist()
+    heads = buffers[header['edges']['head']].tolist()
+    g.add_edges_from(
+        (node_ids[t], node_ids[h], attr)
+        for t, h, attr in zip(tails, heads, decode_columns(header['edges'], buffers, header['edges']['count']))
+    )
+    payload = header['payload']
+    if header['path']:
+        parent = payload
+        for key in header['path'][:-1]:
+            parent = parent.setdefault(key, {})
+        parent[header['path'][-1]] = g
+    return payload, g
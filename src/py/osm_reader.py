@@ -1,9 +1,16 @@
-from geopy.distance import geodesic
-import networkx as nx
 import osmread
 import numpy as np
-import pandas as pd
+from array import array
+from collections import namedtuple
+from heapq import heappop, heappush
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import connected_components
 from statistics import median
+from time import time
+
+from src.py.distance import geodesic_miles, haversine_miles
+from src.py.pbf_reader import read_pbf
+from src.py.road_graph import RoadGraph, StringTable
 
 def ways_filter(tags): # if True, we should filter out this way
     # filter for roads that are "highways" that aren't service, residential, or private roads
@@ -17,6 +24,114 @@ def ways_filter(tags): # if True, we should filter out this way
 #     # filter for restricted nodes
 #     return not (('restriction' in tags) and (tags['restriction'] != 'no_u_turn'))
 
+# the only way tags read by the rest of the pipeline
+WAY_TAGS = {'highway', 'name', 'oneway', 'maxspeed', 'lanes', 'lanes:psv', 'lanes:forward', 'lanes:backward'}
+
+# slimmed down osmread.Way kept by the streaming reader
+RoadWay = namedtuple('RoadWay', ('id', 'uid', 'tags', 'nodes'))
+
+class NodeCoords(object):
+    # read-only {node id: (lon, lat)} lookup backed by sorted int64 ids and float64 coordinate arrays
+
+    def __init__(self, ids):
+        self.ids = ids
+        self.lon = np.full(len(ids), np.nan)
+        self.lat = np.full(len(ids), np.nan)
+
+    def index(self, node_id):
+        i = np.searchsorted(self.ids, node_id)
+        if (i == len(self.ids)) or (self.ids[i] != node_id):
+            raise KeyError(node_id)
+        return i
+
+    def __getitem__(self, node_id):
+        i = self.index(node_id)
+        if np.isnan(self.lon[i]): # referenced by a way but missing from the extract
+            raise KeyError(node_id)
+        return (float(self.lon[i]), float(self.lat[i]))
+
+    def __contains__(self, node_id):
+        try:
+            self[node_id]
+        except KeyError:
+            return False
+        return True
+
+    def __len__(self):
+        return int(np.count_nonzero(~np.isnan(self.lon)))
+
+def clean_way_tags(tags):
+    # convert speed limit from string to int.
+    # NOTE: assumes in US/all limits are in MPH
+    if 'maxspeed' in tags: 
+        try:
+            tags['maxspeed'] = int(tags['maxspeed'][:-4])
+        except ValueError:
+            try: # someone probably forgot to put a mph on it
+                tags['maxspeed'] = int(tags['maxspeed'])
+            except ValueError: # blank maxspeed, probably
+                del tags['maxspeed']
+    
+    # treat links like regular roads
+    if tags['highway'][-5:] == '_link':
+        tags['highway'] = tags['highway'][:-5]
+    
+    # ensure consistency on lanes
+    tags['lanes'] = int(tags.get('lanes', 0))
+
+    return tags
+
+def road_way_tags(tags):
+    # cleaned tags to keep for a whitelisted way, or None if the way is filtered out
+    if ways_filter(tags):
+        return None
+    return clean_way_tags({k: v for k, v in tags.items() if k in WAY_TAGS})
+
+def read_osm_streaming(filepath):
+    # two passes over the file so that memory scales with the road network rather than the extract:
+    # the first keeps whitelisted ways (with only the tags we use) and collects the node ids they reference,
+    # the second fills coordinates for just those nodes.
+
+    ways = []
+    refs = array('q')
+    for entity in osmread.parse_file(filepath):
+        if isinstance(entity, osmread.Way) and (not ways_filter(entity.tags)):
+            tags = road_way_tags(entity.tags)
+            nodes = array('q', entity.nodes)
+            refs.extend(nodes)
+            ways.append(RoadWay(entity.id, entity.uid, tags, nodes))
+
+    nodes = NodeCoords(np.unique(np.frombuffer(refs, dtype=np.int64)))
+    del refs
+    for entity in osmread.parse_file(filepath):
+        if isinstance(entity, osmread.Node):
+            i = np.searchsorted(nodes.ids, entity.id)
+            if (i < len(nodes.ids)) and (nodes.ids[i] == entity.id):
+                nodes.lon[i] = entity.lon
+                nodes.lat[i] = entity.lat
+
+    return nodes, ways
+
+def read_osm_pbf(filepath, processes=None):
+    # same output as read_osm_streaming, with blobs decoded and ways filtered in a process pool
+    ids, lon, lat, pbf_ways = read_pbf(filepath, road_way_tags, processes)
+
+    ways = []
+    for wid, uid, tags, refs in pbf_ways:
+        nodes = array('q')
+        nodes.frombytes(refs.astype(np.int64).tobytes())
+        ways.append(RoadWay(wid, uid, tags, nodes))
+
+    if pbf_ways:
+        nodes = NodeCoords(np.unique(np.concatenate([w[3] for w in pbf_ways])))
+    else:
+        nodes = NodeCoords(np.zeros(0, dtype=np.int64))
+    i = np.searchsorted(nodes.ids, ids)
+    nodes.lon[i] = lon
+    nodes.lat[i] = lat
+
+    return nodes, ways
+
 def read_osm(filepath):
 
     nodes = {}
@@ -31,25 +146,7 @@ def read_osm(filepath):
             nodes[entity.id] = (entity.lon, entity.lat)
 
         elif isinstance(entity, osmread.Way) and (not ways_filter(entity.tags)):
-        
-            # convert speed limit from string to int.
-            # NOTE: assumes in US/all limits are in MPH
-            if 'maxspeed' in entity.tags: 
-                try:
-                    entity.tags['maxspeed'] = int(entity.tags['maxspeed'][:-4])
-                except ValueError:
-                    try: # someone probably forgot to put a mph on it
-                        entity.tags['maxspeed'] = int(entity.tags['maxspeed'])
-                    except ValueError: # blank maxspeed, probably
-                        del entity.tags['maxspeed']
-            
-            # treat links like regular roads
-            if entity.tags['highway'][-5:] == '_link':
-                entity.tags['highway'] = entity.tags['highway'][:-5]
-            
-            # ensure consistency on lanes
-            entity.tags['lanes'] = int(entity.tags.get('lanes', 0))
-            
+            clean_way_tags(entity.tags)
             ways.append(entity)
 
         # elif isinstance(entity, osmread.Relation) and (not rels_filter(entity.tags)):
@@ -58,10 +155,53 @@ def read_osm(filepath):
     # return nodes, ways, rels
     return nodes, ways
 
+# ranks used to pick the smaller road when merging segments of different classes
+ROAD_CLASS = { 
+    'motorway' : 5,
+    'trunk' : 4,
+    'primary' : 3,
+    'secondary' : 2,
+    'tertiary' : 1,
+    'unclassified' : 0,
+#     'residential' : -1,
+#     'service' : -2
+}
+
+def node_coordinates(nodes, node_ids):
+    # lon/lat arrays for the given osm ids from either a NodeCoords or a plain {id: (lon, lat)} dict
+    if isinstance(nodes, NodeCoords):
+        i = np.minimum(np.searchsorted(nodes.ids, node_ids), max(len(nodes.ids)-1, 0))
+        missing = (nodes.ids[i] != node_ids) | np.isnan(nodes.lon[i])
+        if missing.any():
+            raise KeyError(int(node_ids[missing][0]))
+        return nodes.lon[i], nodes.lat[i]
+    coords = np.array([nodes[n] for n in node_ids.tolist()], dtype=float).reshape(-1, 2)
+    return coords[:,0], coords[:,1]
+
 def construct_graph(nodes, ways):
     
-    g = nx.DiGraph()
-    
+    highways = StringTable(ROAD_CLASS)
+    names = StringTable()
+    tails = array('q')
+    heads = array('q')
+    way_ids = array('q')
+    lanes_col = array('d')
+    maxspeed_col = array('d')
+    highway_col = array('b')
+    name_col = array('i')
+    oneway_col = array('b')
+
+    def add_edges(way, frm, to, lanes, oneway):
+        n = len(frm)
+        tails.extend(frm)
+        heads.extend(to)
+        way_ids.extend([way.id] * n)
+        lanes_col.extend([lanes] * n)
+        maxspeed_col.extend([way.tags.get('maxspeed', np.nan)] * n)
+        highway_col.extend([highways.code(way.tags['highway'])] * n)
+        name_col.extend([names.code(way.tags.get('name'))] * n)
+        oneway_col.extend([oneway] * n)
+
     # add edges to graph
     for way in ways:
 
@@ -71,9 +211,8 @@ def construct_graph(nodes, ways):
         lanes -= psv_lanes
 
         # check directionality
-        if (way.tags.get('oneway') == 'yes'): # it's a one-way st
-            for i in range(len(way.nodes)-1):
-                g.add_edge(way.nodes[i], way.nodes[i+1], id=way.id, uid=way.uid, tags=way.tags)
+        if (way.tags.get('oneway') == 'yes'): # it's a one-way st: lanes as tagged, psv lanes and all
+            add_edges(way, way.nodes[:-1], way.nodes[1:], way.tags['lanes'], True)
         else: # 'oneway' is no OR no 'oneway' present (implicit 2-way)
             lanes_forward = lanes // 2
             lanes_backward = lanes // 2
@@ -81,250 +220,299 @@ def construct_graph(nodes, ways):
                 lanes_forward = int(way.tags['lanes:forward']) - psv_lanes//2
             if (way.tags.get('lanes:backward')):
                 lanes_backward = int(way.tags['lanes:backward']) - psv_lanes//2
-        
-            for i in range(len(way.nodes)-1):                
-                # add edge
-                way.tags['lanes'] = lanes_forward
-                g.add_edge(way.nodes[i], way.nodes[i+1], id=way.id, uid=way.uid, tags=way.tags)
-                way.tags['lanes'] = lanes_backward
-                g.add_edge(way.nodes[i+1], way.nodes[i], id=way.id, uid=way.uid, tags=way.tags)
-    
+
+            add_edges(way, way.nodes[:-1], way.nodes[1:], lanes_forward, False)
+            add_edges(way, way.nodes[1:], way.nodes[:-1], lanes_backward, False)
+
+    tails = np.frombuffer(tails, dtype=np.int64)
+    heads = np.frombuffer(heads, dtype=np.int64)
+
+    # a repeated (tail, head) pair keeps the attributes of the way added last
+    idx = np.arange(len(tails))
+    order = np.lexsort((idx, heads, tails))
+    last = np.ones(len(order), dtype=bool)
+    last[:-1] = (tails[order][1:] != tails[order][:-1]) | (heads[order][1:] != heads[order][:-1])
+    keep = np.sort(order[last])
+
+    node_ids, index = np.unique(np.concatenate((tails[keep], heads[keep])), return_inverse=True)
+    g = RoadGraph(
+        node_ids, np.zeros(len(node_ids)), np.zeros(len(node_ids)),
+        index[:len(keep)], index[len(keep):],
+        {
+            'way_id': np.frombuffer(way_ids, dtype=np.int64)[keep],
+            'lanes': np.frombuffer(lanes_col, dtype=float)[keep],
+            'maxspeed': np.frombuffer(maxspeed_col, dtype=float)[keep],
+            'highway': np.frombuffer(highway_col, dtype=np.int8)[keep],
+            'name': np.frombuffer(name_col, dtype=np.int32)[keep],
+            'oneway': np.frombuffer(oneway_col, dtype=np.bool_)[keep]
+        },
+        highways, names
+    )
+
     # drop nodes/subgraphs that aren't connected to the main body of the graph
-    g = max(nx.weakly_connected_component_subgraphs(g), key=len) 
+    V = g.number_of_nodes()
+    adj = csr_matrix((np.ones(len(g.tail)), (g.tail, g.head)), shape=(V, V))
+    _, labels = connected_components(adj, directed=True, connection='weak')
+    g = g.subgraph(labels[g.tail] == np.argmax(np.bincount(labels)))
 
-    for node in g.nodes():
-        g.nodes[node]['lat'] = nodes[node][1]
-        g.nodes[node]['lon'] = nodes[node][0]
+    g.lon, g.lat = node_coordinates(nodes, g.node_ids)
         
     return g
 
-def calc_length(g):
-    for edge in g.edges():
-        g.edges[edge]['length'] = geodesic((g.nodes[edge[0]]['lat'],g.nodes[edge[0]]['lon']), (g.nodes[edge[1]]['lat'],g.nodes[edge[1]]['lon'])).miles
-        if 'length' in g.edges[edge]['tags']:
-            del g.edges[edge]['tags']['length'] # delete because provided property can be confusing
+def calc_length(g, method='geodesic'):
+    # edge lengths in miles. 'geodesic' is ellipsoidal like geopy, 'haversine' is a faster spherical approximation
+    lengths = {'geodesic': geodesic_miles, 'haversine': haversine_miles}[method]
+    g.edges['length'] = lengths(g.lat[g.tail], g.lon[g.tail], g.lat[g.head], g.lon[g.head])
     return g
 
-def replace_node_with_edge(g, ie, oe, oneway): # from_node, to_node, reference edge
-    # assumes same way but different segments
-    # does not delete node (done outside)
-    new_edges = [(ie[0],oe[1])]
-    if not oneway:
-        new_edges.append((oe[1],ie[0]))
-    for new_edge in new_edges:
-        attr = {
-            'id': g.edges[ie]['id'],
-            'tags': g.edges[ie]['tags'].copy(),
-            'length': g.edges[ie]['length'] + g.edges[oe]['length']
-        }
-        
-        if ('name' in g.edges[ie]) and ('name' in g.edge[oe]) and (g.edges[ie]['name'] == g.edges[oe]['name']):
-            attr['name'] = g.edges[ie]['name']
-        
-        g.add_edge(*new_edge, **attr)
-        
-def replace_node_with_edge_adv(g, ie, oe, oneway): # from_node, to_node, reference edge
-    # does not delete node (done outside)
-    
-    # dict to determine smaller road
-    road_class = { 
-        'motorway' : 5,
-        'trunk' : 4,
-        'primary' : 3,
-        'secondary' : 2,
-        'tertiary' : 1,
-        'unclassified' : 0,
-#         'residential' : -1,
-#         'service' : -2
-    }
-    
-    new_edges = [(ie[0],oe[1])]
-    if not oneway:
-        new_edges.append((oe[1],ie[0]))
-        
-    tags = {}
-    # take minimum maxspeed if available
-    maxspeed = []
-    if 'maxspeed' in g.edges[ie]['tags']:
-        maxspeed.append(g.edges[ie]['tags'].get('maxspeed'))
-    if 'maxspeed' in g.edges[oe]['tags']:
-        maxspeed.append(g.edges[oe]['tags'].get('maxspeed'))
-    if len(maxspeed)>0:
-        tags['maxspeed'] = min(maxspeed)
-    # take minimum lanes if available
-    lanes = []
-    if 'lanes' in g.edges[ie]['tags']:
-        lanes.append(g.edges[ie]['tags'].get('lanes'))
-    if 'lanes' in g.edges[oe]['tags']:
-        lanes.append(g.edges[oe]['tags'].get('lanes'))
-    if len(lanes)>0:
-        tags['lanes'] = min(lanes)
-    # take name if we can be sure the links we're connecting are the same
-    if ('name' in g.edges[ie]['tags']) and ('name' in g.edges[oe]['tags']) and (g.edges[ie]['tags']['name'] == g.edges[ie]['tags']['name']):
-        tags['name'] = g.edges[ie]['tags']['name']
-    # determine smaller highway type and take that
-    intype = road_class[g.edges[ie]['tags']['highway']]
-    outype = road_class[g.edges[oe]['tags']['highway']]
-    if intype < outype: # outtype is smaller road. take its properties.
-        tags['highway'] = g.edges[oe]['tags']['highway']
-        if 'name' in g.edges[oe]['tags']:
-            tags['name'] = g.edges[oe]['tags']['name']
-    else: # intype is smaller road. take its properties.
-        tags['highway'] = g.edges[ie]['tags']['highway']
-        if 'name' in g.edges[ie]['tags']:
-            tags['name'] = g.edges[ie]['tags']['name']
-    
-    for new_edge in new_edges:
-        g.add_edge(*new_edge)
-        g.edges[new_edge].update({
-            'id': g.edges[ie]['id'],
-            'tags': tags,
-            'length': g.edges[ie]['length'] + g.edges[oe]['length']
-        })
+# simplify_graph contracts chains of pass-through nodes. a chain is walked once from a node that stays to the
+# next node that stays and replaced by a single edge. both merge rules below are associative, so folding the
+# whole chain gives the same edge as merging it one node at a time.
 
-def simplify_graph(g):
-    g = g.copy()
-    
-    # for each deleted node, track it to a node still in the graph for use in trip table
-#     node_tl = {}
-    
-    last_count = len(g.nodes())
-    # PART I: only delete nodes in the middle of one-way streets, or two way streets that were originally broken up during graph creation
-    while True: # scary notation! break check at end of while loop (always want it to run at least once)
-        
-        nodes_to_remove = []
-        for node in g.nodes():
-#             if (node not in node_tl):
-#                 # init node tracking to self
-#                 node_tl[node] = node 
-            
-            inn = list(g.in_edges(node))
-            out = list(g.out_edges(node))
-
-            # CONSERVATIVE CONSTRAINTS
-            # simplify one way streets, but doesn't delete nodes at the end of two-way streets
-            if (len(inn) == len(out) == 1) and (g.edges[inn[0]]['id'] == g.edges[out[0]]['id']) and (inn[0][0] != out[0][1]):
-                replace_node_with_edge(g,inn[0],out[0],oneway=True)
-                nodes_to_remove.append(node)
-                g.remove_edges_from(inn+out)
-#                 node_tl[node] = inn[0][0] # attach deleted node to node prior
-
-            # simplify two-way: if in_edges() is 2 AND out_edges() is 2 AND all way IDs match (so we know that it's the same two-way street)
-            elif (len(inn) == len(out) == 2) and \
-                 (g.edges[inn[0]]['id'] == g.edges[out[0]]['id']) and \
-                 (g.edges[inn[1]]['id'] == g.edges[out[1]]['id']) and \
-                    (g.edges[inn[0]]['id'] == g.edges[inn[1]]['id']):
-                ie = inn[0]
-                for oe in out:
-                    if ie[0] != oe[1]:
-                        replace_node_with_edge(g,ie,oe,oneway=False)
-                        break
-                nodes_to_remove.append(node) 
-                g.remove_edges_from(inn+out)
-#                 node_tl[node] = ie[0] # attach deleted node to node prior   
-        
-        g.remove_nodes_from(nodes_to_remove)
-        
-        # stop simplifying if no gains are made
-        current = len(g.nodes())
-        if last_count <= current:
-            break
-        else:
-            last_count = current
-            
-    # PART II: run a more lenient iteration that deletes more nodes
-    while True: # scary notation! break check at end of while loop (always want it to run at least once)
-        nodes_to_remove = []
-        for node in g.nodes():
-            inn = list(g.in_edges(node))
-            out = list(g.out_edges(node))
-
-            # RELAXED CONSTRAINTS: check congruity based on name instead of id
-            
-            # simplify one way streets by deleting any midpoints regardless of what way they're on
-            if (len(inn) == len(out) == 1) and (inn[0][0] != out[0][1]):
-                replace_node_with_edge_adv(g,inn[0],out[0],oneway=True)
-                nodes_to_remove.append(node)
-                g.remove_edges_from(inn+out)
-#                 node_tl[node] = inn[0][0] # attach deleted node to node prior
-
-            # simplify two-way: relax prior constraint from ID match to just a 4-way name match while still excluding two-sided road forks
-            # this isn't an area where the road explicitly splits into one-way streets
-            elif (len(inn) == len(out) == 2) and \
-                g.edges[inn[0]]['tags'].get('name') and \
-                g.edges[inn[1]]['tags'].get('name') and \
-                g.edges[out[0]]['tags'].get('name') and \
-                g.edges[out[1]]['tags'].get('name') and \
-                (g.edges[inn[0]]['tags']['name'] == g.edges[out[0]]['tags']['name']) and \
-                (g.edges[inn[1]]['tags']['name'] == g.edges[out[1]]['tags']['name']) and \
-                (g.edges[inn[0]]['tags']['name'] == g.edges[inn[1]]['tags']['name']) and \
-                (('oneway' not in g.edges[inn[0]]['tags']) or (g.edges[inn[0]]['tags']['oneway'] != 'yes')) and \
-                (('oneway' not in g.edges[inn[1]]['tags']) or (g.edges[inn[1]]['tags']['oneway'] != 'yes')):
-                    ie = inn[0]
-                    for oe in out:
-                        if ie[0] != oe[1]:
-                            replace_node_with_edge_adv(g,ie,oe,oneway=False)
-                            nodes_to_remove.append(node) 
-                            g.remove_edges_from(inn+out)
-#                             node_tl[node] = ie[0] # attach deleted node to node prior  
-                            break  
-        
-        g.remove_nodes_from(nodes_to_remove)
+def replace_node_with_edge(cols, path, road_class):
+    # assumes same way but different segments: keep the first segment's attributes
+    attr = {k: v[path[0]] for k, v in cols.items()}
+    attr['length'] = cols['length'][path].sum()
+    return attr
         
-        # stop simplifying if no gains are made
-        current = len(g.nodes())
-        if last_count <= current:
-            break
+def replace_node_with_edge_adv(cols, path, road_class):
+    attr = {
+        'way_id': cols['way_id'][path[0]],
+        'length': cols['length'][path].sum(),
+        'oneway': False
+    }
+    # take minimum maxspeed if available (nan when none has one)
+    attr['maxspeed'] = np.fmin.reduce(cols['maxspeed'][path])
+    # take minimum lanes
+    attr['lanes'] = cols['lanes'][path].min()
+    # determine the biggest highway type (first one on ties) and take its properties
+    big = path[np.argmax(road_class[cols['highway'][path]])]
+    attr['highway'] = cols['highway'][big]
+    attr['name'] = cols['name'][big]
+    return attr
+
+def pass_through_nodes(w, phase):
+    # through[e] is the edge that continues e past its head, if its head is a node we can delete
+    E = w['count']
+    alive = np.flatnonzero(w['alive'][:E])
+    V = len(w['removed'])
+    tail, head = w['tail'], w['head']
+    ids, names, oneway = w['cols']['way_id'], w['cols']['name'], w['cols']['oneway']
+
+    ins = alive[np.argsort(head[alive], kind='stable')]
+    outs = alive[np.argsort(tail[alive], kind='stable')]
+    indeg = np.bincount(head[alive], minlength=V)
+    outdeg = np.bincount(tail[alive], minlength=V)
+    in_ptr = np.concatenate(([0], np.cumsum(indeg)))
+    out_ptr = np.concatenate(([0], np.cumsum(outdeg)))
+    through = np.full(E, -1, dtype=np.int64)
+
+    # one-way pass-through: one edge in, one edge out, not a dead end
+    v = np.flatnonzero((indeg == 1) & (outdeg == 1))
+    ie, oe = ins[in_ptr[v]], outs[out_ptr[v]]
+    ok = tail[ie] != head[oe]
+    if phase == 1: # same way
+        ok &= ids[ie] == ids[oe]
+    through[ie[ok]] = oe[ok]
+
+    # two-way pass-through: in from and out to the same two neighbours
+    v = np.flatnonzero((indeg == 2) & (outdeg == 2))
+    i0, i1 = ins[in_ptr[v]], ins[in_ptr[v]+1]
+    o0, o1 = outs[out_ptr[v]], outs[out_ptr[v]+1]
+    swap = head[o0] != tail[i0]
+    o0, o1 = np.where(swap, o1, o0), np.where(swap, o0, o1)
+    ok = (tail[i0] != tail[i1]) & (head[o0] == tail[i0]) & (head[o1] == tail[i1])
+    if phase == 1: # all on the same way
+        ok &= (ids[i0] == ids[i1]) & (ids[i0] == ids[o0]) & (ids[i0] == ids[o1])
+    else: # all with the same name, and not explicitly one-way
+        ok &= (names[i0] >= 0) & (names[i0] == names[i1]) & (names[i0] == names[o0]) & (names[i0] == names[o1])
+        ok &= ~oneway[i0] & ~oneway[i1]
+    through[i0[ok]] = o1[ok]
+    through[i1[ok]] = o0[ok]
+
+    return through, alive, outs, out_ptr
+
+def contract_chains(w, phase):
+    # one round over the current graph. returns the number of nodes removed.
+    merge = replace_node_with_edge if phase == 1 else replace_node_with_edge_adv
+    tail, head, cols = w['tail'], w['head'], w['cols']
+    through, alive, outs, out_ptr = pass_through_nodes(w, phase)
+    deletable = np.zeros(len(w['removed']), dtype=bool)
+    deletable[head[np.flatnonzero(through >= 0)]] = True
+    removed = 0
+
+    def walk(e):
+        path = [e]
+        while deletable[head[path[-1]]] and (through[path[-1]] >= 0) and (through[path[-1]] != e):
+            path.append(through[path[-1]])
+        return path
+
+    def merge_path(path):
+        nonlocal removed
+        if len(path) < 2:
+            return
+        new = w['count']
+        w['count'] += 1
+        tail[new] = tail[path[0]]
+        head[new] = head[path[-1]]
+        w['alive'][new] = True
+        for k, v in merge(cols, np.array(path), w['road_class']).items():
+            cols[k][new] = v
+        w['alive'][path] = False
+        w['parent'][path] = new
+        for e in path[:-1]:
+            n = head[e]
+            if not w['removed'][n]:
+                w['removed'][n] = True
+                w['node_edge'][n] = new
+                removed += 1
+
+    def contract_from(e):
+        path = walk(e)
+        if tail[path[0]] == head[path[-1]]:
+            # the chain comes back to where it started. keep one interior node (the same one whichever
+            # direction it's walked in) so that no self loop is created
+            interior = [head[x] for x in path[:-1]]
+            k = int(np.argmax(interior))
+            merge_path(path[:k+1])
+            merge_path(path[k+1:])
         else:
-            last_count = current
-        
-    return g
-
+            merge_path(path)
+
+    # chains hanging off nodes that stay
+    for e in alive:
+        if w['alive'][e] and (not deletable[tail[e]]) and deletable[head[e]]:
+            contract_from(e)
+
+    # rings made only of pass-through nodes: keep the lowest node of each and contract from there
+    for n in np.flatnonzero(deletable & ~w['removed']):
+        if w['removed'][n]:
+            continue
+        deletable[n] = False
+        for e in outs[out_ptr[n]:out_ptr[n+1]]:
+            if w['alive'][e]:
+                contract_from(e)
+
+    # a merged edge may land on an existing one; like DiGraph.add_edge the newer edge wins
+    E = w['count']
+    live = np.flatnonzero(w['alive'][:E])
+    order = live[np.lexsort((live, head[live], tail[live]))]
+    dup = (tail[order][1:] == tail[order][:-1]) & (head[order][1:] == head[order][:-1])
+    w['alive'][order[:-1][dup]] = False
+    w['parent'][order[:-1][dup]] = order[1:][dup]
+
+    return removed
 
-def limits_left_to_infer(g):
-    count = 0
-    for edge in g.edges():
-        if 'maxspeed' not in g.edges[edge]['tags']:
-            count += 1
-    return count
+def simplify_graph(g):
+    # O(V+E) per round; extra rounds only happen when merged edges collapse onto existing ones
+    V = g.number_of_nodes()
+    E = g.number_of_edges()
+    w = {
+        'cols': {},
+        'tail': np.concatenate((g.tail, np.zeros(E+1, dtype=np.int64))),
+        'head': np.concatenate((g.head, np.zeros(E+1, dtype=np.int64))),
+        'alive': np.concatenate((np.ones(E, dtype=bool), np.zeros(E+1, dtype=bool))),
+        'parent': np.full(2*E+1, -1, dtype=np.int64), # edge that replaced a merged edge
+        'count': E,
+        'removed': np.zeros(V, dtype=bool),
+        'node_edge': np.full(V, -1, dtype=np.int64), # for each deleted node, the edge it was merged into
+        'road_class': np.array([ROAD_CLASS[h] for h in g.highways.strings])
+    }
+    for k, v in g.edges.items():
+        w['cols'][k] = np.zeros(2*E+1, dtype=v.dtype)
+        w['cols'][k][:E] = v
 
-def infer_speedlimits(g):
-#     g = g.copy()
-    # print('Reducing number of edges without speed limit information...')
-    last_count = limits_left_to_infer(g)
-    while True: # break statement at end of loop
-        # keep iterating until we fail to add any more 
-        for edge in g.edges():
-            if 'maxspeed' not in g.edges[edge]['tags']:
-                # search through other nodes to infer a plausible speed by taking the median speedlimit of neighboring edges
-                lims = []
-                for poss in (list(g.in_edges(edge[0])) + list(g.out_edges(edge[0])) + list(g.in_edges(edge[1])) + list(g.out_edges(edge[1]))):
-                    if g.edges[poss]['tags'].get('maxspeed'):
-                        lims.append(g.edges[poss]['tags']['maxspeed'])
-                if len(lims) > 0:
-                    g.edges[edge]['tags']['maxspeed'] = median(lims)
-#                     print(g.edges[edge]['maxspeed'])
-        
-        # break if we haven't been able to infer any more speed limits
-        unknowns_left = limits_left_to_infer(g)
-        # print(unknowns_left)
-        if last_count <= unknowns_left:
+    # PART I: only delete nodes in the middle of one-way streets, or two way streets that were originally broken up during graph creation
+    while contract_chains(w, phase=1) > 0:
+        pass
+    # PART II: run a more lenient iteration that deletes more nodes (same name instead of same way)
+    while contract_chains(w, phase=2) > 0:
+        pass
+
+    count = w['count']
+    alive = w['alive'][:count]
+    simple = RoadGraph(
+        g.node_ids, g.lon, g.lat,
+        w['tail'][:count], w['head'][:count],
+        {k: v[:count] for k, v in w['cols'].items()},
+        g.highways, g.names
+    ).subgraph(alive)
+
+    # follow merges through to the edge that survived, then to its index in the simplified graph
+    final = np.arange(count)
+    final[~alive] = w['parent'][:count][~alive]
+    while True:
+        nxt = final[final]
+        if np.array_equal(nxt, final):
             break
-        else:
-            last_count = unknowns_left
-            
-    return g
-
-def lanes_left_to_infer(g):
-    count = 0
-    for edge in g.edges():
-        if (g.edges[edge]['tags'].get('lanes',0)) == 0:
-            count += 1
-    return count
-
-def infer_lanes(g):
-    last_count = lanes_left_to_infer(g)
-
+        final = nxt
+    new_index = np.cumsum(alive) - 1
+    gone = np.flatnonzero(w['removed'])
+    simple.merged_nodes = g.node_ids[gone]
+    simple.merged_into = new_index[final[w['node_edge'][gone]]]
+
+    return simple
+
+def known_speeds(maxspeed):
+    return ~np.isnan(maxspeed) & (maxspeed != 0)
+
+def known_lanes(lanes):
+    return lanes > 0
+
+def neighbour_edges(g, e):
+    # edges into and out of both ends of e (e itself included, and edges between the two ends twice)
+    n1, n2 = g.tail[e], g.head[e]
+    return np.concatenate((g.in_edges(n1), g.out_edges(n1), g.in_edges(n2), g.out_edges(n2)))
+
+def infer_from_neighbours(g, rules):
+    # fill unknown edge values from the known values on neighbouring edges, for several columns in one traversal.
+    # rules are (column, known(values) -> mask, estimate(edge, known neighbour values) -> value).
+    # edges are visited in the same order as repeated sweeps over all unknown edges until nothing changes, so the
+    # results are identical, but a sweep only visits edges next to a value filled since they were last looked at:
+    # a newly filled edge wakes its later neighbours for this sweep and its earlier ones for the next.
+    E = g.number_of_edges()
+    columns = [g.edges[col] for col, known, estimate in rules]
+    unknown = np.array([~known(values) for values, (col, known, estimate) in zip(columns, rules)]).reshape(len(rules), E)
+
+    # start with the unknown edges that touch a known one
+    pending = np.zeros((len(rules), E), dtype=bool)
+    for r in range(len(rules)):
+        touched = np.zeros(g.number_of_nodes(), dtype=bool)
+        touched[g.tail[~unknown[r]]] = True
+        touched[g.head[~unknown[r]]] = True
+        pending[r] = unknown[r] & (touched[g.tail] | touched[g.head])
+
+    while pending.any():
+        sweep = np.flatnonzero(pending.any(axis=0)).tolist() # already a heap
+        queued = pending.any(axis=0)
+        upcoming = np.zeros_like(pending)
+        while sweep:
+            e = heappop(sweep)
+            neighbours = neighbour_edges(g, e)
+            for r, (col, known, estimate) in enumerate(rules):
+                if not pending[r, e]:
+                    continue
+                pending[r, e] = False
+                values = columns[r][neighbours]
+                columns[r][e] = estimate(e, values[~unknown[r][neighbours]].tolist())
+                if not known(columns[r][e:e+1])[0]:
+                    continue
+                unknown[r, e] = False
+                for f in neighbours[unknown[r][neighbours]].tolist():
+                    if f < e:
+                        upcoming[r, f] = True
+                    elif not pending[r, f]:
+                        pending[r, f] = True
+                        if not queued[f]:
+                            queued[f] = True
+                            heappush(sweep, f)
+        pending = upcoming
+
+def speedlimit_rule(g):
+    # a plausible speed is the median speedlimit of neighboring edges
+    return ('maxspeed', known_speeds, lambda edge, lims: median(lims))
+
+def lanes_rule(g):
     # ONE-WAY lane max dict
     maxlanes = { 
         'motorway' : 5,
@@ -336,40 +524,19 @@ def infer_lanes(g):
 #         'residential' : 1,
 #         'service' : 1
     }
-    
-    # print('Reducing number of edges without lane information...')
-
-    while True: # break statement at end of loop
-        # keep iterating until we fail to add any more 
-        for edge in g.edges():
-            if (g.edges[edge]['tags'].get('lanes',0)) == 0:
-                # search through other nodes to infer a plausible speed by taking the median lanes of neighboring edges
-                lans = []
-                for poss in (list(g.in_edges(edge[0])) + list(g.out_edges(edge[0])) + list(g.in_edges(edge[1])) + list(g.out_edges(edge[1]))):
-                    if g.edges[poss]['tags'].get('lanes',0) > 0:
-                        lans.append(g.edges[poss]['tags']['lanes'])
-                if len(lans) > 0:
-                    est = median(lans)
-                    
-                    # sanity check on estimated lanes
-                    typ = g.edges[edge]['tags']['highway']
-                    bound = 0
-                    if typ in maxlanes:
-                        bound = maxlanes[typ]
-                    # fallback if highway type isn't found, zero out edge
-                    if est > bound:
-                        est = bound
-                    
-                    g.edges[edge]['tags']['lanes'] = est
-        
-        # break if we haven't been able to infer any more speed lanes
-        unknowns_left = lanes_left_to_infer(g)
-        # print(unknowns_left)
-        if last_count <= unknowns_left:
-            break
-        else:
-            last_count = unknowns_left
-            
+    # fallback if highway type isn't found, zero out edge
+    bound = np.array([maxlanes.get(h, 0) for h in g.highways.strings])
+    highway = g.edges['highway']
+
+    # median lanes of neighboring edges, with a sanity check on estimated lanes
+    return ('lanes', known_lanes, lambda edge, lans: min(median(lans), bound[highway[edge]]))
+
+def infer_speedlimits(g):
+    infer_from_neighbours(g, [speedlimit_rule(g)])
+    return g
+
+def infer_lanes(g):
+    infer_from_neighbours(g, [lanes_rule(g)])
     return g
 
 def estimate_capacity(g):
@@ -386,72 +553,77 @@ def estimate_capacity(g):
 #         'residential' : 400,
 #         'service' : 400
     }
+    per_lane = np.array([capacity.get(h, 0) for h in g.highways.strings], dtype=float)
     
-    for edge in g.edges():
-#         if g.edges[edge]['tags']['highway'] in capacity:
-        g.edges[edge]['capacity'] = capacity.get(g.edges[edge]['tags']['highway'],0) * g.edges[edge]['tags']['lanes']
-#         else:
-#             print(g[n1][n2]['tags']['highway'])
-#             row['capacity'] = 0
+    g.edges['capacity'] = per_lane[g.edges['highway']] * g.edges['lanes']
 
 def estimate_fftime(g):
-    
-    for edge in g.edges():
-        g.edges[edge]['fftime'] = g.edges[edge]['length'] / g.edges[edge]['tags']['maxspeed']
+    if not known_speeds(g.edges['maxspeed']).all():
+        raise ValueError('could not infer a speed limit for every edge')
+    g.edges['fftime'] = g.edges['length'] / g.edges['maxspeed']
 
 def det_coeffs(g):
-    for n1,n2,e in g.edges(data=True):
-        typ = e['tags'].get('highway')
-
-        # values from a paper by Carlin and Gerry
-        g[n1][n2]['b'] = 0.7
-        g[n1][n2]['power'] = 0.4
-
-        # if (typ == "motorway") or (typ == "trunk"): # kinda like a 6-lane freeway
-        #     # approximated from http://onlinepubs.trb.org/onlinepubs/archive/NotesDocs/appxa.pdf
-        #     g[n1][n2]['b'] = 6
-        #     g[n1][n2]['power'] = 0.85
-        # elif typ == 'primary': # kinda like a 4-lane highway
-        #     # see above
-        #     g[n1][n2]['b'] = 3
-        #     g[n1][n2]['power'] = 0.85
-        # else:
-        #     # sourced from http://onlinepubs.trb.org/onlinepubs/archive/NotesDocs/appxa.pdf
-        #     g[n1][n2]['b'] = 4
-        #     g[n1][n2]['power'] = 0.15
-
-def read_osm_and_make_graph(filename):
-    nodes, ways = read_osm(filename)
+    # values from a paper by Carlin and Gerry
+    g.edges['b'] = np.full(g.number_of_edges(), 0.7)
+    g.edges['power'] = np.full(g.number_of_edges(), 0.4)
+
+    # if (typ == "motorway") or (typ == "trunk"): # kinda like a 6-lane freeway
+    #     # approximated from http://onlinepubs.trb.org/onlinepubs/archive/NotesDocs/appxa.pdf
+    #     g[n1][n2]['b'] = 6
+    #     g[n1][n2]['power'] = 0.85
+    # elif typ == 'primary': # kinda like a 4-lane highway
+    #     # see above
+    #     g[n1][n2]['b'] = 3
+    #     g[n1][n2]['power'] = 0.85
+    # else:
+    #     # sourced from http://onlinepubs.trb.org/onlinepubs/archive/NotesDocs/appxa.pdf
+    #     g[n1][n2]['b'] = 4
+    #     g[n1][n2]['power'] = 0.15
+
+def read_osm_and_make_graph(filename, streaming=True, lengths='geodesic', timings=None):
+    # streaming: use the two-pass reader that only keeps nodes on whitelisted ways (.osm.pbf files always stream)
+    # lengths: 'geodesic' or 'haversine', see calc_length
+    # timings: optional dict, filled with the seconds spent in each stage
+    # returns a RoadGraph; call to_networkx() on it for the rest of the app
+    if timings is None:
+        timings = {}
+    start = time()
+    def stage(name):
+        nonlocal start
+        now = time()
+        timings[name] = now - start
+        start = now
+
+    if filename.endswith('.pbf'):
+        nodes, ways = read_osm_pbf(filename)
+    elif streaming:
+        nodes, ways = read_osm_streaming(filename)
+    else:
+        nodes, ways = read_osm(filename)
+    stage('read')
     g = construct_graph(nodes, ways)
+    del nodes, ways
+    stage('construct')
 
-    eo = len(g.edges())
-    no = len(g.nodes())
+    eo = g.number_of_edges()
+    no = g.number_of_nodes()
 
-    calc_length(g)
+    calc_length(g, lengths)
+    stage('length')
     g = simplify_graph(g)
-    infer_speedlimits(g)
-    infer_lanes(g)
+    stage('simplify')
+    infer_from_neighbours(g, [speedlimit_rule(g), lanes_rule(g)])
+    stage('infer')
     estimate_capacity(g)
     estimate_fftime(g)
     det_coeffs(g) # TODO: make user-editable
+    stage('attributes')
 
-    es = len(g.edges())
-    ns = len(g.nodes())
+    es = g.number_of_edges()
+    ns = g.number_of_nodes()
 
     # find centroid
-    mlon = np.mean([g.nodes[n]['lon'] for n in g.nodes()])
-    mlat = np.mean([g.nodes[n]['lat'] for n in g.nodes()])
-
-    # clean up graph to save memory
-    for edge in g.edges():
-        g.edges[edge]['maxspeed'] = g.edges[edge]['tags'].get('maxspeed',0)
-        g.edges[edge]['lanes'] = g.edges[edge]['tags'].get('lanes',0)
-        g.edges[edge]['name'] = g.edges[edge]['tags'].get('name',0)
-        del g.edges[edge]['tags']
-        g.edges[edge].pop('uid', None)
-    
-    # mark not TAZs
-    for node in g.nodes():
-        g.nodes[node]['taz'] = False
+    mlon = np.mean(g.lon)
+    mlat = np.mean(g.lat)
 
     return g, eo, no, es, ns, mlon, mlat
@@ -0,0 +1,257 @@
+# reads OSM .pbf extracts (https://wiki.openstreetmap.org/wiki/PBF_Format) with blobs decoded in a process pool.
+# the file is memory-mapped and only blob offsets are sent to the workers; ways are filtered inside the workers
+# and the node pass only returns nodes that the kept ways reference, so little data crosses process boundaries.
+# a minimal protobuf wire decoder is used instead of osmread's generated classes, which pin an old protobuf.
+
+import mmap
+import zlib
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from struct import unpack_from
+
+SUPPORTED_FEATURES = {'OsmSchema-V0.6', 'DenseNodes'}
+
+# protobuf wire decoding
+
+def read_varint(buf, pos):
+    result = 0
+    shift = 0
+    while True:
+        b = buf[pos]
+        pos += 1
+        result |= (b & 0x7f) << shift
+        if b < 0x80:
+            return result, pos
+        shift += 7
+
+def iter_fields(buf, pos=0, end=None):
+    # yields (field number, value) where value is an int for varints and a memoryview for length-delimited fields
+    if end is None:
+        end = len(buf)
+    while pos < end:
+        key, pos = read_varint(buf, pos)
+        field, wire_type = key >> 3, key & 0x7
+        if wire_type == 0:
+            value, pos = read_varint(buf, pos)
+        elif wire_type == 2:
+            size, pos = read_varint(buf, pos)
+            value = buf[pos:pos+size]
+            pos += size
+        elif wire_type == 1:
+            value = buf[pos:pos+8]
+            pos += 8
+        elif wire_type == 5:
+            value = buf[pos:pos+4]
+            pos += 4
+        else:
+            raise ValueError('unsupported protobuf wire type {}'.format(wire_type))
+        yield field, value
+
+def packed_varints(data):
+    # decode a packed repeated varint field in one go
+    b = np.frombuffer(data, dtype=np.uint8)
+    if len(b) == 0:
+        return np.zeros(0, dtype=np.uint64)
+    ends = np.flatnonzero(b < 0x80)
+    starts = np.concatenate(([0], ends[:-1] + 1))
+    group = np.repeat(np.arange(len(ends)), ends - starts + 1)
+    shift = ((np.arange(len(b)) - starts[group]) * 7).astype(np.uint64)
+    return np.bitwise_or.reduceat((b & 0x7f).astype(np.uint64) << shift, starts)
+
+def zigzag(v):
+    return (v >> np.uint64(1)).astype(np.int64) ^ -(v & np.uint64(1)).astype(np.int64)
+
+def signed(v):
+    # plain (non-zigzag) int64 varint
+    return v - (1 << 64) if v >= (1 << 63) else v
+
+# file layout
+
+def blob_data(buf, offset, size):
+    raw = None
+    zdata = None
+    for field, value in iter_fields(buf, offset, offset+size):
+        if field == 1:
+            raw = value
+        elif field == 3:
+            zdata = value
+    if raw is not None:
+        return bytes(raw)
+    if zdata is not None:
+        return zlib.decompress(zdata)
+    raise ValueError('unsupported pbf blob compression')
+
+def blob_offsets(buf):
+    # walk the BlobHeaders and return (offset, size) of every OSMData blob
+    offsets = []
+    pos = 0
+    while pos < len(buf):
+        header_size = unpack_from('!L', buf, pos)[0]
+        pos += 4
+        blob_type = None
+        datasize = 0
+        for field, value in iter_fields(buf, pos, pos+header_size):
+            if field == 1:
+                blob_type = bytes(value).decode('utf-8')
+            elif field == 3:
+                datasize = value
+        pos += header_size
+
+        if blob_type == 'OSMHeader':
+            header = memoryview(blob_data(buf, pos, datasize))
+            for field, value in iter_fields(header):
+                if (field == 4) and (bytes(value).decode('utf-8') not in SUPPORTED_FEATURES):
+                    raise ValueError('pbf requires unsupported feature {}'.format(bytes(value).decode('utf-8')))
+        elif blob_type == 'OSMData':
+            offsets.append((pos, datasize))
+        pos += datasize
+    return offsets
+
+def primitive_block(data):
+    # split a PrimitiveBlock into its string table, group messages and coordinate scaling
+    block = {
+        'strings': [],
+        'groups': [],
+        'granularity': 100,
+        'lat_offset': 0,
+        'lon_offset': 0
+    }
+    for field, value in iter_fields(data):
+        if field == 1:
+            block['strings'] = [bytes(s) for f, s in iter_fields(value) if f == 1]
+        elif field == 2:
+            block['groups'].append(value)
+        elif field == 17:
+            block['granularity'] = value
+        elif field == 19:
+            block['lat_offset'] = signed(value)
+        elif field == 20:
+            block['lon_offset'] = signed(value)
+    return block
+
+def decode_tags(strings, keys, vals):
+    return {strings[k].decode('utf-8'): strings[v].decode('utf-8') for k, v in zip(keys.tolist(), vals.tolist())}
+
+def decode_ways(block, group, tag_filter):
+    ways = []
+    for field, way in iter_fields(group):
+        if field != 3:
+            continue
+        wid = 0
+        uid = 0
+        keys = vals = refs = np.zeros(0, dtype=np.uint64)
+        for f, value in iter_fields(way):
+            if f == 1:
+                wid = signed(value)
+            elif f == 2:
+                keys = packed_varints(value)
+            elif f == 3:
+                vals = packed_varints(value)
+            elif f == 4:
+                for i, info in iter_fields(value):
+                    if i == 4:
+                        uid = info
+            elif f == 8:
+                refs = packed_varints(value)
+        tags = tag_filter(decode_tags(block['strings'], keys, vals))
+        if tags is not None:
+            ways.append((wid, uid, tags, np.cumsum(zigzag(refs))))
+    return ways
+
+def decode_nodes(block, group):
+    # (ids, lon, lat) of the dense and plain nodes in a group, in nanodegree units before scaling
+    ids, lats, lons = [], [], []
+    for field, value in iter_fields(group):
+        if field == 2: # DenseNodes
+            for f, packed in iter_fields(value):
+                if f == 1:
+                    ids.append(np.cumsum(zigzag(packed_varints(packed))))
+                elif f == 8:
+                    lats.append(np.cumsum(zigzag(packed_varints(packed))))
+                elif f == 9:
+                    lons.append(np.cumsum(zigzag(packed_varints(packed))))
+        elif field == 1: # plain Node
+            node = {f: v for f, v in iter_fields(value) if f in (1, 8, 9)}
+            ids.append(zigzag(np.array([node.get(1, 0)], dtype=np.uint64)))
+            lats.append(zigzag(np.array([node.get(8, 0)], dtype=np.uint64)))
+            lons.append(zigzag(np.array([node.get(9, 0)], dtype=np.uint64)))
+    if not ids:
+        return None
+    scale = block['granularity'] * 1e-9
+    ids = np.concatenate(ids)
+    lon = np.concatenate(lons) * scale + block['lon_offset'] * 1e-9
+    lat = np.concatenate(lats) * scale + block['lat_offset'] * 1e-9
+    return ids, lon, lat
+
+# worker side. each worker maps the file once and keeps what it needs in globals.
+
+worker_state = {}
+
+def init_worker(filepath, tag_filter=None, needed=None):
+    f = open(filepath, 'rb')
+    worker_state['buf'] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    worker_state['tag_filter'] = tag_filter
+    worker_state['needed'] = needed
+
+def read_block_ways(blob):
+    block = primitive_block(memoryview(blob_data(worker_state['buf'], *blob)))
+    ways = []
+    has_nodes = False
+    for group in block['groups']:
+        field = next(iter_fields(group), (None, None))[0]
+        if field in (1, 2):
+            has_nodes = True
+        elif field == 3:
+            ways.extend(decode_ways(block, group, worker_state['tag_filter']))
+    return ways, has_nodes
+
+def read_block_nodes(blob):
+    block = primitive_block(memoryview(blob_data(worker_state['buf'], *blob)))
+    needed = worker_state['needed']
+    found = []
+    for group in block['groups']:
+        nodes = decode_nodes(block, group)
+        if nodes is None:
+            continue
+        ids, lon, lat = nodes
+        i = np.minimum(np.searchsorted(needed, ids), len(needed)-1)
+        keep = needed[i] == ids
+        found.append((ids[keep], lon[keep], lat[keep]))
+    return found
+
+def read_pbf(filepath, tag_filter, processes=None):
+    # tag_filter(tags) returns the tags to keep for a way, or None to drop it. it runs in the workers so
+    # must be a module-level function. returns sorted node ids with their lon/lat arrays and the kept
+    # ways as (id, uid, tags, node ids) tuples in file order.
+
+    with open(filepath, 'rb') as f:
+        buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        blobs = blob_offsets(buf)
+        buf.close()
+
+    # first pass: filtered ways, and which blobs hold nodes at all
+    ways = []
+    node_blobs = []
+    with ProcessPoolExecutor(processes, initializer=init_worker, initargs=(filepath, tag_filter)) as pool:
+        for blob, (block_ways, has_nodes) in zip(blobs, pool.map(read_block_ways, blobs)):
+            ways.extend(block_ways)
+            if has_nodes:
+                node_blobs.append(blob)
+
+    # second pass: coordinates of the referenced nodes only
+    if ways:
+        needed = np.unique(np.concatenate([w[3] for w in ways]))
+    else:
+        needed = np.zeros(0, dtype=np.int64)
+    ids, lon, lat = [needed[:0]], [np.zeros(0)], [np.zeros(0)]
+    if len(needed):
+        with ProcessPoolExecutor(processes, initializer=init_worker, initargs=(filepath, None, needed)) as pool:
+            for found in pool.map(read_block_nodes, node_blobs):
+                for block_ids, block_lon, block_lat in found:
+                    ids.append(block_ids)
+                    lon.append(block_lon)
+                    lat.append(block_lat)
+
+    ids = np.concatenate(ids)
+    order = np.argsort(ids, kind='stable')
+    return ids[order], np.concatenate(lon)[order], np.concatenate(lat)[order], ways
@@ -0,0 +1,150 @@
+import networkx as nx
+import numpy as np
+
+class StringTable(object):
+    # interns repeated strings (road classes, street names) as small integer codes. code -1 means no value.
+
+    def __init__(self, strings=()):
+        self.strings = []
+        self.codes = {}
+        for s in strings:
+            self.code(s)
+
+    def code(self, s):
+        if not s:
+            return -1
+        if s not in self.codes:
+            self.codes[s] = len(self.strings)
+            self.strings.append(s)
+        return self.codes[s]
+
+    def lookup(self, codes):
+        return [self.strings[c] if c >= 0 else None for c in codes]
+
+    def __len__(self):
+        return len(self.strings)
+
+class RoadGraph(object):
+    # directed road network held as numpy columns instead of a networkx DiGraph of per-edge dicts.
+    # nodes are indexed 0..V-1 (node_ids holds the osm ids), edges 0..E-1 with tail/head node indices.
+    # edge attributes live in the `edges` dict of equal-length arrays. unknown maxspeed is nan, unknown lanes 0.
+    # highway/name columns hold codes into the `highways`/`names` string tables.
+    # out_ptr/out_idx (CSR, by tail) and in_ptr/in_idx (CSC, by head) list the edges at every node.
+    # merged_nodes/merged_into map osm ids of nodes removed by simplification to the edge they were merged into.
+
+    def __init__(self, node_ids, lon, lat, tail, head, edges, highways, names):
+        self.node_ids = np.asarray(node_ids, dtype=np.int64)
+        self.lon = np.asarray(lon, dtype=float)
+        self.lat = np.asarray(lat, dtype=float)
+        self.tail = np.asarray(tail, dtype=np.int64)
+        self.head = np.asarray(head, dtype=np.int64)
+        self.edges = edges
+        self.highways = highways
+        self.names = names
+        self.merged_nodes = np.zeros(0, dtype=np.int64)
+        self.merged_into = np.zeros(0, dtype=np.int64)
+        self.build_adjacency()
+
+    def number_of_nodes(self):
+        return len(self.node_ids)
+
+    def number_of_edges(self):
+        return len(self.tail)
+
+    def build_adjacency(self):
+        V = self.number_of_nodes()
+        self.out_idx = np.argsort(self.tail, kind='stable')
+        self.out_ptr = np.zeros(V+1, dtype=np.int64)
+        np.cumsum(np.bincount(self.tail, minlength=V), out=self.out_ptr[1:])
+        self.in_idx = np.argsort(self.head, kind='stable')
+        self.in_ptr = np.zeros(V+1, dtype=np.int64)
+        np.cumsum(np.bincount(self.head, minlength=V), out=self.in_ptr[1:])
+
+    def out_edges(self, v):
+        return self.out_idx[self.out_ptr[v]:self.out_ptr[v+1]]
+
+    def in_edges(self, v):
+        return self.in_idx[self.in_ptr[v]:self.in_ptr[v+1]]
+
+    def out_degree(self):
+        return np.diff(self.out_ptr)
+
+    def in_degree(self):
+        return np.diff(self.in_ptr)
+
+    def subgraph(self, edge_mask):
+        # keep the selected edges and the nodes they touch
+        edge_mask = np.asarray(edge_mask, dtype=bool)
+        tail = self.tail[edge_mask]
+        head = self.head[edge_mask]
+        keep = np.zeros(self.number_of_nodes(), dtype=bool)
+        keep[tail] = True
+        keep[head] = True
+        new_index = np.cumsum(keep) - 1
+        return RoadGraph(
+            self.node_ids[keep], self.lon[keep], self.lat[keep],
+            new_index[tail], new_index[head],
+            {k: v[edge_mask] for k, v in self.edges.items()},
+            self.highways, self.names
+        )
+
+    def to_networkx(self):
+        # the DiGraph the rest of the app (geojson export, TAZs, traffic, assignment) works with
+        g = nx.DiGraph()
+        g.add_nodes_from(
+            (n, {'lat': lat, 'lon': lon, 'taz': False})
+            for n, lon, lat in zip(self.node_ids.tolist(), self.lon.tolist(), self.lat.tolist())
+        )
+
+        def as_number(values):
+            # whole numbers back to ints, unknowns to 0
+            values = np.where(np.isnan(values), 0, values)
+            return [int(v) if v.is_integer() else v for v in values.tolist()]
+
+        names = [0 if n is None else n for n in self.names.lookup(self.edges['name'].tolist())]
+        highways = self.highways.lookup(self.edges['highway'].tolist())
+        attrs = zip(
+            self.edges['way_id'].tolist(),
+            self.edges['length'].tolist(),
+            self.edges['capacity'].tolist(),
+            self.edges['fftime'].tolist(),
+            self.edges['b'].tolist(),
+            self.edges['power'].tolist(),
+            as_number(self.edges['maxspeed']),
+            as_number(self.edges['lanes']),
+            names,
+            highways
+        )
+        keys = ('id', 'length', 'capacity', 'fftime', 'b', 'power', 'maxspeed', 'lanes', 'name', 'highway')
+        ids = self.node_ids.tolist()
+        g.add_edges_from(
+            (ids[n1], ids[n2], dict(zip(keys, a)))
+            for n1, n2, a in zip(self.tail.tolist(), self.head.tolist(), attrs)
+        )
+        return g
+
+def save_road_graph(g, f, **extra):
+    # write the graph (and any extra arrays/scalars) to a single uncompressed .npz, which loads without parsing
+    arrays = {
+        'node_ids': g.node_ids, 'lon': g.lon, 'lat': g.lat, 'tail': g.tail, 'head': g.head,
+        'highways': np.array(g.highways.strings, dtype=str), 'names': np.array(g.names.strings, dtype=str),
+        'merged_nodes': g.merged_nodes, 'merged_into': g.merged_into
+    }
+    for k, v in g.edges.items():
+        arrays['edge_' + k] = v
+    for k, v in extra.items():
+        arrays['extra_' + k] = np.asarray(v)
+    np.savez(f, **arrays)
+
+def load_road_graph(f):
+    # returns the graph and a dict of the extras it was saved with
+    with np.load(f) as data:
+        g = RoadGraph(
+            data['node_ids'], data['lon'], data['lat'], data['tail'], data['head'],
+            {k[len('edge_'):]: data[k] for k in data.files if k.startswith('edge_')},
+            StringTable(data['highways'].tolist()), StringTable(data['names'].tolist())
+        )
+        g.merged_nodes = data['merged_nodes']
+        g.merged_into = data['merged_into']
+        extra = {k[len('extra_'):]: data[k][()] for k in data.files if k.startswith('extra_')}
+    return g, extra
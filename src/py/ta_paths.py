@@ -0,0 +1,285 @@
+# path-based traffic assignment by gradient projection (Jayakrishnan et al. 1994), for equilibria much tighter
+# than the frank-wolfe solvers in ta_solver.py reach in reasonable time. every od pair keeps the set of paths it
+# uses; an iteration goes origin by origin, adding each od pair's current shortest path to its set and moving
+# flow from its costlier paths onto its cheapest one until their costs are equal. the path sets are returned, so
+# a re-run of a slightly changed scenario starts from them rather than from scratch.
+
+import numpy as np
+from time import time
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import dijkstra
+
+from src.py.ta_solver import AON_BATCH_CELLS, create_graph, link_cost_functions
+
+# regula falsi steps per flow shift between two paths
+SHIFT_STEPS = 4
+
+def od_pairs(travel_demand):
+    # origin -> (destinations, trips) of an od table, leaving out trips within a zone since they load no links
+    od = csr_matrix(travel_demand, dtype=float).tocoo()
+    keep = (od.row != od.col) & (od.data > 0)
+    rows, cols, trips = od.row[keep], od.col[keep], od.data[keep]
+    order = np.lexsort((cols, rows))
+    rows, cols, trips = rows[order], cols[order], trips[order]
+    bounds = np.flatnonzero(np.diff(rows)) + 1
+    return {int(r[0]): (c, t) for r, c, t in zip(np.split(rows, bounds), np.split(cols, bounds), np.split(trips, bounds))
+            if len(r)}
+
+def scaled_path_set(old, destinations, trips):
+    # a previous run's path set for one origin, with each od pair's path flows scaled to its trips now. od pairs
+    # gone from the table are dropped
+    pos = np.minimum(np.searchsorted(destinations, old['destinations']), len(destinations) - 1)
+    found = destinations[pos] == old['destinations']
+    old_trips = np.bincount(old['od'], weights=old['flow'], minlength=len(old['destinations']))
+    keep = found[old['od']] & (old['flow'] > 0)
+    od = pos[old['od'][keep]]
+    return {
+        'destinations': destinations,
+        'trips': trips,
+        'paths': [p for p, k in zip(old['paths'], keep) if k],
+        'od': od,
+        'flow': old['flow'][keep] * trips[od] / old_trips[old['od'][keep]]
+    }
+
+def flatten(path_set):
+    # the links of all paths end to end, with each path's length and start
+    lengths = np.array([len(p) for p in path_set['paths']], dtype=np.int64)
+    links = np.concatenate(path_set['paths']) if path_set['paths'] else np.zeros(0, dtype=np.int64)
+    return links, lengths, np.cumsum(lengths) - lengths
+
+def ta_gradient_projection(ta_data, tol=1e-6, max_iter_no=2000, paths0=None, progress=None, time_budget=None, log=False):
+    # ta_data as load_ta_network makes it. paths0: path sets from a previous run on the same links, e.g. of a
+    # scenario with a slightly different od table. od pairs new to this one start on their shortest path.
+    # progress(k, rel_gap, objective): called after each iteration's gap is computed. rel_gap is the relative gap,
+    # as ta_frank_wolfe tests it: how much the total travel time is over what it would be with every trip on a
+    # shortest path at the current times.
+    # stops once rel_gap < tol, after max_iter_no iterations or after time_budget seconds, whichever comes first.
+    # returns the same as ta_frank_wolfe, plus the path sets: origin -> {destinations, trips, paths (arrays of
+    # link indices), od (each path's index in destinations), flow (on each path)}
+    start_time = time()
+
+    number_of_nodes = ta_data['number_of_nodes']
+    number_of_links = ta_data['number_of_links']
+    start_node = ta_data['start_node']
+    end_node = ta_data['end_node']
+    travel_time = ta_data['travel_time']
+
+    graph, order = create_graph(start_node, end_node, number_of_nodes)
+    link_keys = start_node[order] * number_of_nodes + end_node[order]
+    link_ids = order
+
+    fixed_flow, BPR, objective, _ = link_cost_functions(ta_data)
+
+    pairs = od_pairs(ta_data['travel_demand'])
+    origins = np.array(sorted(pairs), dtype=np.int64)
+    batch = max(1, AON_BATCH_CELLS // number_of_nodes)
+    chunks = [origins[i:i+batch] for i in range(0, len(origins), batch)]
+
+    path_sets = {}
+    for origin, (destinations, trips) in pairs.items():
+        if paths0 and (origin in paths0):
+            path_sets[origin] = scaled_path_set(paths0[origin], destinations, trips)
+        else:
+            path_sets[origin] = {'destinations': destinations, 'trips': trips, 'paths': [],
+                                 'od': np.zeros(0, dtype=np.int64), 'flow': np.zeros(0)}
+    is_warm = any(len(s['paths']) for s in path_sets.values())
+
+    def link_flows():
+        # recomputed from the path flows every iteration, so round-off in the link flows doesn't build up
+        x = np.zeros(number_of_links)
+        for s in path_sets.values():
+            links, lengths, _ = flatten(s)
+            x += np.bincount(links, weights=np.repeat(s['flow'], lengths), minlength=number_of_links)
+        return x
+
+    def shortest_paths(times, chunk, predecessors):
+        graph.data[:] = times[order]
+        return dijkstra(graph, indices=chunk, return_predecessors=predecessors)
+
+    def path_links(pred, origin, destination):
+        nodes = [destination]
+        while nodes[-1] != origin:
+            nodes.append(pred[nodes[-1]])
+        nodes = np.array(nodes[::-1], dtype=np.int64)
+        return link_ids[np.searchsorted(link_keys, nodes[:-1] * number_of_nodes + nodes[1:])]
+
+    def add_shortest_paths(s, origin, times, dist, pred, unassigned_only):
+        # adds the shortest path of each od pair whose paths all cost more than it (by over tol/10), carrying the
+        # trips not yet on any path (all of them for a new od pair, none otherwise). unreachable destinations get
+        # no path.
+        # returns the change in link flows
+        destinations = s['destinations']
+        shortest = dist[destinations]
+        assigned = np.bincount(s['od'], weights=s['flow'], minlength=len(destinations))
+        if unassigned_only:
+            new = (assigned == 0) & np.isfinite(shortest)
+        else:
+            links, lengths, starts = flatten(s)
+            cheapest = np.full(len(destinations), np.inf)
+            if len(links):
+                np.minimum.at(cheapest, s['od'], np.add.reduceat(times[links], starts))
+            new = np.isfinite(shortest) & (cheapest - shortest > 0.1 * tol * shortest)
+        dx = np.zeros(number_of_links)
+        for i in np.flatnonzero(new):
+            links = path_links(pred, origin, destinations[i])
+            flow = s['trips'][i] if assigned[i] == 0 else 0.0
+            s['paths'].append(links)
+            dx[links] += flow
+            s['od'] = np.append(s['od'], i)
+            s['flow'] = np.append(s['flow'], flow)
+        return dx
+
+    def equalizing_shift(links, signs, flows, excess, flow):
+        # the flow to move from a costlier path onto a cheaper one to equalize their costs, at most all of it. links
+        # are those on only one of the two, with their signs (1 on the costlier, -1 on the cheaper) and flows. the
+        # cost difference falls as flow moves, so its root is bracketed and found by regula falsi (illinois). this
+        # rather than a newton step since BPR powers below 1, as networks here have, make the derivative infinite
+        # on empty links
+        def difference(shift):
+            return np.dot(signs, BPR(np.maximum(flows - signs*shift, 0), links))
+
+        hi, g_hi = flow, difference(flow)
+        if g_hi >= 0:
+            return flow
+        lo, g_lo = 0.0, excess
+        side = 0
+        for _ in range(SHIFT_STEPS):
+            shift = lo + g_lo * (hi - lo) / (g_lo - g_hi)
+            g = difference(shift)
+            if g > 0:
+                lo, g_lo = shift, g
+                if side > 0:
+                    g_hi /= 2
+                side = 1
+            elif g < 0:
+                hi, g_hi = shift, g
+                if side < 0:
+                    g_lo /= 2
+                side = -1
+            else:
+                return shift
+        return lo + g_lo * (hi - lo) / (g_lo - g_hi)
+
+    on_path = np.zeros(number_of_links, dtype=bool)
+
+    def shift_flows(s, x):
+        # od pair by od pair, moves flow from each path onto the cheapest of the pair's paths until their costs are
+        # equal (or it has none left), updating x as it goes. pairs whose paths in use already cost about the same
+        # (within tol/10, which keeps their part of the gap well under tol) are left as they are
+        od = s['od']
+        counts = np.bincount(od, minlength=len(s['destinations']))
+        if counts.max(initial=0) < 2:
+            return
+        links, lengths, starts = flatten(s)
+        cost = np.add.reduceat(BPR(x[links], links), starts)
+        lowest = np.full(len(counts), np.inf)
+        highest = np.zeros(len(counts))
+        np.minimum.at(lowest, od, cost)
+        np.maximum.at(highest, od, np.where(s['flow'] > 0, cost, 0))
+        equal = 0.1 * tol * lowest
+        unequal = (counts > 1) & (highest - lowest > equal)
+
+        by_od = np.split(np.argsort(od, kind='stable'), np.cumsum(counts)[:-1])
+        flow = s['flow']
+        for i in np.flatnonzero(unequal):
+            # the pairs before this one have moved flow since the costs above
+            members = by_od[i]
+            member_links = np.concatenate([s['paths'][m] for m in members])
+            member_cost = np.add.reduceat(BPR(x[member_links], member_links), np.cumsum(lengths[members]) - lengths[members])
+            cheapest = members[np.argmin(member_cost)]
+            cheapest_links = s['paths'][cheapest]
+            for m, excess in zip(members, member_cost - member_cost.min()):
+                if (m == cheapest) or (flow[m] == 0) or (excess <= equal[i]):
+                    continue
+                path = s['paths'][m]
+                # only the links the two paths don't share change the difference
+                on_path[path] = True
+                cheaper = cheapest_links[~on_path[cheapest_links]]
+                on_path[path] = False
+                on_path[cheapest_links] = True
+                costlier = path[~on_path[path]]
+                on_path[cheapest_links] = False
+
+                pair_links = np.concatenate((costlier, cheaper))
+                signs = np.concatenate((np.ones(len(costlier)), -np.ones(len(cheaper))))
+                pair_flows = x[pair_links]
+                excess = np.dot(signs, BPR(pair_flows, pair_links))
+                if excess > 0:
+                    shift = equalizing_shift(pair_links, signs, pair_flows, excess, flow[m])
+                    flow[m] -= shift
+                    flow[cheapest] += shift
+                    x[pair_links] = np.maximum(pair_flows - signs*shift, 0)
+
+        # drop paths left without flow, other than the cheapest
+        keep = (flow > 0) | (cost == lowest[od])
+        if not keep.all():
+            s['paths'] = [p for p, k in zip(s['paths'], keep) if k]
+            s['od'] = od[keep]
+            s['flow'] = flow[keep]
+
+    # finding a starting feasible solution: the od pairs without paths go on their shortest ones
+    x = link_flows()
+    if is_warm:
+        times = BPR(x)
+    elif travel_time.any():
+        times = travel_time
+    else:
+        times = BPR(np.zeros(number_of_links))
+    for chunk in chunks:
+        dist, pred = shortest_paths(times, chunk, True)
+        for row, origin in enumerate(chunk):
+            x += add_shortest_paths(path_sets[origin], origin, times, dist[row], pred[row], True)
+
+    trace = {'gap': [], 'objective': []}
+    stopped = 'max_iter'
+    k = 0
+    for k in range(1, max_iter_no+1):
+        x = link_flows()
+        times = BPR(x)
+
+        # relative gap, from the shortest paths at the current times
+        total_time = np.dot(x, times)
+        shortest_time = 0.0
+        for chunk in chunks:
+            dist = shortest_paths(times, chunk, False)
+            for row, origin in enumerate(chunk):
+                shortest = dist[row, path_sets[origin]['destinations']]
+                reachable = np.isfinite(shortest)
+                shortest_time += np.dot(path_sets[origin]['trips'][reachable], shortest[reachable])
+        rel_gap = max(0.0, (total_time - shortest_time) / total_time) if total_time > 0 else 0.0
+        obj = objective(x)
+        if log:
+            print('k={:4d}, objective={:15f}, rel_gap={:15.10e}'.format(k, obj, rel_gap))
+
+        trace['gap'].append(rel_gap)
+        trace['objective'].append(obj)
+        if progress is not None:
+            progress(k, rel_gap, obj)
+        if rel_gap < tol:
+            stopped = 'converged'
+            break
+
+        # one pass over the origins, each seeing the flows the ones before it moved
+        for chunk in chunks:
+            times = BPR(x)
+            dist, pred = shortest_paths(times, chunk, True)
+            for row, origin in enumerate(chunk):
+                s = path_sets[origin]
+                x += add_shortest_paths(s, origin, times, dist[row], pred[row], False)
+                shift_flows(s, x)
+
+        if (time_budget is not None) and (time() - start_time > time_budget):
+            stopped = 'time_budget'
+            break
+
+    x = link_flows()
+    stats = {
+        'iterations': k,
+        'warm_start': is_warm,
+        'stopped': stopped,
+        'gap': trace['gap'][-1] if trace['gap'] else None,
+        'trace': trace,
+        'paths': sum(len(s['paths']) for s in path_sets.values())
+    }
+
+    return x, BPR(x), objective(x), fixed_flow, stats, path_sets
@@ -0,0 +1,331 @@
+# in-process port of the frank-wolfe solver in src/jl/traffic_assignment.jl
+# (itself modified from https://github.com/chkwon/TrafficAssignment.jl)
+# runs on numpy arrays and a scipy CSR graph so no julia startup/JIT or csv round-trip is needed
+
+import numpy as np
+from time import time
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import dijkstra
+
+# upper bound on origins x nodes handled by one batched dijkstra call
+AON_BATCH_CELLS = 2**24
+
+def load_ta_network(dfn, number_of_zones, number_of_nodes, travel_demand,
+                    toll_factor=0.0, distance_factor=0.0, travel_time_initialization=None, fftime='fftime'):
+    # dfn has the same columns as the net.csv consumed by traffic_assignment.jl (1-indexed tail/head).
+    # travel_demand: zones x zones, dense or a scipy sparse matrix; it's kept as CSR
+    number_of_links = len(dfn)
+    assert number_of_links > 0
+
+    travel_demand = csr_matrix(travel_demand, dtype=float)
+    assert travel_demand.shape == (number_of_zones, number_of_zones)
+    assert travel_demand.sum() > 0
+
+    if travel_time_initialization is not None:
+        travel_time = dfn[travel_time_initialization].to_numpy(dtype=float)
+    else:
+        travel_time = np.zeros(number_of_links)
+
+    return {
+        'number_of_zones': number_of_zones,
+        'number_of_nodes': number_of_nodes,
+        'number_of_links': number_of_links,
+        'start_node': dfn['tail'].to_numpy(dtype=np.int64) - 1, # 0-indexed from here on
+        'end_node': dfn['head'].to_numpy(dtype=np.int64) - 1,
+        'capacity': dfn['capacity'].to_numpy(dtype=float),
+        'link_length': dfn['length'].to_numpy(dtype=float),
+        'free_flow_time': dfn[fftime].to_numpy(dtype=float),
+        'B': dfn['b'].to_numpy(dtype=float),
+        'power': dfn['power'].to_numpy(dtype=float),
+        'toll': dfn['toll'].to_numpy(dtype=float),
+        'travel_demand': travel_demand,
+        'toll_factor': toll_factor,
+        'distance_factor': distance_factor,
+        'travel_time': travel_time
+    }
+
+def create_graph(start_node, end_node, number_of_nodes):
+    # CSR adjacency whose data array is overwritten with link costs before each shortest path run.
+    # built by hand so that zero-cost links (e.g. TAZ connectors) stay as explicit edges.
+    order = np.lexsort((end_node, start_node))
+    indptr = np.zeros(number_of_nodes+1, dtype=np.int64)
+    np.cumsum(np.bincount(start_node, minlength=number_of_nodes), out=indptr[1:])
+    graph = csr_matrix((np.zeros(len(order)), end_node[order], indptr), shape=(number_of_nodes, number_of_nodes))
+    return graph, order
+
+def demand_origins(demand):
+    # rows of a sparse od table (or of a change to one) with any trips
+    return np.flatnonzero(np.asarray(abs(demand).sum(axis=1)).ravel() > 0)
+
+def load_trees(pred, demand, link_keys, link_ids, number_of_links):
+    # push demand from every destination back up its origin's shortest path tree, all origins at once.
+    # pred is (origins x nodes) from dijkstra, demand is (origins x zones), sparse.
+    R, V = pred.shape
+    acc = np.zeros((R, V))
+    od = demand.tocoo()
+    np.add.at(acc, (od.row, od.col), od.data)
+
+    # depth of every node in its tree by pointer jumping
+    reach = pred >= 0
+    depth = reach.astype(np.int64)
+    anc = np.where(reach, pred, -1)
+    rows = np.arange(R)[:, None]
+    while True:
+        valid = anc >= 0
+        if not valid.any():
+            break
+        a = np.where(valid, anc, 0)
+        depth = depth + np.where(valid, depth[rows, a], 0)
+        anc = np.where(valid, anc[rows, a], -1)
+
+    # accumulate subtree demand level by level, deepest first
+    flat = np.flatnonzero(reach)
+    lvl = depth.ravel()[flat]
+    srt = np.argsort(-lvl, kind='stable')
+    flat = flat[srt]
+    lvl = lvl[srt]
+    parent = (flat // V) * V + pred.ravel()[flat]
+    acc = acc.ravel()
+    bounds = np.concatenate(([0], np.flatnonzero(np.diff(lvl)) + 1, [len(flat)]))
+    for s, e in zip(bounds[:-1], bounds[1:]):
+        np.add.at(acc, parent[s:e], acc[flat[s:e]])
+
+    # flow into each tree node sits on the link (pred, node)
+    keys = pred.ravel()[flat] * V + flat % V
+    links = link_ids[np.searchsorted(link_keys, keys)]
+    return np.bincount(links, weights=acc[flat], minlength=number_of_links)
+
+def link_cost_functions(ta_data):
+    # the link travel time (BPR) function, the objective and the travel time derivative (the objective's hessian
+    # diagonal), all of the flow assigned on top of the fixed flow inferred from the seeded travel times.
+    # BPR takes the flows of all links, or of just the links (indices) given
+    capacity = ta_data['capacity']
+    free_flow_time = ta_data['free_flow_time']
+    B = ta_data['B']
+    power = ta_data['power']
+    travel_time = ta_data['travel_time']
+
+    # calculate flow from seeded times
+    fixed_flow = np.zeros(ta_data['number_of_links'])
+    if travel_time.any():
+        with np.errstate(divide='ignore', invalid='ignore'):
+            seeded = ((travel_time/free_flow_time - 1)/B)**(1/power) * capacity
+        skip = (free_flow_time > travel_time) | (travel_time == 0) | (free_flow_time == 0)
+        fixed_flow = np.where(skip, 0, seeded)
+
+    link_constant = ta_data['toll_factor'] * ta_data['toll'] + ta_data['distance_factor'] * ta_data['link_length']
+
+    def BPR(x, links=slice(None)):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            vc = (x + fixed_flow[links])/capacity[links]
+        vc[np.isnan(vc)] = 0 # empty zero-capacity link
+        return free_flow_time[links] * (1.0 + B[links] * vc**power[links]) + link_constant[links]
+
+    def objective(x):
+        xf = x + fixed_flow
+        with np.errstate(divide='ignore', invalid='ignore'):
+            congestion = B * xf**(power+1) / capacity**power / (power+1)
+        congestion[np.isnan(congestion)] = 0
+        return np.sum(free_flow_time * (xf + congestion) + link_constant)
+
+    def hessian_diag(x):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            h_diag = free_flow_time * B * power * (x + fixed_flow)**(power-1) / capacity**power
+        return np.where(power >= 1.0, h_diag, 0) # some cases, power is zero.
+
+    return fixed_flow, BPR, objective, hessian_diag
+
+def ta_frank_wolfe(ta_data, method='bfw', min_iter_no=5, max_iter_no=2000, step='exact', log=False, tol=1e-3,
+                   x0=None, demand0=None, progress=None, time_budget=None):
+    # same algorithm and convergence test as ta_frank_wolfe in traffic_assignment.jl: the relative gap, how much
+    # the total travel time is over what it would be with every trip on a shortest path at the current times
+    # CFW and BFW in Mitradijieva and Lindberg (2013)
+    # x0: link flows to start from instead of all-or-nothing, e.g. a previous equilibrium of the same network.
+    # demand0: the od table x0 was solved for, if different from this one.
+    # progress(k, rel_gap, objective): called after each iteration's convergence test is computed.
+    # time_budget: seconds after which to stop with the flows so far, if tol or max_iter_no aren't reached first.
+    # the stats returned say which it was ('stopped'), with the gap and objective of every iteration ('trace').
+    start_time = time()
+
+    number_of_zones = ta_data['number_of_zones']
+    number_of_nodes = ta_data['number_of_nodes']
+    number_of_links = ta_data['number_of_links']
+
+    start_node = ta_data['start_node']
+    end_node = ta_data['end_node']
+    travel_demand = csr_matrix(ta_data['travel_demand'], dtype=float)
+    travel_time = ta_data['travel_time']
+
+    # preparing a graph
+    graph, order = create_graph(start_node, end_node, number_of_nodes)
+    link_keys = start_node[order] * number_of_nodes + end_node[order]
+    link_ids = order
+
+    fixed_flow, BPR, objective, hessian_diag = link_cost_functions(ta_data)
+
+    # only origins with trips get a shortest path tree
+    origins = demand_origins(travel_demand)
+    batch = max(1, AON_BATCH_CELLS // number_of_nodes)
+
+    def all_or_nothing(travel_time, demand=travel_demand, origins=origins):
+        graph.data[:] = travel_time[order]
+        x = np.zeros(number_of_links)
+        for i in range(0, len(origins), batch):
+            chunk = origins[i:i+batch]
+            _, pred = dijkstra(graph, indices=chunk, return_predecessors=True)
+            x += load_trees(pred, demand[chunk], link_keys, link_ids, number_of_links)
+        return x
+
+    def warm_start(x0, demand0):
+        xk = np.array(x0, dtype=float)
+        if demand0 is not None:
+            # move the od cells that changed along shortest paths at the previous equilibrium
+            delta = travel_demand - csr_matrix(demand0, dtype=float)
+            xk += all_or_nothing(BPR(xk), delta, demand_origins(delta))
+        # removed demand must not take any link below zero, otherwise the start isn't usable
+        if xk.min() < -1e-6 * max(1.0, xk.max()):
+            return None
+        return np.maximum(xk, 0)
+
+    def line_search(xk, dk):
+        # objective is convex along dk, so bisect on its directional derivative over [0, 1]
+        lo, hi = 0.0, 1.0
+        if np.dot(BPR(xk), dk) >= 0:
+            return lo
+        if np.dot(BPR(xk + dk), dk) <= 0:
+            return hi
+        for _ in range(50):
+            mid = (lo + hi)/2
+            if np.dot(BPR(xk + mid*dk), dk) > 0:
+                hi = mid
+            else:
+                lo = mid
+            if hi - lo < 1e-10:
+                break
+        return (lo + hi)/2
+
+    def conjugate_weight(dk_bar, dk_FW, Hk_diag):
+        Nk = np.dot(dk_bar, Hk_diag * dk_FW)
+        Dk = np.dot(dk_bar, Hk_diag * (dk_FW - dk_bar))
+
+        delta = 0.0001
+        if Dk != 0 and 0 <= Nk/Dk <= 1-delta:
+            return Nk/Dk
+        elif Dk != 0 and Nk/Dk > 1-delta:
+            return 1-delta
+        return 0
+
+    # finding a starting feasible solution
+    xk = None
+    if x0 is not None:
+        xk = warm_start(x0, demand0)
+    is_warm = xk is not None
+    if not is_warm:
+        if not travel_time.any():
+            travel_time = BPR(np.zeros(number_of_links))
+        xk = all_or_nothing(travel_time)
+
+    tauk = 0.0
+    sk_CFW = xk
+    sk_BFW = xk
+    sk_BFW_old = xk
+    is_first_iteration = False
+    is_second_iteration = False
+
+    trace = {'gap': [], 'objective': []}
+    stopped = 'max_iter'
+    k = 0
+    for k in range(1, max_iter_no+1):
+        # finding yk
+        travel_time = BPR(xk)
+        yk_FW = all_or_nothing(travel_time)
+
+        # basic frank-wolfe direction
+        dk_FW = yk_FW - xk
+        Hk_diag = hessian_diag(xk)
+
+        # finding a feasible direction
+        if method == 'fw':
+            dk = dk_FW
+        elif method == 'cfw':
+            if k == 1 or tauk > 0.999999: # if tauk=1, then start the process all over again.
+                sk_CFW = yk_FW
+            else:
+                alphak = conjugate_weight(sk_CFW - xk, dk_FW, Hk_diag)
+                sk_CFW = alphak * sk_CFW + (1-alphak) * yk_FW
+            dk = sk_CFW - xk
+        elif method == 'bfw':
+            if tauk > 0.999999:
+                is_first_iteration = True
+                is_second_iteration = True
+
+            if k == 1 or is_first_iteration: # first iteration is like FW
+                sk_BFW_old = yk_FW
+                dk = dk_FW
+                is_first_iteration = False
+            elif k == 2 or is_second_iteration: # second iteration is like CFW
+                alphak = conjugate_weight(sk_BFW_old - xk, dk_FW, Hk_diag)
+                sk_BFW = alphak * sk_BFW_old + (1-alphak) * yk_FW
+                dk = sk_BFW - xk
+                is_second_iteration = False
+            else:
+                # sk_BFW, tauk is from iteration k-1, sk_BFW_old is from iteration k-2
+                dk_bar = sk_BFW - xk
+                dk_bbar = tauk * sk_BFW - xk + (1-tauk) * sk_BFW_old
+
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    muk = - np.dot(dk_bbar, Hk_diag * dk_FW) / np.dot(dk_bbar, Hk_diag * (sk_BFW_old - sk_BFW))
+                    nuk = - np.dot(dk_bar, Hk_diag * dk_FW) / np.dot(dk_bar, Hk_diag * dk_bar) + muk*tauk/(1-tauk)
+                muk = max(0, muk) if np.isfinite(muk) else 0
+                nuk = max(0, nuk) if np.isfinite(nuk) else 0
+
+                beta0 = 1 / (1 + muk + nuk)
+                beta1 = nuk * beta0
+                beta2 = muk * beta0
+
+                sk_BFW_new = beta0 * yk_FW + beta1 * sk_BFW + beta2 * sk_BFW_old
+                dk = sk_BFW_new - xk
+
+                sk_BFW_old = sk_BFW
+                sk_BFW = sk_BFW_new
+        else:
+            raise ValueError("The type of Frank-Wolfe method is specified incorrectly. Use 'fw', 'cfw', or 'bfw'.")
+
+        if step == 'exact':
+            tauk = line_search(xk, dk)
+        elif step == 'newton':
+            tauk = - np.dot(BPR(xk), dk) / np.dot(dk, Hk_diag*dk)
+            tauk = max(0, min(1, tauk))
+
+        obj = objective(xk)
+        if log:
+            average_excess_cost = (np.dot(xk, travel_time) - np.dot(yk_FW, travel_time)) / travel_demand.sum()
+            print('k={:4d}, tauk={:15.10f}, objective={:15f}, aec={:15.10f}'.format(k, tauk, obj, average_excess_cost))
+
+        # convergence test, on the all-or-nothing flows found above
+        total_time = np.dot(xk, travel_time)
+        rel_gap = max(0.0, (total_time - np.dot(yk_FW, travel_time)) / total_time) if total_time > 0 else 0.0
+        trace['gap'].append(rel_gap)
+        trace['objective'].append(obj)
+        if progress is not None:
+            progress(k, rel_gap, obj)
+        if k > min_iter_no and rel_gap < tol:
+            stopped = 'converged'
+            break
+
+        # update x, clipping round-off below zero
+        xk = np.maximum(xk + tauk*dk, 0)
+
+        if (time_budget is not None) and (time() - start_time > time_budget):
+            stopped = 'time_budget'
+            break
+
+    stats = {
+        'iterations': k,
+        'warm_start': is_warm,
+        'stopped': stopped,
+        'gap': trace['gap'][-1] if trace['gap'] else None,
+        'trace': trace
+    }
+
+    return xk, BPR(xk), objective(xk), fixed_flow, stats
@@ -0,0 +1,122 @@
+# sampled traffic querying for networks too big to query every edge. sample_edges picks a budgeted subset of
+# edges stratified by highway class and a grid of spatial cells; once those are queried, interpolate_ratios
+# estimates api_ratio (and the travel times) on the rest from measured edges nearby, falling back to the class
+# median. every edge handled is flagged with api_measured so estimates can be told apart from measurements.
+
+import numpy as np
+from statistics import median
+
+def road_edges(g):
+    # edges between road nodes; TAZ connectors aren't queried
+    return [(n1, n2) for n1, n2 in g.edges() if not (g.nodes[n1].get('taz') or g.nodes[n2].get('taz'))]
+
+def edge_strata(g, edges, cells):
+    # (highway, cell column, cell row) of each edge's midpoint on a cells x cells grid over the network
+    lon = np.array([(g.nodes[n1]['lon'] + g.nodes[n2]['lon']) / 2 for n1, n2 in edges])
+    lat = np.array([(g.nodes[n1]['lat'] + g.nodes[n2]['lat']) / 2 for n1, n2 in edges])
+
+    def cell(x):
+        span = x.max() - x.min()
+        if span == 0:
+            return np.zeros(len(x), dtype=int)
+        return np.minimum(((x - x.min()) / span * cells).astype(int), cells - 1)
+
+    highways = [g[n1][n2].get('highway', 'unknown') for n1, n2 in edges]
+    return list(zip(highways, cell(lon).tolist(), cell(lat).tolist()))
+
+def sample_edges(g, budget, cells=None, seed=0):
+    # returns at most `budget` road edges. every stratum gets at least one edge if the budget allows, and the
+    # rest is shared out in proportion to stratum size. cells defaults to about four sampled edges per cell.
+    edges = road_edges(g)
+    if budget >= len(edges):
+        return edges
+    if cells is None:
+        cells = max(1, int(np.sqrt(budget / 4)))
+
+    strata = {}
+    for i, s in enumerate(edge_strata(g, edges, cells)):
+        strata.setdefault(s, []).append(i)
+    members = list(strata.values())
+    sizes = np.array([len(m) for m in members])
+
+    if budget >= len(members):
+        take = np.ones(len(members), dtype=int)
+        share = (sizes - 1) * (budget - len(members)) / max(1, (sizes - 1).sum())
+    else:
+        take = np.zeros(len(members), dtype=int)
+        share = sizes * budget / sizes.sum()
+    take += np.floor(share).astype(int)
+    # hand out what rounding left over to the largest remainders
+    left = budget - take.sum()
+    room = take < sizes
+    order = np.argsort(-(share - np.floor(share)) - room, kind='stable')
+    take[order[:left]] += 1
+
+    rng = np.random.default_rng(seed)
+    chosen = np.concatenate([rng.choice(m, n, replace=False) for m, n in zip(members, take) if n > 0])
+    return [edges[i] for i in np.sort(chosen)]
+
+def neighbour_nodes(g, n):
+    # both directions, skipping TAZs
+    return {m for m in list(g.successors(n)) + list(g.predecessors(n)) if not g.nodes[m].get('taz')}
+
+def interpolate_ratios(g, queried, max_hops=3):
+    # queried edges with both travel times are measured. every other road edge gets the median api_ratio of the
+    # nearest measured edges (same class preferred) within max_hops, else its class median, else the overall one.
+    # unmeasured edges also get ff_best_guess from fftime scaled like measured edges of their class, and the
+    # am_best_guess that ratio implies. returns (measured, interpolated) counts.
+    queried = set(queried)
+    measured = {
+        e for e in queried if (g.edges[e]['ff_best_guess'] > 0) and (g.edges[e]['am_best_guess'] > 0)
+    }
+
+    def highway(e):
+        return g.edges[e].get('highway', 'unknown')
+
+    # class statistics
+    ratios = {}
+    ff_scale = {}
+    for e in measured:
+        dat = g.edges[e]
+        ratios.setdefault(highway(e), []).append(dat['api_ratio'])
+        if dat['fftime'] > 0:
+            ff_scale.setdefault(highway(e), []).append(dat['ff_best_guess'] / dat['fftime'])
+    all_ratios = [r for rs in ratios.values() for r in rs]
+    all_scales = [s for ss in ff_scale.values() for s in ss]
+    class_ratio = {h: median(rs) for h, rs in ratios.items()}
+    class_scale = {h: median(ss) for h, ss in ff_scale.items()}
+    overall_ratio = median(all_ratios) if all_ratios else 1
+    overall_scale = median(all_scales) if all_scales else 1
+
+    def incident(n):
+        return [(n, m) for m in g.successors(n)] + [(m, n) for m in g.predecessors(n)]
+
+    def nearby_ratio(e):
+        # widen one hop at a time around the edge until measured edges turn up
+        seen = set(e)
+        ring = set(e)
+        for _ in range(max_hops):
+            found = {f for n in ring for f in incident(n) if f in measured}
+            if found:
+                same = [g.edges[f]['api_ratio'] for f in found if highway(f) == highway(e)]
+                return median(same or [g.edges[f]['api_ratio'] for f in found])
+            ring = {m for n in ring for m in neighbour_nodes(g, n)} - seen
+            seen |= ring
+        return None
+
+    interpolated = 0
+    for e in road_edges(g):
+        dat = g.edges[e]
+        if e in measured:
+            dat['api_measured'] = True
+            continue
+        ratio = nearby_ratio(e)
+        if ratio is None:
+            ratio = class_ratio.get(highway(e), overall_ratio)
+        dat['api_ratio'] = ratio
+        dat['ff_best_guess'] = dat['fftime'] * class_scale.get(highway(e), overall_scale)
+        dat['am_best_guess'] = dat['ff_best_guess'] * ratio
+        dat['api_measured'] = False
+        interpolated += 1
+
+    return len(measured), interpolated
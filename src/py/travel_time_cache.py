@@ -0,0 +1,88 @@
+# persistent cache of Directions travel times, so re-fetching traffic for a network only pays for edges that
+# weren't queried recently. entries are keyed by origin/destination rounded to ~1m, the departure slot (time of
+# week in 15 minute steps, so "next wednesday 8am" matches across weeks) and the traffic model. entries expire
+# after ttl seconds, and the least recently used ones are dropped once there are more than max_entries.
+
+import sqlite3
+import threading
+from time import time
+
+WEEK = 7 * 24 * 60 * 60
+SLOT = 15 * 60
+
+def departure_slot(departure_time):
+    return (int(departure_time) % WEEK) // SLOT
+
+def point_key(lat, lon, digits=5):
+    return '{:.{d}f},{:.{d}f}'.format(lat, lon, d=digits)
+
+class TravelTimeCache(object):
+
+    def __init__(self, filename, ttl=30 * 24 * 60 * 60, max_entries=2000000):
+        self.filename = filename
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        # one connection shared by the server's request threads, used under the lock
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(filename, check_same_thread=False)
+        with self.db:
+            self.db.execute('''
+                CREATE TABLE IF NOT EXISTS travel_times (
+                    origin TEXT, destination TEXT, slot INTEGER, model TEXT,
+                    duration REAL, fetched REAL, used REAL,
+                    PRIMARY KEY (origin, destination, slot, model)
+                )''')
+            self.db.execute('CREATE INDEX IF NOT EXISTS travel_times_used ON travel_times (used)')
+
+    def get_many(self, keys):
+        # keys are (origin, destination, slot, model); returns {key: duration} for the fresh entries among them
+        now = time()
+        found = {}
+        with self.lock, self.db:
+            for key in keys:
+                row = self.db.execute(
+                    'SELECT duration FROM travel_times WHERE origin=? AND destination=? AND slot=? AND model=? AND fetched>?',
+                    key + (now - self.ttl,)
+                ).fetchone()
+                if row is not None:
+                    found[key] = row[0]
+            self.db.executemany(
+                'UPDATE travel_times SET used=? WHERE origin=? AND destination=? AND slot=? AND model=?',
+                ((now,) + key for key in found)
+            )
+        self.hits += len(found)
+        self.misses += len(keys) - len(found)
+        return found
+
+    def put_many(self, items):
+        # items are (key, duration) pairs
+        now = time()
+        with self.lock, self.db:
+            self.db.executemany(
+                'INSERT OR REPLACE INTO travel_times VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (key + (duration, now, now) for key, duration in items)
+            )
+        self.evict()
+
+    def evict(self):
+        with self.lock, self.db:
+            self.db.execute('DELETE FROM travel_times WHERE fetched<=?', (time() - self.ttl,))
+            excess = self.db.execute('SELECT COUNT(*) FROM travel_times').fetchone()[0] - self.max_entries
+            if excess > 0:
+                self.db.execute(
+                    'DELETE FROM travel_times WHERE rowid IN (SELECT rowid FROM travel_times ORDER BY used LIMIT ?)',
+                    (excess,)
+                )
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        with self.lock:
+            entries = self.db.execute('SELECT COUNT(*) FROM travel_times').fetchone()[0]
+        return {
+            'entries': entries,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0
+        }
@@ -1,103 +1,521 @@
+import hashlib
+import multiprocessing
+import os
+import subprocess
+import numpy as np
 import pandas as pd
-from os import system, remove
-
-NET_FILENAME = "tmp/net.csv"
-NET_METADATA_FILENAME = "tmp/net_metadata.csv"
-TRIP_METADATA_FILENAME = "tmp/trip_metadata.csv"
-TRIP_FILENAME = "tmp/trips.csv"
-OUT_FILENAME = "tmp/TA_results.csv"
-
-def dump_network_as_csvs(g, ntazs):
-    df = pd.DataFrame(columns=['tail','head','capacity','length','fftime','b','power','speedlimit','toll','type','am','base'])
-
-    # iterate through all edges
-    node_counter = ntazs
-    edge_counter = 0
-    node_to_id = {}
-    id_to_node = {}
-    for i in range(1, ntazs+1):
-        node_to_id[i] = i
-        id_to_node[i] = i
-    for n1, n2 in g.edges():
-
-        # reindex nodes
-        if n1 not in node_to_id:
-            node_counter += 1
-            node_to_id[n1] = node_counter
-            id_to_node[node_counter] = n1
-        if n2 not in node_to_id:
-            node_counter += 1
-            node_to_id[n2] = node_counter
-            id_to_node[node_counter] = n2
-  
-        row = {}
-        row['tail'] = node_to_id[n1]
-        row['head'] = node_to_id[n2]
-        row['capacity'] = g[n1][n2]['capacity']
-        row['length'] = g[n1][n2]['length']
-        row['speedlimit'] = g[n1][n2]['maxspeed']
-        row['fftime'] = g[n1][n2]['fftime']
-        row['b'] = g[n1][n2]['b']
-        row['power'] = g[n1][n2]['power']
-        
-        row['toll'] =  0 # see osm fee, payment, toll, charge tags. assuming 0 because no transbay bridges are included in the bounding box.
-        row['type'] =  1 # not making a distinction for now. if we want to, try https://github.com/bstabler/TransportationNetworks/blob/45c79942bfcd007bce644b825b7f4571355d33a0/Philadelphia/README.md
-        
-        row['am'] = g[n1][n2]['am_best_guess']
-        row['base'] = g[n1][n2]['ff_best_guess']
-        
-        df.loc[edge_counter] = row
-        edge_counter += 1
-
-    # ensure ints
-    df['tail'] = df['tail'].astype(int)
-    df['head'] = df['head'].astype(int)
-    
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+from src.py.ta_paths import ta_gradient_projection
+from src.py.ta_solver import load_ta_network, ta_frank_wolfe
+from src.py.trip_tables import sparse_trip_table
+
+# file names within the working directory each assignment run is given
+NET_FILENAME = "net.csv"
+NET_METADATA_FILENAME = "net_metadata.csv"
+TRIP_METADATA_FILENAME = "trip_metadata.csv"
+TRIP_FILENAME = "trips.bin"
+OUT_FILENAME = "TA_results.csv"
+
+# python solver settings, the same the julia script runs with by default. tol is the target relative gap, for
+# every engine
+SOLVER_SETTINGS = {'method': 'cfw', 'tol': 1e-4, 'max_iter_no': 2000, 'min_iter_no': 5, 'time_budget': None}
+
+# edge attributes an assignment sets
+LINK_RESULT_COLUMNS = ['proj_ttime', 'new_flow', 'fixed_flow', 'flow', 'fw_ratio', 'delta']
+
+def solver_settings(gap=None, max_iterations=None, time_budget=None):
+    # SOLVER_SETTINGS with the convergence controls a run can set: the target relative gap, an iteration cap and
+    # a wall-clock budget in seconds. the solver stops at whichever comes first. raises ValueError for bad values
+    def positive(name, value, kind):
+        try:
+            value = kind(value)
+        except (TypeError, ValueError):
+            raise ValueError('{} should be a number, not {!r}'.format(name, value))
+        if not value > 0:
+            raise ValueError('{} should be positive'.format(name))
+        return value
+
+    settings = dict(SOLVER_SETTINGS)
+    if gap is not None:
+        settings['tol'] = positive('gap', gap, float)
+    if max_iterations is not None:
+        settings['max_iter_no'] = positive('max_iterations', max_iterations, int)
+    if time_budget is not None:
+        settings['time_budget'] = positive('time_budget', time_budget, float)
+    return settings
+
+class ConvergenceTrace(object):
+    # the convergence stats the python solver returns (see ta_frank_wolfe), rebuilt for the julia engine from the
+    # progress it reports. pass it as the progress callback; it passes reports on to progress
+
+    def __init__(self, settings, progress=None):
+        self.settings = settings
+        self.progress = progress
+        self.trace = {'gap': [], 'objective': []}
+
+    def __call__(self, k, gap, obj):
+        self.trace['gap'].append(gap)
+        self.trace['objective'].append(obj)
+        if self.progress is not None:
+            self.progress(k, gap, obj)
+
+    def stats(self):
+        # julia stops on the same tests, in the same order, as the python solver
+        k = len(self.trace['gap'])
+        gap = self.trace['gap'][-1] if k else None
+        if k and (k > self.settings['min_iter_no']) and (gap < self.settings['tol']):
+            stopped = 'converged'
+        elif k >= self.settings['max_iter_no']:
+            stopped = 'max_iter'
+        else:
+            stopped = 'time_budget'
+        return {'iterations': k, 'stopped': stopped, 'gap': gap, 'trace': self.trace}
+
+def network_to_dataframe(g, ntazs):
+    edges = list(g.edges(data=True))
+    tails = np.array([n1 for n1, _, _ in edges], dtype=np.int64)
+    heads = np.array([n2 for _, n2, _ in edges], dtype=np.int64)
+
+    # reindex nodes in one pass: TAZs keep ids 1..ntazs, every other node is numbered by first appearance
+    nodes, first = np.unique(np.column_stack((tails, heads)).ravel(), return_index=True)
+    is_taz = (nodes >= 1) & (nodes <= ntazs)
+    others = np.flatnonzero(~is_taz)
+    others = others[np.argsort(first[others], kind='stable')]
+    new_ids = nodes.copy()
+    new_ids[others] = np.arange(ntazs+1, ntazs+1+len(others))
+    node_counter = ntazs + len(others)
+
+    id_to_node = np.arange(node_counter+1, dtype=np.int64)
+    id_to_node[ntazs+1:] = nodes[others]
+
+    def column(key):
+        return np.array([dat[key] for _, _, dat in edges], dtype=float)
+
+    df = pd.DataFrame({
+        'tail': new_ids[np.searchsorted(nodes, tails)],
+        'head': new_ids[np.searchsorted(nodes, heads)],
+        'capacity': column('capacity'),
+        'length': column('length'),
+        'fftime': column('fftime'),
+        'b': column('b'),
+        'power': column('power'),
+        'speedlimit': column('maxspeed'),
+        'toll': 0, # see osm fee, payment, toll, charge tags. assuming 0 because no transbay bridges are included in the bounding box.
+        'type': 1, # not making a distinction for now. if we want to, try https://github.com/bstabler/TransportationNetworks/blob/45c79942bfcd007bce644b825b7f4571355d33a0/Philadelphia/README.md
+        'am': column('am_best_guess'),
+        'base': column('ff_best_guess')
+    }, columns=['tail','head','capacity','length','fftime','b','power','speedlimit','toll','type','am','base'])
+
+    return df, id_to_node, node_counter
+
+def dump_network_as_csvs(g, ntazs, workdir):
+    df, id_to_node, node_counter = network_to_dataframe(g, ntazs)
+    edge_counter = len(df)
+
     # csv form
     # main body (edges)
-    df.to_csv('tmp/net.csv', index=False)
+    df.to_csv(os.path.join(workdir, NET_FILENAME), index=False)
     # header/metadata
-    with open('tmp/net_metadata.csv', 'w') as o:
+    with open(os.path.join(workdir, NET_METADATA_FILENAME), 'w') as o:
         o.write('<NUMBER OF ZONES>,{}\n<NUMBER OF NODES>,{}\n<NUMBER OF LINKS>,{}\n'.format(ntazs, node_counter, edge_counter))
 
     return id_to_node
 
-def dump_trips_as_csvs(trip_table, ntazs, total_trips):
-    pd.DataFrame(trip_table, columns=list(range(len(trip_table)))).to_csv('tmp/trips.csv')
-    with open('tmp/trip_metadata.csv', 'w') as o:
-        o.write('<NUMBER OF ZONES>,{}\n<TOTAL OD FLOW>,{}\n'.format(ntazs, total_trips))
-
-def run_trip_assignment(g, ntazs, trip_table, total_trips):
-    id_to_node = dump_network_as_csvs(g, ntazs)
-    dump_trips_as_csvs(trip_table, ntazs, total_trips)   
-    
-    system('./julia-0.6/bin/julia src/jl/traffic_assignment.jl {} {} {} {} {}'.format(
-        NET_FILENAME, NET_METADATA_FILENAME, TRIP_METADATA_FILENAME, TRIP_FILENAME, OUT_FILENAME))
-
-    remove(NET_FILENAME)
-    remove(NET_METADATA_FILENAME)
-    remove(TRIP_METADATA_FILENAME)
-    remove(TRIP_FILENAME)
-
-    dfres = pd.read_csv(OUT_FILENAME)
-    remove(OUT_FILENAME)
-    dfres['tail'] = dfres['tail'].apply(lambda x: id_to_node[x])
-    dfres['head'] = dfres['head'].apply(lambda x: id_to_node[x])
-
-    for i,row in dfres.iterrows():
-        edge = g[int(row['tail'])][int(row['head'])]
-        edge['proj_ttime'] = row['travel_time']
-        edge['new_flow'] = row['xk']
-        edge['fixed_flow'] = row['fixed_flow']   
-        edge['flow'] = row['xk'] + row['fixed_flow']
-        
-        if edge['ff_best_guess'] == 0:
-            edge['fw_ratio'] = 1
+def dump_trips_binary(trip_table, ntazs, total_trips, workdir):
+    # only the od pairs with trips, as raw little-endian arrays julia can read() straight in: int64 origins, int64
+    # destinations (zones from 1), then float64 trips. the metadata julia reads with them is still a small csv
+    od = sparse_trip_table(trip_table).tocoo()
+    with open(os.path.join(workdir, TRIP_FILENAME), 'wb') as o:
+        o.write(np.asarray(od.row + 1, dtype='<i8').tobytes())
+        o.write(np.asarray(od.col + 1, dtype='<i8').tobytes())
+        o.write(np.asarray(od.data, dtype='<f8').tobytes())
+    with open(os.path.join(workdir, TRIP_METADATA_FILENAME), 'w') as o:
+        o.write('<NUMBER OF ZONES>,{}\n<TOTAL OD FLOW>,{}\n<NUMBER OF OD PAIRS>,{}\n'.format(ntazs, total_trips, od.nnz))
+
+def julia_settings_args(settings):
+    # the convergence controls as the julia script's optional arguments: tol, max_iter_no and time budget
+    budget = settings['time_budget']
+    return [repr(float(settings['tol'])), str(int(settings['max_iter_no'])), repr(float('inf') if budget is None else float(budget))]
+
+def run_julia(files, progress=None, settings=SOLVER_SETTINGS):
+    # files: network, network metadata, trip metadata, trips and output, as the julia script takes them.
+    # returns the output as a dataframe
+    # the script prints "iteration <k> <relative gap> <objective>" as it goes
+    proc = subprocess.Popen(['./julia-0.6/bin/julia', 'src/jl/traffic_assignment.jl'] + files + julia_settings_args(settings),
+        stdout=subprocess.PIPE, universal_newlines=True)
+    try:
+        for line in proc.stdout:
+            fields = line.split()
+            if fields[:1] == ['iteration'] and progress is not None:
+                progress(int(fields[1]), float(fields[2]), float(fields[3]))
+        proc.wait()
+    except BaseException:
+        # e.g. a cancelled job: don't leave julia running
+        proc.kill()
+        proc.wait()
+        raise
+    if proc.returncode != 0:
+        raise RuntimeError('julia traffic assignment exited with code {}'.format(proc.returncode))
+    return pd.read_csv(files[-1])
+
+def solve_with_julia(g, ntazs, trip_table, total_trips, workdir, progress=None, julia_workers=None,
+                     settings=SOLVER_SETTINGS):
+    trace = ConvergenceTrace(settings, progress)
+    if julia_workers is not None:
+        df, id_to_node, node_counter = network_to_dataframe(g, ntazs)
+        dfres = julia_workers.solve(df, ntazs, node_counter, trip_table, total_trips, settings, trace)
+        return dfres, id_to_node, trace.stats()
+
+    id_to_node = dump_network_as_csvs(g, ntazs, workdir)
+    dump_trips_binary(trip_table, ntazs, total_trips, workdir)
+    files = [os.path.join(workdir, f) for f in (NET_FILENAME, NET_METADATA_FILENAME, TRIP_METADATA_FILENAME, TRIP_FILENAME, OUT_FILENAME)]
+
+    dfres = run_julia(files, trace, settings)
+    for f in files:
+        os.remove(f)
+
+    return dfres, id_to_node, trace.stats()
+
+def network_key(g, ntazs):
+    # identifies a network by its topology so edits to edge attributes map to the same key
+    links = np.array(sorted(g.edges()), dtype=np.int64)
+    return '{}-{}'.format(ntazs, hashlib.sha1(links.tobytes()).hexdigest())
+
+def match_links(old_links, new_links):
+    # the index in new_links of each of old_links, or None if the link sets differ
+    if len(old_links) != len(new_links):
+        return None
+    old_order = np.lexsort((old_links[:,1], old_links[:,0]))
+    new_order = np.lexsort((new_links[:,1], new_links[:,0]))
+    if not np.array_equal(old_links[old_order], new_links[new_order]):
+        return None
+    index = np.empty(len(old_links), dtype=np.int64)
+    index[old_order] = new_order
+    return index
+
+def align_flows(old_links, old_flows, new_links):
+    # reorder flows solved on old_links to match new_links, or None if the link sets differ
+    index = match_links(old_links, new_links)
+    if index is None:
+        return None
+    flows = np.empty(len(new_links))
+    flows[index] = old_flows
+    return flows
+
+def align_path_sets(old_links, path_sets, new_links):
+    # path sets (see ta_gradient_projection) found on old_links with their paths renumbered to new_links, or None
+    # if the link sets differ
+    index = match_links(old_links, new_links)
+    if index is None:
+        return None
+    return {origin: dict(s, paths=[index[p] for p in s['paths']]) for origin, s in path_sets.items()}
+
+def solve_with_python(g, ntazs, trip_table, warm_start=None, progress=None, settings=SOLVER_SETTINGS):
+    df, id_to_node, node_counter = network_to_dataframe(g, ntazs)
+    trip_table = sparse_trip_table(trip_table)
+    links = np.column_stack((id_to_node[df['tail']], id_to_node[df['head']]))
+
+    # start from the last equilibrium of this network when the links are unchanged
+    x0 = demand0 = None
+    if warm_start:
+        x0 = align_flows(warm_start['links'], warm_start['flows'], links)
+        if (x0 is not None) and (warm_start['demand'].shape == trip_table.shape):
+            if (warm_start['demand'] != trip_table).nnz:
+                demand0 = warm_start['demand']
+        else:
+            x0 = None
+
+    ta_data = load_ta_network(df, ntazs, node_counter, trip_table, travel_time_initialization='am', fftime='base')
+    xk, travel_time, obj, fixed_flow, stats = ta_frank_wolfe(ta_data, x0=x0, demand0=demand0, progress=progress,
+                                                             **settings)
+
+    if warm_start is not None:
+        # savings are counted against the last cold run, converged or not: cold_stopped says how it ended
+        if stats['warm_start']:
+            if 'cold_run' in warm_start:
+                stats['iterations_saved'] = max(0, warm_start['cold_run']['iterations'] - stats['iterations'])
+                stats['cold_stopped'] = warm_start['cold_run']['stopped']
         else:
-            edge['fw_ratio'] = edge['proj_ttime']/edge['ff_best_guess']
-        if edge['fw_ratio'] < 1:
-            edge['fw_ratio'] = 1
+            warm_start['cold_run'] = {'iterations': stats['iterations'], 'stopped': stats['stopped']}
+        warm_start.update({
+            'links': links,
+            'flows': xk,
+            'demand': trip_table
+        })
+        # the paths engine's path sets (see solve_with_paths) no longer match the stored equilibrium
+        warm_start.pop('paths', None)
 
-        edge["delta"] = edge["new_flow"]/edge["capacity"]
+    dfres = pd.DataFrame({
+        'tail': df['tail'],
+        'head': df['head'],
+        'travel_time': travel_time,
+        'xk': xk,
+        'fixed_flow': fixed_flow
+    })
+
+    return dfres, id_to_node, stats
+
+def solve_with_paths(g, ntazs, trip_table, warm_start=None, progress=None, settings=SOLVER_SETTINGS):
+    # path-based assignment (see src/py/ta_paths.py), for gaps the frank-wolfe engines take too long to reach.
+    # the path sets are kept in warm_start under 'paths', so a re-run of the scenario (e.g. with some od cells
+    # changed) starts from them; the link flows are stored as the python engine stores them, so either engine can
+    # warm start from the other's last run
+    df, id_to_node, node_counter = network_to_dataframe(g, ntazs)
+    trip_table = sparse_trip_table(trip_table)
+    links = np.column_stack((id_to_node[df['tail']], id_to_node[df['head']]))
+
+    paths0 = None
+    if warm_start and ('paths' in warm_start):
+        paths0 = align_path_sets(warm_start['paths']['links'], warm_start['paths']['path_sets'], links)
+
+    ta_data = load_ta_network(df, ntazs, node_counter, trip_table, travel_time_initialization='am', fftime='base')
+    xk, travel_time, obj, fixed_flow, stats, path_sets = ta_gradient_projection(ta_data, tol=settings['tol'],
+        max_iter_no=settings['max_iter_no'], paths0=paths0, progress=progress, time_budget=settings['time_budget'])
+
+    if warm_start is not None:
+        # as for the python engine, against the last cold run of this engine
+        cold_run = warm_start.get('paths', {}).get('cold_run')
+        if stats['warm_start']:
+            if cold_run is not None:
+                stats['iterations_saved'] = max(0, cold_run['iterations'] - stats['iterations'])
+                stats['cold_stopped'] = cold_run['stopped']
+        else:
+            cold_run = {'iterations': stats['iterations'], 'stopped': stats['stopped']}
+        warm_start.update({
+            'links': links,
+            'flows': xk,
+            'demand': trip_table,
+            'paths': {'links': links, 'path_sets': path_sets, 'cold_run': cold_run}
+        })
+
+    dfres = pd.DataFrame({
+        'tail': df['tail'],
+        'head': df['head'],
+        'travel_time': travel_time,
+        'xk': xk,
+        'fixed_flow': fixed_flow
+    })
+
+    return dfres, id_to_node, stats
+
+def link_results(g, dfres, id_to_node):
+    # the solver output as columns per link: the links in original node ids, then the edge attributes the
+    # assignment sets
+    tails = id_to_node[dfres['tail'].to_numpy()]
+    heads = id_to_node[dfres['head'].to_numpy()]
+    edges = [g[n1][n2] for n1, n2 in zip(tails.tolist(), heads.tolist())]
+    ff_best_guess = np.fromiter((edge['ff_best_guess'] for edge in edges), dtype=float, count=len(edges))
+    capacity = np.fromiter((edge['capacity'] for edge in edges), dtype=float, count=len(edges))
+
+    proj_ttime = dfres['travel_time'].to_numpy(dtype=float)
+    new_flow = dfres['xk'].to_numpy(dtype=float)
+    fixed_flow = dfres['fixed_flow'].to_numpy(dtype=float)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        fw_ratio = np.where(ff_best_guess == 0, 1, proj_ttime/ff_best_guess)
+        delta = new_flow/capacity
+    fw_ratio[fw_ratio < 1] = 1
+
+    return {
+        'links': np.column_stack((tails, heads)),
+        'proj_ttime': proj_ttime,
+        'new_flow': new_flow,
+        'fixed_flow': fixed_flow,
+        'flow': new_flow + fixed_flow,
+        'fw_ratio': fw_ratio,
+        'delta': delta
+    }
+
+def run_trip_assignment(g, ntazs, trip_table, total_trips, engine='julia', warm_start=None, workdir='tmp', progress=None,
+                        julia_workers=None, table=False, settings=SOLVER_SETTINGS):
+    # engine: 'julia' shells out to src/jl/traffic_assignment.jl, or hands the job to julia_workers (a
+    # JuliaWorkerPool, see src/py/julia_worker.py) if given; 'python' solves in-process with src/py/ta_solver.py;
+    # 'paths' solves in-process by gradient projection (src/py/ta_paths.py), much faster to tight relative gaps
+    # warm_start: dict kept by the caller per network/scenario. the python engines start from the equilibrium
+    # stored in it (if any) and store the new one back; 'paths' also keeps its path sets there.
+    # settings: solver settings, see solver_settings for the convergence controls. the iteration stats (why it
+    # stopped, the final gap and the gap and objective of every iteration) go in g.graph['assignment'].
+    # workdir: where the julia engine's input/output files go; give concurrent runs separate directories
+    # progress(iteration, relative gap, objective) is called after each iteration
+    # table: return the link results as columns (see link_results, plus the stats) and leave g as it is
+    if engine == 'julia':
+        dfres, id_to_node, stats = solve_with_julia(g, ntazs, trip_table, total_trips, workdir, progress, julia_workers,
+                                                    settings)
+    elif engine == 'python':
+        dfres, id_to_node, stats = solve_with_python(g, ntazs, trip_table, warm_start, progress, settings)
+    elif engine == 'paths':
+        dfres, id_to_node, stats = solve_with_paths(g, ntazs, trip_table, warm_start, progress, settings)
+    else:
+        raise ValueError('unknown assignment engine: {}'.format(engine))
+
+    results = link_results(g, dfres, id_to_node)
+    if table:
+        return dict(results, stats=stats)
+
+    # one update per edge, from plain python values
+    columns = [results[c].tolist() for c in LINK_RESULT_COLUMNS]
+    for (n1, n2), values in zip(results['links'].tolist(), zip(*columns)):
+        g[n1][n2].update(zip(LINK_RESULT_COLUMNS, values))
+    g.graph['assignment'] = stats
 
     return g
+
+# batch assignment of many scenarios (trip tables) on one network: the network is prepared once and the scenarios
+# are solved in parallel, the python engine on a process pool and the julia one as concurrent julia processes.
+
+def scenario_trip_tables(ntazs, scenarios, base_trip_table=None):
+    # each scenario has its own trip table ('tt') or scales the base one ('scale')
+    tables = []
+    for s in scenarios:
+        if 'tt' in s:
+            tt = sparse_trip_table(s['tt'])
+        elif base_trip_table is not None:
+            tt = sparse_trip_table(base_trip_table) * s.get('scale', 1)
+        else:
+            raise ValueError('scenario {} has no trip table and there is no base one to scale'.format(s.get('name')))
+        if tt.shape != (ntazs, ntazs):
+            raise ValueError('scenario {} trip table is {}, not {} x {}'.format(s.get('name'), tt.shape, ntazs, ntazs))
+        tables.append(tt)
+    return tables
+
+# the network a scenario worker process solves on, set once per process by init_scenario_worker
+scenario_network = None
+
+def init_scenario_worker(ta_data):
+    global scenario_network
+    scenario_network = ta_data
+
+def solve_scenario(trip_table, settings=SOLVER_SETTINGS):
+    ta_data = dict(scenario_network, travel_demand=trip_table)
+    xk, travel_time, obj, fixed_flow, stats = ta_frank_wolfe(ta_data, **settings)
+    return xk, travel_time, fixed_flow, dict(stats, objective=obj)
+
+def solve_numbered_scenario(job):
+    # solve_scenario for a pool worker: job is (scenario index, trip table, settings), and so is the result's start
+    i, trip_table, settings = job
+    return (i,) + solve_scenario(trip_table, settings)
+
+# these yield (scenario index, new flow, travel time, fixed flow, stats) as scenarios finish, with links in
+# g.edges() order, and None for every second nothing finishes so the caller can report progress (or cancel)
+
+def finished_scenarios(futures):
+    pending = set(futures)
+    while pending:
+        finished, pending = wait(pending, timeout=1, return_when=FIRST_COMPLETED)
+        if not finished:
+            yield None
+        for future in finished:
+            yield futures[future], future.result()
+
+def python_scenarios(g, ntazs, tables, workers, settings=SOLVER_SETTINGS):
+    df, id_to_node, node_counter = network_to_dataframe(g, ntazs)
+    ta_data = load_ta_network(df, ntazs, node_counter, tables[0], travel_time_initialization='am', fftime='base')
+    if workers == 1:
+        init_scenario_worker(ta_data)
+        for i, tt in enumerate(tables):
+            yield (i,) + solve_scenario(tt, settings)
+        return
+
+    # fork, so workers don't re-import the server module (and re-create its caches) the way spawn would. a worker
+    # only runs solve_numbered_scenario, on numpy and scipy, so it never waits on a server lock another thread held
+    # when it was forked
+    pool = multiprocessing.get_context('fork').Pool(workers, initializer=init_scenario_worker, initargs=(ta_data,))
+    results = pool.imap_unordered(solve_numbered_scenario, [(i, tt, settings) for i, tt in enumerate(tables)])
+    try:
+        for _ in tables:
+            while True:
+                try:
+                    yield results.next(timeout=1)
+                    break
+                except multiprocessing.TimeoutError:
+                    yield None
+    except BaseException:
+        # stopped early (an error, or a cancelled job): stop the workers rather than wait for their scenarios
+        pool.terminate()
+        pool.join()
+        raise
+    pool.close()
+    pool.join()
+
+def julia_scenarios(g, ntazs, tables, workers, workdir, julia_workers=None, settings=SOLVER_SETTINGS):
+    # with julia_workers, the network is converted once and the scenarios go to the workers (as many at once as
+    # are free); otherwise one copy of the network files, and a directory of trip files per scenario
+    if julia_workers is not None:
+        df, _, node_counter = network_to_dataframe(g, ntazs)
+
+        def solve(i, tt):
+            trace = ConvergenceTrace(settings)
+            return julia_workers.solve(df, ntazs, node_counter, tt, tt.sum(), settings, trace), trace.stats()
+    else:
+        dump_network_as_csvs(g, ntazs, workdir)
+        net_files = [os.path.join(workdir, f) for f in (NET_FILENAME, NET_METADATA_FILENAME)]
+
+        def solve(i, tt):
+            scenario_dir = os.path.join(workdir, str(i))
+            os.makedirs(scenario_dir)
+            dump_trips_binary(tt, ntazs, tt.sum(), scenario_dir)
+            trace = ConvergenceTrace(settings)
+            files = net_files + [os.path.join(scenario_dir, f) for f in (TRIP_METADATA_FILENAME, TRIP_FILENAME, OUT_FILENAME)]
+            return run_julia(files, trace, settings), trace.stats()
+
+    with ThreadPoolExecutor(workers) as pool:
+        futures = {pool.submit(solve, i, tt): i for i, tt in enumerate(tables)}
+        try:
+            for finished in finished_scenarios(futures):
+                if finished is None:
+                    yield None
+                    continue
+                i, (dfres, stats) = finished
+                yield i, dfres['xk'].to_numpy(), dfres['travel_time'].to_numpy(), dfres['fixed_flow'].to_numpy(), stats
+        finally:
+            # scenarios already running in julia finish, the rest are dropped
+            for future in futures:
+                future.cancel()
+
+def run_scenarios(g, ntazs, scenarios, base_trip_table=None, engine='python', workers=None, workdir='tmp', progress=None,
+                  julia_workers=None, settings=SOLVER_SETTINGS):
+    # scenarios: [{'name': ..., 'tt': trip table} or {'name': ..., 'scale': factor on base_trip_table}]
+    # workers: scenarios solved at once, by default one per core. progress(done, total) as scenarios finish.
+    # returns a table: links (tail, head) once, fixed_flow per link, and per scenario (in the order given) rows
+    # of new_flow and travel_time per link, plus each scenario's name, total trips and solver stats.
+    # settings (see solver_settings) apply to every scenario.
+    # g is left as it is.
+    tables = scenario_trip_tables(ntazs, scenarios, base_trip_table)
+    if not tables:
+        raise ValueError('no scenarios')
+    workers = max(1, min(workers or os.cpu_count() or 1, len(tables)))
+
+    if engine == 'python':
+        results = python_scenarios(g, ntazs, tables, workers, settings)
+    elif engine == 'julia':
+        results = julia_scenarios(g, ntazs, tables, workers, workdir, julia_workers, settings)
+    else:
+        raise ValueError('unknown assignment engine: {}'.format(engine))
+
+    links = np.array(list(g.edges()), dtype=np.int64)
+    new_flow = np.zeros((len(tables), len(links)))
+    travel_time = np.zeros((len(tables), len(links)))
+    fixed_flow = np.zeros(len(links))
+    stats = [None] * len(tables)
+    done = 0
+    try:
+        for result in results:
+            if result is not None:
+                i, new_flow[i], travel_time[i], fixed_flow, stats[i] = result
+                done += 1
+            if progress is not None:
+                progress(done, len(tables))
+    finally:
+        # if progress raised, stop the remaining scenarios now rather than when the generator is collected
+        results.close()
+
+    return {
+        'links': links,
+        'fixed_flow': fixed_flow,
+        'new_flow': new_flow,
+        'travel_time': travel_time,
+        'scenarios': [
+            {'name': s.get('name', str(i)), 'total_trips': float(tt.sum()), 'stats': st}
+            for i, (s, tt, st) in enumerate(zip(scenarios, tables, stats))
+        ]
+    }
@@ -0,0 +1,157 @@
+# reading uploaded trip tables, and keeping them server-side so the frontend names a table by id rather than
+# sending the whole matrix back and forth. zones are numbered from 1, rows are origins and columns destinations.
+# tables are kept sparse (scipy CSR) from here through the assignment, since most od pairs have no trips.
+# accepted forms:
+#   .csv  dense: the square matrix of volumes, no header. parsed in chunks of rows, each made sparse as it's read,
+#         with values read exactly (like np.genfromtxt did) rather than pandas' faster approximate parsing
+#         long: a header naming origin, destination and trips columns, one row per od pair (repeats are summed)
+#   .npy  the square matrix
+#   .npz  the square matrix as its only array, origin/destination/trips arrays, or a scipy.sparse.save_npz matrix
+
+import threading
+import uuid
+import numpy as np
+import pandas as pd
+from collections import OrderedDict
+from scipy.sparse import coo_matrix, csr_matrix, issparse, load_npz, vstack
+
+LONG_COLUMNS = ['origin', 'destination', 'trips']
+CHUNK_ROWS = 1024
+CHUNK_PAIRS = 1 << 20
+
+def sparse_trip_table(tt):
+    # a trip table as sent (nested lists), read or stored, as a float CSR matrix without explicit zeros
+    if issparse(tt):
+        tt = csr_matrix(tt, dtype=float, copy=True)
+    else:
+        tt = csr_matrix(np.asarray(tt, dtype=float))
+    tt.eliminate_zeros()
+    return tt
+
+def trip_table_bytes(tt):
+    return tt.data.nbytes + tt.indices.nbytes + tt.indptr.nbytes
+
+def check_trip_table(tt):
+    if (len(tt.shape) != 2) or (tt.shape[0] != tt.shape[1]):
+        raise ValueError('trip table is {}, not square'.format(tt.shape))
+    if tt.shape[0] < 2:
+        raise ValueError('trip table needs at least 2 zones')
+    if not np.isfinite(tt.data).all():
+        raise ValueError('trip table has blank or non-numeric cells')
+    if (tt.data < 0).any():
+        raise ValueError('trip table has negative trips')
+    return tt
+
+def read_dense_csv(filename):
+    blocks = []
+    for chunk in pd.read_csv(filename, header=None, dtype=np.float64, float_precision='round_trip', chunksize=CHUNK_ROWS):
+        blocks.append(csr_matrix(chunk.to_numpy()))
+    if not blocks:
+        raise ValueError('trip table is empty')
+    return vstack(blocks, format='csr')
+
+def long_to_sparse(origins, destinations, trips, ntazs=None):
+    # ntazs: number of zones, if more than the highest zone in the table
+    origins = np.asarray(origins)
+    destinations = np.asarray(destinations)
+    if len(origins) == 0:
+        raise ValueError('trip table is empty')
+    zones = np.concatenate((origins, destinations))
+    if (zones != np.round(zones)).any() or (zones.min() < 1):
+        raise ValueError('zones must be numbered from 1')
+    n = max(int(zones.max()), ntazs or 0)
+    return coo_matrix((np.asarray(trips, dtype=float), (origins.astype(np.int64) - 1, destinations.astype(np.int64) - 1)),
+                      shape=(n, n)).tocsr()
+
+def read_long_csv(filename, ntazs=None):
+    columns = {c: [] for c in LONG_COLUMNS}
+    reader = pd.read_csv(filename, usecols=lambda c: c.strip().lower() in LONG_COLUMNS, dtype=np.float64,
+                         float_precision='round_trip', chunksize=CHUNK_PAIRS)
+    for chunk in reader:
+        chunk.columns = [c.strip().lower() for c in chunk.columns]
+        if set(chunk.columns) != set(LONG_COLUMNS):
+            raise ValueError('long form trip table needs origin, destination and trips columns')
+        for c in LONG_COLUMNS:
+            columns[c].append(chunk[c].to_numpy())
+    if not columns['trips']:
+        raise ValueError('trip table is empty')
+    return long_to_sparse(*(np.concatenate(columns[c]) for c in LONG_COLUMNS), ntazs=ntazs)
+
+def has_header(filename):
+    # long form tables start with their column names, dense ones with a row of numbers
+    with open(filename, 'r', errors='replace') as f:
+        first = f.readline()
+    try:
+        [float(v) for v in first.split(',') if v.strip()]
+    except ValueError:
+        return True
+    return False
+
+def read_npz(filename, ntazs=None):
+    with np.load(filename, allow_pickle=False) as f:
+        if set(LONG_COLUMNS) <= set(f.files):
+            return long_to_sparse(*(f[c] for c in LONG_COLUMNS), ntazs=ntazs)
+        if len(f.files) == 1:
+            return f[f.files[0]]
+        if 'format' not in f.files:
+            raise ValueError('npz trip table should hold one matrix, or origin, destination and trips arrays')
+    # saved with scipy.sparse.save_npz
+    return load_npz(filename)
+
+def read_trip_table(filename, ntazs=None):
+    # returns the table as CSR, or raises ValueError if the file doesn't hold a valid one.
+    # ntazs: zone count for long form tables whose last zones have no trips
+    extension = filename.rsplit('.', 1)[-1].lower()
+    try:
+        if extension == 'npy':
+            tt = np.load(filename, allow_pickle=False)
+        elif extension == 'npz':
+            tt = read_npz(filename, ntazs)
+        elif has_header(filename):
+            tt = read_long_csv(filename, ntazs)
+        else:
+            tt = read_dense_csv(filename)
+        tt = sparse_trip_table(tt)
+    except (OSError, TypeError, pd.errors.ParserError, pd.errors.EmptyDataError) as e:
+        raise ValueError('could not read trip table: {}'.format(e))
+    return check_trip_table(tt)
+
+def trip_table_summary(tt, preview=10):
+    # what the frontend shows of a table: totals, sizes, and its top left corner
+    return {
+        'ntazs': tt.shape[0],
+        'total_trips': float(tt.sum()),
+        'nonzero': int(tt.nnz),
+        'preview': tt[:preview, :preview].toarray().tolist()
+    }
+
+class TripTableStore(object):
+    # uploaded tables by id, in memory up to max_bytes, least recently used first out. stored tables aren't modified
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.tables = OrderedDict()
+        self.bytes = 0
+        self.lock = threading.Lock()
+
+    def put(self, tt):
+        table_id = uuid.uuid4().hex
+        with self.lock:
+            self.tables[table_id] = tt
+            self.bytes += trip_table_bytes(tt)
+            # always keeps the newest table, even if it alone is over the limit
+            while (self.bytes > self.max_bytes) and (len(self.tables) > 1):
+                _, old = self.tables.popitem(last=False)
+                self.bytes -= trip_table_bytes(old)
+        return table_id
+
+    def get(self, table_id):
+        with self.lock:
+            if table_id not in self.tables:
+                return None
+            self.tables.move_to_end(table_id)
+            return self.tables[table_id]
+
+    def stats(self):
+        with self.lock:
+            return {'tables': len(self.tables), 'bytes': self.bytes, 'max_bytes': self.max_bytes}